@@ -0,0 +1,95 @@
+import json
+import logging
+import platform
+import statistics
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Latency summary of samples in milliseconds
+def summarize(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+
+    def pct(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        'n': len(ordered),
+        'mean_ms': statistics.fmean(ordered),
+        'p50_ms': pct(0.50),
+        'p95_ms': pct(0.95),
+        'p99_ms': pct(0.99),
+    }
+
+
+def fmt(stats: Dict[str, float]) -> str:
+    return f"p50 {stats['p50_ms']:.2f} ms, p95 {stats['p95_ms']:.2f} ms, p99 {stats['p99_ms']:.2f} ms"
+
+
+def environment() -> dict:
+    info = {'python': platform.python_version(), 'machine': platform.machine(), 'time': time.time()}
+    try:
+        import torch
+        info['torch'] = torch.__version__
+        info['cpu_threads'] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return info
+
+
+def save(path: str, results: dict) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    logger.info(f"Results written to {path}")
+
+
+def load(path: str) -> dict:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _flatten(data: dict, prefix: str = '') -> Dict[str, float]:
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+# Compares p50/p95 latencies (lower is better) and *_per_s rates (higher is better) with the baseline;
+# p99 and means of short runs are too noisy to gate on. Returns the names that got worse by more
+# than `tolerance` (0.1 = 10%), logs everything that moved by more than that either way
+def compare(results: dict, baseline: dict, tolerance: float = 0.1) -> List[str]:
+    current, previous = _flatten(results), _flatten(baseline)
+    regressions = []
+    for name in sorted(current):
+        if name not in previous or not previous[name]:
+            continue
+        if name.endswith(('p50_ms', 'p95_ms')):
+            change = current[name] / previous[name] - 1
+        elif name.endswith('_per_s'):
+            change = previous[name] / current[name] - 1 if current[name] else float('inf')
+        else:
+            continue
+        if abs(change) <= tolerance:
+            continue
+        if change > 0:
+            regressions.append(name)
+        logger.info(f"{'slower' if change > 0 else 'faster'} {name}: {previous[name]:.3f} -> {current[name]:.3f}")
+    return regressions
+
+
+def check_baseline(results: dict, baseline: Optional[str], tolerance: float) -> bool:
+    if not baseline:
+        return True
+    regressions = compare(results, load(baseline), tolerance)
+    if regressions:
+        logger.warning(f"{len(regressions)} regressions over {tolerance:.0%}: {', '.join(regressions)}")
+    else:
+        logger.info(f"No regressions over {tolerance:.0%} against {baseline}")
+    return not regressions
@@ -0,0 +1,93 @@
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from datetime import timedelta
+from typing import List
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from benchmarks.common import check_baseline, environment, fmt, save, summarize
+from benchmarks.meals import MEALS_PER_DAY, USER_ID, fill, seed_calories
+from src.database.calories import calorie_index
+from src.database.engine import PRAGMAS, POOL_SIZE, _create_all, make_engine
+from src.database.query import (add_meal, add_user, get_daily_totals, get_day_meals, get_day_total, get_user,
+                                has_meals_before, today)
+
+logger = logging.getLogger(__name__)
+
+PROFILE = {'gender': 'm', 'age': 30, 'height': 180.0, 'weight': 80.0, 'activity': 1.55, 'goal': 'Maintaining weight'}
+
+
+async def time_async(fn, runs: int) -> List[float]:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+# Every query a handler makes, against one user with `size` logged meals (and 50 neighbours as busy)
+async def run_size(size: int, runs: int, directory=None) -> dict:
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        engine = make_engine(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}", PRAGMAS, POOL_SIZE)
+        async with engine.begin() as conn:
+            await conn.run_sync(_create_all)
+        session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+        async with session_maker() as session:
+            await add_user(session, USER_ID, 'bench', PROFILE)
+            await seed_calories(session)
+            await fill(session, size)
+            middle = today() - timedelta(days=size // MEALS_PER_DAY // 2)
+            calorie_index.invalidate()
+            queries = {
+                'get_user': lambda: get_user(session, USER_ID),
+                'get_day_meals': lambda: get_day_meals(session, USER_ID),
+                'get_day_total': lambda: get_day_total(session, USER_ID),
+                'get_daily_totals': lambda: get_daily_totals(session, USER_ID),
+                'get_daily_totals.middle': lambda: get_daily_totals(session, USER_ID, before=middle),
+                'has_meals_before': lambda: has_meals_before(session, USER_ID, middle),
+                'calorie_lookup': lambda: calorie_index.lookup(session, 'Chiken wings'),
+                'add_meal': lambda: add_meal(session, USER_ID, 'Pizza', 250.0, 665.0),
+            }
+            results = {name: summarize(await time_async(fn, runs)) for name, fn in queries.items()}
+        await engine.dispose()
+    return results
+
+
+async def collect(sizes: List[int], runs: int, directory=None) -> dict:
+    results = {}
+    for size in sizes:
+        results[f"meals={size}"] = stats = await run_size(size, runs, directory)
+        for name, s in stats.items():
+            logger.info(f"{size:>7} meals, {name}: {fmt(s)}")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Handler query latency at realistic meal-history sizes")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 2000, 20000])
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--dir', help="Where to put the database (fsync cost depends on the disk, tmpfs hides it)")
+    parser.add_argument('--out', help="Write results as JSON")
+    parser.add_argument('--baseline', help="Earlier --out file to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = {'environment': environment(), 'db': asyncio.run(collect(args.sizes, args.runs, args.dir))}
+    if args.out:
+        save(args.out, results)
+    if not check_baseline(results, args.baseline, args.tolerance):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
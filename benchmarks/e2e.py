@@ -0,0 +1,143 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import tempfile
+import time
+from typing import Dict, List
+
+from benchmarks.common import check_baseline, environment, fmt, save, summarize
+
+logger = logging.getLogger(__name__)
+
+PROFILE = {'gender': 'm', 'age': 30, 'height': 180.0, 'weight': 80.0, 'activity': 1.55, 'goal': 'Maintaining weight'}
+
+
+# /add -> photo -> yes -> grams through the real dispatcher, middlewares and handlers,
+# with the Bot API answered in-process (StubSession) and a fresh SQLite database.
+# src.config is imported only here, after the environment points it at the stub.
+async def collect(users: int, flows: int, directory=None) -> dict:
+    tmp = tempfile.TemporaryDirectory(dir=directory)
+    url = f"sqlite+aiosqlite:///{os.path.join(tmp.name, 'bench.db')}"
+    os.environ.setdefault('BOT_TOKEN', '123456:bench')
+    os.environ['BOT_STUB'] = '1'
+    # Handlers get sessions from the engine below; write-behind would go through the app's engine
+    os.environ.setdefault('DB_LITE', url)
+    os.environ['WRITE_BEHIND'] = '0'
+    # One photo per flow and user is well above the production rate limit
+    os.environ.setdefault('ADMISSION_RATE', '0')
+
+    from aiogram import Dispatcher
+    from aiogram.fsm.storage.base import StorageKey
+    from aiogram.types import Update
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+    from benchmarks.meals import seed_calories
+    from src.bot.handlers.main_logic import router
+    from src.bot.handlers.start import start
+    from src.config import bot, classifier
+    from src.database.engine import PRAGMAS, POOL_SIZE, _create_all, make_engine
+    from src.database.query import add_user
+    from src.fsm.storage import SQLiteStorage
+    from src.fsm.user import PhotoStates
+    from src.middleware.middleware import DataBaseSession
+
+    with tmp:
+        engine = make_engine(url, PRAGMAS, POOL_SIZE)
+        async with engine.begin() as conn:
+            await conn.run_sync(_create_all)
+        session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+        async with session_maker() as session:
+            await seed_calories(session)
+            for uid in range(1, users + 1):
+                await add_user(session, uid, f'user{uid}', PROFILE)
+
+        storage = SQLiteStorage(os.path.join(tmp.name, 'fsm.db'))
+        dp = Dispatcher(storage=storage)
+        db_middleware = DataBaseSession(session_pool=session_maker)
+        dp.message.middleware(db_middleware)
+        dp.callback_query.middleware(db_middleware)
+        dp.include_router(start)
+        dp.include_router(router)
+        await classifier.ensure_loaded()
+
+        ids = itertools.count(1)
+        steps: Dict[str, List[float]] = {}
+
+        def message(uid: int, **content) -> Update:
+            n = next(ids)
+            return Update.model_validate({
+                'update_id': n,
+                'message': {'message_id': n, 'date': int(time.time()), 'chat': {'id': uid, 'type': 'private'},
+                            'from': {'id': uid, 'is_bot': False, 'first_name': 'u'}, **content}
+            }, context={'bot': bot})
+
+        async def step(name: str, update: Update) -> None:
+            start_ = time.perf_counter()
+            await dp.feed_update(bot, update)
+            steps.setdefault(name, []).append((time.perf_counter() - start_) * 1000)
+
+        async def state(uid: int):
+            return await storage.get_state(StorageKey(bot_id=bot.id, chat_id=uid, user_id=uid))
+
+        # The stub photo may not be recognized with confidence; answer whatever the bot asks next
+        async def flow(uid: int) -> None:
+            start_ = time.perf_counter()
+            await step('add', message(uid, text='/add'))
+            n = next(ids)
+            await step('photo', message(uid, photo=[{'file_id': f'p{n}', 'file_unique_id': f'u{n}',
+                                                     'width': 1280, 'height': 960}]))
+            if await state(uid) == PhotoStates.confirm_prediction.state:
+                await step('yes', message(uid, text='yes'))
+            else:
+                await step('name', message(uid, text='Pizza'))
+            await step('grams', message(uid, text='250'))
+            if await state(uid) == PhotoStates.ask_calories.state:
+                await step('calories', message(uid, text='250'))
+            steps.setdefault('flow', []).append((time.perf_counter() - start_) * 1000)
+
+        async def user(uid: int) -> None:
+            for _ in range(flows):
+                await flow(uid)
+
+        start_ = time.perf_counter()
+        await asyncio.gather(*(user(uid) for uid in range(1, users + 1)))
+        elapsed = time.perf_counter() - start_
+
+        await storage.close()
+        await bot.session.close()
+        await classifier.close()
+        await engine.dispose()
+
+    results = {name: summarize(samples) for name, samples in steps.items()}
+    results['flows_per_s'] = users * flows / elapsed
+    for name, samples in steps.items():
+        logger.info(f"{name:>8}: {fmt(results[name])} ({len(samples)} samples)")
+    logger.info(f"{results['flows_per_s']:.1f} flows/s with {users} concurrent users")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End-to-end /add flow latency against a stubbed Bot API")
+    parser.add_argument('--users', type=int, default=8, help="Users going through the flow at once")
+    parser.add_argument('--flows', type=int, default=5, help="Flows per user")
+    parser.add_argument('--dir', help="Where to put the databases")
+    parser.add_argument('--out', help="Write results as JSON")
+    parser.add_argument('--baseline', help="Earlier --out file to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = {'environment': environment(), 'e2e': asyncio.run(collect(args.users, args.flows, args.dir))}
+    if args.out:
+        save(args.out, results)
+    if not check_baseline(results, args.baseline, args.tolerance):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
@@ -0,0 +1,127 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import List
+
+import numpy as np
+import torch
+from PIL import Image
+
+from benchmarks.common import check_baseline, environment, fmt, save, summarize
+from src.model.batching import BatchingEngine
+from src.model.model import FoodClassificationService
+from src.model.preprocess import decode_image
+
+logger = logging.getLogger(__name__)
+
+CLASSES_PATH = "src/model/classes.txt"
+
+
+# Phone-sized JPEG of noise unless a real photo is given
+def sample_jpeg(path: str = None) -> bytes:
+    if path:
+        with open(path, 'rb') as f:
+            return f.read()
+    pixels = np.random.default_rng(0).integers(0, 256, (960, 1280, 3), dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def time_sync(fn, runs: int) -> List[float]:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+# Decode and _get_transform (resize + crop + normalize) timed apart, both on the calling thread
+def preprocessing(service: FoodClassificationService, jpeg: bytes, runs: int) -> dict:
+    img = decode_image(BytesIO(jpeg))
+    return {
+        'decode': summarize(time_sync(lambda: decode_image(BytesIO(jpeg)), runs)),
+        'transform': summarize(time_sync(lambda: service.transform(img), runs)),
+    }
+
+
+# `batch` concurrent predict_pil calls per round, so the engine can group them into one forward pass
+async def predict(service: FoodClassificationService, img: Image.Image, batch: int, runs: int) -> dict:
+    samples = []
+
+    async def one():
+        start = time.perf_counter()
+        await service.predict_pil(img)
+        samples.append((time.perf_counter() - start) * 1000)
+
+    await service.predict_pil(img)
+    rounds = max(1, runs // batch)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await asyncio.gather(*(one() for _ in range(batch)))
+    elapsed = time.perf_counter() - start
+    return {**summarize(samples), 'images_per_s': rounds * batch / elapsed}
+
+
+async def collect(model_path: str, threads: List[int], batches: List[int], runs: int, max_wait_ms: float,
+                  variant: str = 'fp32', image: str = None) -> dict:
+    service = FoodClassificationService(model_path, CLASSES_PATH, variant=variant)
+    await service.ensure_loaded()
+    jpeg = sample_jpeg(image)
+    img = decode_image(BytesIO(jpeg))
+    results = {}
+
+    for t in threads:
+        torch.set_num_threads(t)
+        key = f"threads={t}"
+        results[key] = {'preprocess': preprocessing(service, jpeg, runs)}
+        logger.info(f"{key}: transform {fmt(results[key]['preprocess']['transform'])}, "
+                    f"decode {fmt(results[key]['preprocess']['decode'])}")
+        for batch in batches:
+            # The forward pass runs in the engine's thread, which gets the same thread budget
+            executor = ThreadPoolExecutor(1, initializer=torch.set_num_threads, initargs=(t,))
+            await service.engine.close()
+            service.engine = BatchingEngine(service._forward, batch, max_wait_ms, executor=executor)
+            stats = await predict(service, img, batch, runs)
+            results[key][f"predict_pil.batch={batch}"] = stats
+            logger.info(f"{key} batch={batch}: {fmt(stats)}, {stats['images_per_s']:.1f} images/s")
+            executor.shutdown()
+
+    await service.close()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="predict_pil latency/throughput across torch thread counts")
+    parser.add_argument('--model', default=os.getenv("MODEL_PATH", "src/model/vit_food_101.pth"))
+    parser.add_argument('--variant', default='fp32')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--batches', type=int, nargs='+', default=[1, 8], help="Concurrent requests per round")
+    parser.add_argument('--runs', type=int, default=32, help="Images per configuration")
+    parser.add_argument('--max-wait-ms', type=float, default=10)
+    parser.add_argument('--image', help="JPEG to use instead of generated noise")
+    parser.add_argument('--out', help="Write results as JSON")
+    parser.add_argument('--baseline', help="Earlier --out file to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = {'environment': environment(),
+               'inference': asyncio.run(collect(args.model, args.threads, args.batches, args.runs,
+                                                args.max_wait_ms, args.variant, args.image))}
+    if args.out:
+        save(args.out, results)
+    if not check_baseline(results, args.baseline, args.tolerance):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
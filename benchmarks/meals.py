@@ -0,0 +1,100 @@
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import tempfile
+import time
+from datetime import timedelta
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from src.database.aggregates import repair_daily_totals
+from src.database.engine import _create_all
+from src.database.models import Meal
+from src.database.query import get_daily_totals, get_day_meals, get_meals, today, upsert_cals, utcnow
+
+logger = logging.getLogger(__name__)
+
+USER_ID = 1
+MEALS_PER_DAY = 5
+
+
+# Old /profile path: every meal of the user, filtered to today in Python
+async def full_scan_today(session: AsyncSession, user_id: int) -> float:
+    return sum(m.kcal for m in await get_meals(session, user_id) if m.created.date() == today())
+
+
+async def timed(fn, runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+# One calories row per class ("apple_pie" -> "Apple pie") so lookups see the real table size;
+# the values are placeholders
+async def seed_calories(session: AsyncSession, classes_path: str = "src/model/classes.txt") -> None:
+    with open(classes_path, 'r', encoding='utf-8') as f:
+        names = [" ".join(line.strip().split("_")).capitalize() for line in f if line.strip()]
+    await upsert_cals(session, {name: 200.0 for name in names})
+
+
+async def fill(session: AsyncSession, total: int) -> None:
+    now = utcnow().replace(hour=20, minute=0, second=0, microsecond=0)
+    rows = []
+    for i in range(total):
+        created = now - timedelta(days=i // MEALS_PER_DAY, hours=3 * (i % MEALS_PER_DAY))
+        rows.append({'user_id': USER_ID, 'name': 'Pizza', 'grams': 250.0, 'kcal': 665.0,
+                     'created': created, 'updated': created})
+        # Neighbours in the same table, so the index has something to skip
+        rows.append({'user_id': USER_ID + 1 + i % 50, 'name': 'Pizza', 'grams': 250.0, 'kcal': 665.0,
+                     'created': created, 'updated': created})
+    for i in range(0, len(rows), 10000):
+        await session.execute(insert(Meal), rows[i:i + 10000])
+    await session.commit()
+    await repair_daily_totals(session)
+
+
+async def run(sizes, runs: int, legacy_limit: int) -> None:
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}")
+            async with engine.begin() as conn:
+                await conn.run_sync(_create_all)
+            session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+            async with session_maker() as session:
+                await fill(session, size)
+                day_ms = await timed(lambda: get_day_meals(session, USER_ID), runs)
+                history_ms = await timed(lambda: get_daily_totals(session, USER_ID), runs)
+                middle = today() - timedelta(days=size // MEALS_PER_DAY // 2)
+                older_ms = await timed(lambda: get_daily_totals(session, USER_ID, before=middle), runs)
+                line = (f"{size:>7} meals: today {day_ms:.2f} ms, history page {history_ms:.2f} ms, "
+                        f"middle page {older_ms:.2f} ms")
+                if size <= legacy_limit:
+                    legacy_ms = await timed(lambda: full_scan_today(session, USER_ID), max(1, runs // 5))
+                    line += f", old full scan {legacy_ms:.2f} ms"
+                logger.info(line)
+            await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Meal-log query latency as a user's history grows")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--legacy-limit', type=int, default=100000,
+                        help="Skip the old load-everything path above this many meals")
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.runs, args.legacy_limit))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
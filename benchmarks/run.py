@@ -0,0 +1,60 @@
+import argparse
+import asyncio
+import logging
+import os
+
+from benchmarks.common import check_baseline, environment, save
+
+logger = logging.getLogger(__name__)
+
+SUITES = ('inference', 'db', 'e2e')
+
+
+# Suites are imported when they run: e2e has to set up the environment before src.config is imported
+def run_suite(name: str, args) -> dict:
+    if name == 'inference':
+        from benchmarks import inference
+        return asyncio.run(inference.collect(args.model, args.threads, args.batches, args.runs, args.max_wait_ms))
+    if name == 'db':
+        from benchmarks import db
+        return asyncio.run(db.collect(args.sizes, args.db_runs, args.dir))
+    from benchmarks import e2e
+    return asyncio.run(e2e.collect(args.users, args.flows, args.dir))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Inference, DB and end-to-end benchmarks into one JSON report")
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=list(SUITES))
+    parser.add_argument('--out', default="bench_results.json")
+    parser.add_argument('--baseline', help="Earlier --out file; exits with 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed slowdown, 0.2 = 20%%")
+    parser.add_argument('--dir', help="Where to put the databases")
+    inference = parser.add_argument_group('inference')
+    inference.add_argument('--model', default=os.getenv("MODEL_PATH", "src/model/vit_food_101.pth"))
+    inference.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4])
+    inference.add_argument('--batches', type=int, nargs='+', default=[1, 8])
+    inference.add_argument('--runs', type=int, default=32)
+    inference.add_argument('--max-wait-ms', type=float, default=10)
+    db = parser.add_argument_group('db')
+    db.add_argument('--sizes', type=int, nargs='+', default=[100, 2000, 20000])
+    db.add_argument('--db-runs', type=int, default=200)
+    e2e = parser.add_argument_group('e2e')
+    e2e.add_argument('--users', type=int, default=8)
+    e2e.add_argument('--flows', type=int, default=5)
+    args = parser.parse_args()
+
+    results = {'environment': environment()}
+    for name in args.suites:
+        logger.info(f"Running {name} benchmarks")
+        results[name] = run_suite(name, args)
+    save(args.out, results)
+    if not check_baseline(results, args.baseline, args.tolerance):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
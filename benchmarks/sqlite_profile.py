@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from src.database.engine import PRAGMAS, POOL_SIZE, READ_POOL_SIZE, _create_all, make_engine, read_only_url
+from src.database.query import add_meal, get_day_meals, get_day_total
+
+logger = logging.getLogger(__name__)
+
+
+# One simulated user: logs a meal, then opens /profile `reads` times, until the deadline
+async def user_loop(user_id: int, write: async_sessionmaker, read: async_sessionmaker, reads: int,
+                    deadline: float, counts: dict) -> None:
+    while time.perf_counter() < deadline:
+        try:
+            async with write() as session:
+                await add_meal(session, user_id, 'Pizza', random.uniform(50, 400), random.uniform(100, 1000))
+            counts['writes'] += 1
+            for _ in range(reads):
+                async with read() as session:
+                    await get_day_total(session, user_id)
+                    await get_day_meals(session, user_id)
+                counts['reads'] += 1
+        except Exception as e:
+            counts['errors'] += 1
+            logger.debug(f"user {user_id}: {e!r}")
+
+
+async def run_profile(name: str, tuned: bool, users: int, reads: int, seconds: float, directory=None) -> None:
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        url = f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}"
+        if tuned:
+            engine = make_engine(url, PRAGMAS, POOL_SIZE)
+            read_engine = make_engine(read_only_url(url), PRAGMAS, READ_POOL_SIZE, read_only=True)
+        else:
+            engine = read_engine = make_engine(url)
+        async with engine.begin() as conn:
+            await conn.run_sync(_create_all)
+
+        write = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+        read = async_sessionmaker(bind=read_engine, class_=AsyncSession, expire_on_commit=False)
+        counts = {'writes': 0, 'reads': 0, 'errors': 0}
+        start = time.perf_counter()
+        await asyncio.gather(*(user_loop(uid, write, read, reads, start + seconds, counts)
+                               for uid in range(1, users + 1)))
+        elapsed = time.perf_counter() - start
+
+        logger.info(f"{name:>8}: {counts['writes'] / elapsed:8.1f} meal inserts/s, "
+                    f"{counts['reads'] / elapsed:8.1f} profile reads/s, {counts['errors']} errors "
+                    f"({users} users, {elapsed:.1f}s)")
+        if read_engine is not engine:
+            await read_engine.dispose()
+        await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Meal-insert and profile-read throughput, default vs tuned SQLite")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--reads', type=int, default=3, help="Profile reads per logged meal")
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--dir', help="Where to put the database (fsync cost depends on the disk, tmpfs hides it)")
+    args = parser.parse_args()
+
+    async def run():
+        await run_profile('default', False, args.users, args.reads, args.seconds, args.dir)
+        await run_profile('tuned', True, args.users, args.reads, args.seconds, args.dir)
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
@@ -3,12 +3,19 @@ import logging
 
 from aiogram import Dispatcher
 
+from src import metrics
 from src.bot.handlers.main_logic import router
 from src.bot.handlers.start import start
-from src.config import bot
-from src.database.engine import create_db, session_maker
+from src.bot.webhook import WebhookServer
+from src.config import (bot, classifier, fsm_storage, prediction_cache, write_buffer, BOT_MODE,
+                        METRICS_ENABLED, METRICS_HOST, METRICS_PORT, METRICS_LOG_INTERVAL, DROP_PENDING_UPDATES,
+                        WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_WORKERS,
+                        WEBHOOK_QUEUE_SIZE, WEBHOOK_DRAIN_TIMEOUT, WEBHOOK_PHOTO_WORKERS)
+from src.database.aggregates import backfill
+from src.database.engine import create_db, read_session_maker, session_maker
+from src.database.snapshot import apply_snapshot
 from src.get_kcal import get_kcal
-from src.middleware.middleware import DataBaseSession
+from src.middleware.middleware import DataBaseSession, FirstUpdateLogger, HandlerTimer
 
 logging.basicConfig(
     level=logging.INFO,
@@ -18,20 +25,62 @@ logger = logging.getLogger(__name__)
 
 
 async def main():
+    metrics.set_enabled(METRICS_ENABLED)
     # Create .db file if not exist
     await create_db()
-    # Checks for all 101 class is .db if not pars from USDA
+    # Calories come from the bundled snapshot: new dishes, and changed values when its version is newer
+    async with session_maker() as session:
+        await apply_snapshot(session)
+        # Daily totals and targets for data written before they existed
+        await backfill(session)
+    # Anything still missing is looked up in USDA
     await get_kcal()
     logger.info("Starting Food Classifier Bot...")
-    dp = Dispatcher()
+    # Conversation state survives restarts unless FSM_DB is empty
+    dp = Dispatcher(storage=fsm_storage)
+
+    # Model loads in the background, only the first photo waits for it
+    classifier.start_loading()
 
     # Middleware for working async session
-    dp.update.middleware(DataBaseSession(session_pool=session_maker))
+    dp.update.outer_middleware(FirstUpdateLogger())
+    db_middleware = DataBaseSession(session_pool=session_maker, read_session_pool=read_session_maker,
+                                    write_buffer=write_buffer)
+    dp.message.middleware(db_middleware)
+    dp.callback_query.middleware(db_middleware)
     dp.include_router(start)
     dp.include_router(router)
+    if METRICS_ENABLED:
+        for name, r in (('start', start), ('router', router)):
+            r.message.middleware(HandlerTimer(name))
+            r.callback_query.middleware(HandlerTimer(name))
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT) if METRICS_ENABLED and METRICS_PORT else None
+    summary = asyncio.create_task(metrics.log_periodically(METRICS_LOG_INTERVAL)) if METRICS_LOG_INTERVAL else None
+    try:
+        if BOT_MODE == "webhook":
+            server = WebhookServer(dp, bot, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE,
+                                   WEBHOOK_DRAIN_TIMEOUT, WEBHOOK_PHOTO_WORKERS)
+            if WEBHOOK_URL:
+                await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                      drop_pending_updates=DROP_PENDING_UPDATES,
+                                      allowed_updates=dp.resolve_used_update_types())
+            logger.info(f"Webhook starts {metrics.uptime():.1f}s after start, RSS {metrics.rss_mb():.0f} MB")
+            await server.serve(WEBHOOK_HOST, WEBHOOK_PORT)
+            await bot.session.close()
+        else:
+            await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+            logger.info(f"Polling starts {metrics.uptime():.1f}s after start, RSS {metrics.rss_mb():.0f} MB")
+            await dp.start_polling(bot)
+    finally:
+        if summary is not None:
+            summary.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await write_buffer.close()
+        await dp.storage.close()
+        await classifier.close()
+        prediction_cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from src import metrics
+
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        # "rate": this user is over their photo rate, "busy": too many photos queued overall
+        self.reason = reason
+
+
+# Admission in front of photo classification:
+# - per-user token bucket, `rate` photos per second with bursts of `burst`;
+# - at most `max_depth` photos admitted and not finished, beyond that callers are turned away;
+# - at most `max_active` photos in download/decode/inference at once, the rest wait for a slot.
+# Time waiting for a slot and time holding it are separate histograms.
+class AdmissionController:
+    def __init__(self, rate: float = 0.5, burst: int = 3, max_depth: int = 64, max_active: int = 16,
+                 max_users: int = 10000):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_depth = max(1, max_depth)
+        self.max_active = max(1, max_active)
+        self.max_users = max_users
+        self.depth = 0
+        self._buckets: Dict[int, Tuple[float, float]] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+
+        self.rate_limited = metrics.counter('admission_rate_limited')
+        self.busy = metrics.counter('admission_busy')
+        self.admitted = metrics.counter('admission_admitted')
+        self.depth_gauge = metrics.gauge('admission_depth')
+        self.queue_wait = metrics.histogram('admission_queue_wait_seconds', WAIT_BUCKETS)
+        self.service_time = metrics.histogram('admission_service_seconds', WAIT_BUCKETS)
+
+    def _take_token(self, user_id: int) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(user_id, (float(self.burst), now))
+        tokens = min(float(self.burst), tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[user_id] = (tokens, now)
+            return False
+        self._buckets[user_id] = (tokens - 1, now)
+        if len(self._buckets) > self.max_users:
+            self._prune(now)
+        return True
+
+    # Buckets that have refilled completely carry no state worth keeping
+    def _prune(self, now: float) -> None:
+        refill = self.burst / self.rate
+        self._buckets = {uid: (tokens, updated) for uid, (tokens, updated) in self._buckets.items()
+                         if now - updated < refill}
+
+    @asynccontextmanager
+    async def admit(self, user_id: int) -> AsyncIterator[None]:
+        if self.depth >= self.max_depth:
+            self.busy.inc()
+            raise AdmissionRejected("busy")
+        if not self._take_token(user_id):
+            self.rate_limited.inc()
+            raise AdmissionRejected("rate")
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_active)
+
+        self.depth += 1
+        self.depth_gauge.set(self.depth)
+        self.admitted.inc()
+        queued = time.perf_counter()
+        try:
+            async with self._slots:
+                started = time.perf_counter()
+                self.queue_wait.observe(started - queued)
+                try:
+                    yield
+                finally:
+                    self.service_time.observe(time.perf_counter() - started)
+        finally:
+            self.depth -= 1
+            self.depth_gauge.set(self.depth)
@@ -1,18 +1,24 @@
+import asyncio
 import logging
 from datetime import date
 
-from PIL import Image
 from aiogram import Router, F
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.types import Message
+from aiogram.types import CallbackQuery, Message
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from src import metrics
 from src.bot import keyboard as kb
-from src.config import classifier
-from src.database.query import get_user, get_meals, get_cal, add_meal, add_cal
+from src.bot.admission import AdmissionRejected
+from src.config import admission, classifier, prediction_cache, write_buffer
+from src.database.calories import CONFIRM_SCORE, calorie_index
+from src.database.query import (get_user, get_day_meals, get_day_total, get_daily_totals, has_meals_before,
+                                daily_target)
 from src.fsm.user import PhotoStates
+from src.model.cache import dhash
+from src.model.preprocess import decode_image, download_photo, select_photo
 
 logging.basicConfig(
     level=logging.INFO,
@@ -22,9 +28,12 @@ logger = logging.getLogger(__name__)
 
 router = Router()
 
+# Names not in the calorie table, the user is asked for kcal per 100 g
+calorie_misses = metrics.counter('calorie_miss_fallbacks')
+
 
 # To cancel forms if user typo
-@router.message(Command("cancel"), StateFilter("*"))
+@router.message(Command("cancel"), StateFilter("*"), flags={'no_db': True})
 async def cancel_handler(msg: Message, state: FSMContext):
     current_state = await state.get_state()
     if current_state is None:
@@ -35,7 +44,7 @@ async def cancel_handler(msg: Message, state: FSMContext):
     await msg.answer("Action cancelled.")
 
 
-@router.message(F.document)
+@router.message(F.document, flags={'no_db': True})
 async def handle_document(message: Message):
     if message.document.mime_type and message.document.mime_type.startswith('image/'):
         await message.answer(
@@ -47,58 +56,51 @@ async def handle_document(message: Message):
                              parse_mode=ParseMode.HTML)
 
 
-# Uses formula of the Mifflin-St Jeor to calculate kcal per day
+# Daily target (Mifflin-St Jeor) is stored at registration, today's sum is kept in daily_totals
 @router.message(Command('profile'))
-async def cmd_profile(msg: Message, session: AsyncSession):
-    user = await get_user(session, msg.from_user.id)
+async def cmd_profile(msg: Message, read_session: AsyncSession):
+    user = await get_user(read_session, msg.from_user.id)
     if not user:
         await msg.answer("You are not registered. Press /start")
         return
 
-    meals = await get_meals(session, msg.from_user.id)
-    formula = {"Weight loss": 0.85, "Maintaining weight": 1, "Mass gain": 1.15}
-
-    if user.gender in ['male', 'm']:
-        cal = (((10 * user.weight) + (6.25 * user.height) - (5 * user.age) + 5) * user.activity) * formula[user.goal]
-    else:
-        cal = (((10 * user.weight) + (6.25 * user.height) - (5 * user.age) - 161) * user.activity) * formula[user.goal]
+    cal = user.daily_target
+    if cal is None:
+        cal = daily_target(user.gender, user.age, user.height, user.weight, user.activity, user.goal)
 
     text = f"Profile @{user.user_name}\nGoal: {user.goal}\nDaily calorie intake: {round(cal)}\n\n"
 
-    if not meals:
-        text += "There are no food entries yet. Press /add"
+    total = await get_day_total(read_session, msg.from_user.id)
+    if not total:
+        text += "There are no food entries today yet. Press /add"
     else:
-        cal_meal = 0.0
         text += "Today meals:\n"
-        for m in meals:
-            if m.created.date() == date.today():
-                text += f"- {m.name}: {m.grams} г — {m.kcal:.1f} kcal\n"
-                cal_meal += m.kcal
-        text += f"\n\nThe remainder of the daily calorie intake {round(cal - cal_meal)}"
+        for m in await get_day_meals(read_session, msg.from_user.id):
+            text += f"- {m.name}: {m.grams} г — {m.kcal:.1f} kcal\n"
+        text += f"\n\nThe remainder of the daily calorie intake {round(cal - total.kcal)}"
 
     await msg.answer(text, reply_markup=kb.history)
 
 
-# Shows history of kcal day by day
-@router.callback_query(F.data == "history_by_days")
-async def show_history(callback, session: AsyncSession):
-    meals = await get_meals(session, callback.from_user.id)
+# Shows history of kcal day by day, two weeks per page
+@router.callback_query(F.data.startswith("history_by_days"))
+async def show_history(callback, read_session: AsyncSession):
+    _, _, before = callback.data.partition(":")
+    before = date.fromisoformat(before) if before else None
+    stats = await get_daily_totals(read_session, callback.from_user.id, before=before)
 
-    if not meals:
+    if not stats:
         await callback.message.edit_text("There are no food entries yet. Press /add.")
         return
 
-    stats = {}
-    for m in meals:
-        day = m.created.date()
-        stats.setdefault(day, 0)
-        stats[day] += m.kcal
-
     text = "<b>History by days:</b>\n\n"
-    for day, total in sorted(stats.items(), reverse=True):
+    for day, total in stats:
         text += f"<b>{day}</b>: {total:.1f} kcal\n"
 
-    await callback.message.edit_text(text, parse_mode=ParseMode.HTML)
+    oldest = stats[-1][0]
+    older = await has_meals_before(read_session, callback.from_user.id, oldest)
+    await callback.message.edit_text(text, parse_mode=ParseMode.HTML,
+                                     reply_markup=kb.history_older(oldest) if older else None)
 
 
 @router.message(Command('add'))
@@ -112,17 +114,47 @@ async def cmd_add(msg: Message, session: AsyncSession, state: FSMContext):
     await state.set_state(PhotoStates.waiting_photo)
 
 
+BUSY_REPLIES = {
+    "rate": "You are sending photos too fast. Please wait a few seconds and send it again.",
+    "busy": "I'm busy with other photos right now. Please try again in a minute.",
+}
+
+
+async def classify_photo(msg: Message, photo) -> list:
+    loop = asyncio.get_running_loop()
+    with metrics.timer('photo_download_seconds'):
+        file = await download_photo(msg.bot, photo)
+    with metrics.timer('photo_decode_seconds'):
+        img = await loop.run_in_executor(None, decode_image, file)
+
+    img_hash, result = None, None
+    if prediction_cache.phash:
+        img_hash = await loop.run_in_executor(None, dhash, img)
+        result = prediction_cache.get_similar(img_hash)
+    if result is None:
+        result = await classifier.predict_pil(img)
+    if result:
+        prediction_cache.put(photo.file_unique_id, result, img_hash)
+    return result
+
+
 @router.message(PhotoStates.waiting_photo)
 async def validate_photo(msg: Message, state: FSMContext):
     if not msg.photo:
         await msg.answer("Send a photo of the dish.")
         return
 
-    photo = msg.photo[-1]
-    file = await msg.bot.download(photo)
-    img = Image.open(file)
-
-    result = await classifier.predict_pil(img)
+    # Smallest rendition that is still big enough for the model, not the full-size photo
+    photo = select_photo(msg.photo)
+    # Same file (forwarded or re-sent) is answered from cache without downloading it again
+    result = prediction_cache.get(photo.file_unique_id)
+    if result is None:
+        try:
+            async with admission.admit(msg.from_user.id):
+                result = await classify_photo(msg, photo)
+        except AdmissionRejected as e:
+            await msg.answer(BUSY_REPLIES[e.reason])
+            return
 
     if not result:
         await msg.answer("The dish was not recognized. Please enter the dish name manually:")
@@ -178,24 +210,60 @@ async def validate_grams(msg: Message, session: AsyncSession, state: FSMContext)
         data = await state.get_data()
         name = data.get('pred_name')
 
-        cal = await get_cal(session, name)
+        # In-memory lookup, tolerant to case, spacing and typos in manually entered names
+        cal = await calorie_index.lookup(session, name)
         if not cal:
+            calorie_misses.inc()
             await msg.answer(f"I didn't find <b>{name}</b> in the calorie database. "
                              f"Please enter the calorie content per 100g (kcal):",
                              parse_mode=ParseMode.HTML)
             await state.set_state(PhotoStates.ask_calories)
             await state.update_data(grams=grams)
             return
-        kcal_per100 = cal.kcal_per_100
-        total = kcal_per100 * grams / 100.0
+        # A loose match may be a different dish ("chicken" -> "Chicken wings"): ask before logging it
+        if cal.score < CONFIRM_SCORE:
+            await state.update_data(grams=grams, match_name=cal.name, match_kcal=cal.kcal_per_100)
+            await msg.answer(f"I didn't find <b>{name}</b>. Did you mean <b>{cal.name}</b> "
+                             f"({cal.kcal_per_100:.0f} kcal per 100g)?",
+                             parse_mode=ParseMode.HTML, reply_markup=kb.match_confirm)
+            await state.set_state(PhotoStates.confirm_match)
+            return
+        total = cal.kcal_per_100 * grams / 100.0
 
-        await add_meal(session, msg.from_user.id, name, grams, total)
-        await msg.answer(f"Added: {name}, {grams} g — {total:.1f} kcal.")
+        await write_buffer.add_meal(session, msg.from_user.id, cal.name, grams, total)
+        text = f"Added: {cal.name}, {grams} g — {total:.1f} kcal."
+        if cal.score < 1.0:
+            text += f"\n(closest match for \"{name}\", similarity {cal.score:.0%})"
+        await msg.answer(text)
         await state.clear()
     except ValueError:
         await msg.answer("Please enter the number of grams (e.g. 250).")
 
 
+@router.callback_query(PhotoStates.confirm_match, F.data == "match_yes")
+async def accept_match(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
+    data = await state.get_data()
+    name, grams = data['match_name'], data['grams']
+    total = data['match_kcal'] * grams / 100.0
+    await write_buffer.add_meal(session, callback.from_user.id, name, grams, total)
+    await callback.message.edit_text(f"Added: {name}, {grams} g — {total:.1f} kcal.")
+    await state.clear()
+
+
+# Not that dish: the user's own name is kept and its calories are asked for
+@router.callback_query(PhotoStates.confirm_match, F.data == "match_no", flags={'no_db': True})
+async def reject_match(callback: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    await callback.message.edit_text(f"Please enter the calorie content of <b>{data['pred_name']}</b> "
+                                     f"per 100g (kcal):", parse_mode=ParseMode.HTML)
+    await state.set_state(PhotoStates.ask_calories)
+
+
+@router.message(PhotoStates.confirm_match, flags={'no_db': True})
+async def confirm_match_text(msg: Message):
+    await msg.answer("Please press Yes or No above.")
+
+
 @router.message(PhotoStates.ask_calories)
 async def validate_cal(msg: Message, session: AsyncSession, state: FSMContext):
     try:
@@ -204,9 +272,9 @@ async def validate_cal(msg: Message, session: AsyncSession, state: FSMContext):
         name = data.get('pred_name')
         grams = data.get('grams')
 
-        await add_cal(session, name, kcal100)
+        await write_buffer.add_cal(session, name, kcal100, msg.from_user.id)
         total = kcal100 * grams / 100.0
-        await add_meal(session, msg.from_user.id, name, grams, total)
+        await write_buffer.add_meal(session, msg.from_user.id, name, grams, total)
 
         await msg.answer(f"Saved and added: <b>{name}</b>, {grams} g — {total:.1f} kcal.",
                          parse_mode=ParseMode.HTML)
@@ -215,7 +283,7 @@ async def validate_cal(msg: Message, session: AsyncSession, state: FSMContext):
         await msg.answer("Please enter the number (kcal per 100g).")
 
 
-@router.message()
+@router.message(flags={'no_db': True})
 async def handle_other_messages(message: Message):
     await message.answer(
         "<b>Food Classifier Bot</b>\n\n"
@@ -8,8 +8,8 @@ from aiogram.types import Message, CallbackQuery
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.bot import keyboard as kb
-from src.config import bot
-from src.database.query import get_user, add_user
+from src.config import bot, write_buffer
+from src.database.query import get_user
 from src.fsm.user import RegStates
 
 logging.basicConfig(
@@ -111,7 +111,7 @@ async def validate_goal(callback: CallbackQuery, session: AsyncSession, state: F
     await state.update_data(goal=goal)
     data = await state.get_data()
     try:
-        await add_user(session, callback.from_user.id, callback.from_user.username, data)
+        await write_buffer.add_user(session, callback.from_user.id, callback.from_user.username, data)
         await bot.edit_message_text(text="Registration is complete.\n"
                                          "Use /add to add food or /profile to view your profile.",
                                     chat_id=callback.message.chat.id,
@@ -124,7 +124,7 @@ async def validate_goal(callback: CallbackQuery, session: AsyncSession, state: F
     await state.clear()
 
 
-@start.message(Command('help'))
+@start.message(Command('help'), flags={'no_db': True})
 async def cmd_help(msg: Message):
     help_text = """
 <b>What the bot can do:</b>
@@ -149,7 +149,7 @@ If something is wrong please contact @olikooon.
     await msg.answer(help_text, parse_mode=ParseMode.HTML)
 
 
-@start.message(Command('info'))
+@start.message(Command('info'), flags={'no_db': True})
 async def cmd_info(msg: Message):
     info_text = """
 <b>About the Model</b>
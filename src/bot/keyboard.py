@@ -61,4 +61,24 @@ history = InlineKeyboardMarkup(
     inline_keyboard=[
         [InlineKeyboardButton(text="History by day", callback_data="history_by_days")]
     ]
-)
\ No newline at end of file
+)
+
+
+# Keyboard under a page of history, loads the days before `before`
+def history_older(before) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="Older", callback_data=f"history_by_days:{before.isoformat()}")]
+        ]
+    )
+
+
+# Keyboard under "Did you mean ...?" for a fuzzy calorie match
+match_confirm = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="Yes", callback_data="match_yes"),
+            InlineKeyboardButton(text="No", callback_data="match_no"),
+        ]
+    ]
+)
@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, List
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+# Update JSON objects from a .json file (one object or a list) or .jsonl (one per line)
+def load_updates(path: str) -> List[dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    if path.endswith('.jsonl'):
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    data = json.loads(text)
+    return data if isinstance(data, list) else [data]
+
+
+# Posts recorded updates to a running webhook server (e.g. BOT_MODE=webhook BOT_STUB=1 python main.py),
+# returns how many responses had each HTTP status
+async def replay(url: str, updates: List[dict], repeat: int = 1, concurrency: int = 20,
+                 secret: str = None) -> Dict[int, int]:
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    next_id = 1
+
+    async with aiohttp.ClientSession(headers=headers) as http:
+        async def post(update: dict):
+            async with semaphore:
+                async with http.post(url, json=update) as r:
+                    statuses[r.status] = statuses.get(r.status, 0) + 1
+
+        tasks = []
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for update in updates:
+                tasks.append(post({**update, 'update_id': next_id}))
+                next_id += 1
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    logger.info(f"Posted {len(tasks)} updates in {elapsed:.2f}s ({len(tasks) / elapsed:.0f}/s), statuses {statuses}")
+    return statuses
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates against the webhook server")
+    parser.add_argument('updates', help=".json or .jsonl file with Update objects")
+    parser.add_argument('--url', default="http://127.0.0.1:8080/webhook")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--secret')
+    args = parser.parse_args()
+    asyncio.run(replay(args.url, load_updates(args.updates), args.repeat, args.concurrency, args.secret))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
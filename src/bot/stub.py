@@ -0,0 +1,68 @@
+import asyncio
+import itertools
+import logging
+from collections import deque
+from datetime import datetime
+from io import BytesIO
+from typing import Any, AsyncGenerator, Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, GetFile, GetMe, SendMessage, TelegramMethod
+from aiogram.types import Chat, File, Message, User
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+def _sample_jpeg() -> bytes:
+    buffer = BytesIO()
+    Image.new('RGB', (1280, 960), (180, 120, 60)).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+# Bot API session that never leaves the process: replies are recorded and answered with
+# plausible objects, file downloads return `photo` (a JPEG) or a generated image.
+# For local runs (BOT_STUB=1), webhook replays and end-to-end benchmarks.
+class StubSession(BaseSession):
+    def __init__(self, photo: Optional[str] = None, latency_ms: float = 0.0, keep: int = 1000, **kwargs):
+        super().__init__(**kwargs)
+        self.latency_ms = latency_ms
+        self.requests: deque = deque(maxlen=keep)
+        self.calls: Dict[str, int] = {}
+        self._ids = itertools.count(1)
+        if photo:
+            with open(photo, 'rb') as f:
+                self.photo = f.read()
+        else:
+            self.photo = _sample_jpeg()
+
+    def _message(self, chat_id: Any, text: Optional[str]) -> Message:
+        chat_id = chat_id if isinstance(chat_id, int) else 0
+        return Message(message_id=next(self._ids), date=datetime.now(), chat=Chat(id=chat_id, type='private'),
+                       text=text)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.requests.append(method)
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return self._message(method.chat_id, method.text)
+        if isinstance(method, GetFile):
+            return File(file_id=method.file_id, file_unique_id=method.file_id, file_size=len(self.photo),
+                        file_path=f"photos/{method.file_id}.jpg")
+        if isinstance(method, GetMe):
+            return User(id=bot.id, is_bot=True, first_name="Stub", username="stub_bot")
+        # setWebhook, deleteWebhook, answerCallbackQuery and the like return True
+        return True
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        for i in range(0, len(self.photo), chunk_size):
+            yield self.photo[i:i + chunk_size]
+
+    async def close(self) -> None:
+        logger.info(f"Stub Bot API calls: {self.calls}")
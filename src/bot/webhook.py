@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import signal
+import time
+from typing import Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+HANDLER_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LANES = ('text', 'photo')
+
+
+# Webhook mode: updates are acknowledged right away (200) and queued; a fixed number of
+# workers feeds them to the dispatcher, which caps the number of handlers in flight.
+# Updates carrying a photo or a file go to a separate lane with its own workers, so text
+# steps never wait behind image work. When a lane's queue is full the server answers 503
+# and Telegram redelivers the update later. On shutdown new updates get 503 and the
+# workers finish what is already queued.
+class WebhookServer:
+    def __init__(self, dp: Dispatcher, bot: Bot, path: str = "/webhook", secret_token: Optional[str] = None,
+                 workers: int = 8, queue_size: int = 1000, drain_timeout: float = 60.0, photo_workers: int = 4):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.lane_workers = {'text': max(1, workers), 'photo': max(1, photo_workers)}
+        self.queue_size = max(1, queue_size)
+        self.drain_timeout = drain_timeout
+
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self._tasks: List[asyncio.Task] = []
+        self.accepting = False
+        self._in_flight = 0
+
+        self.received = metrics.counter('webhook_updates_received')
+        self.rejected = metrics.counter('webhook_updates_rejected')
+        self.failed = metrics.counter('webhook_updates_failed')
+        self.in_flight = metrics.gauge('webhook_in_flight')
+        self.handler_seconds = metrics.histogram('webhook_handler_seconds', HANDLER_BUCKETS)
+        self.depth = {lane: metrics.gauge(f'webhook_{lane}_queue_depth') for lane in LANES}
+        self.queue_wait = {lane: metrics.histogram(f'webhook_{lane}_queue_wait_seconds', HANDLER_BUCKETS)
+                           for lane in LANES}
+
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle)
+        self.app.router.add_get('/healthz', self.health)
+
+    @staticmethod
+    def lane(update: Update) -> str:
+        message = update.message
+        if message is not None and (message.photo or message.document):
+            return 'photo'
+        return 'text'
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            return web.Response(status=401)
+        if not self.accepting:
+            self.rejected.inc()
+            return web.Response(status=503)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError as e:
+            logger.warning(f"Bad update payload: {e}")
+            return web.Response(status=400)
+        lane = self.lane(update)
+        queue = self.queues[lane]
+        try:
+            queue.put_nowait((time.perf_counter(), update))
+        except asyncio.QueueFull:
+            self.rejected.inc()
+            return web.Response(status=503)
+        self.received.inc()
+        self.depth[lane].set(queue.qsize())
+        return web.Response()
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({'accepting': self.accepting, 'in_flight': self._in_flight,
+                                  'queued': {lane: queue.qsize() for lane, queue in self.queues.items()}})
+
+    async def _worker(self, lane: str) -> None:
+        queue = self.queues[lane]
+        while True:
+            queued, update = await queue.get()
+            self.depth[lane].set(queue.qsize())
+            self._in_flight += 1
+            self.in_flight.set(self._in_flight)
+            start = time.perf_counter()
+            self.queue_wait[lane].observe(start - queued)
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                self.failed.inc()
+                logger.error(f"Update {update.update_id} failed: {e!r}")
+            finally:
+                self.handler_seconds.observe(time.perf_counter() - start)
+                self._in_flight -= 1
+                self.in_flight.set(self._in_flight)
+                queue.task_done()
+
+    def start(self) -> None:
+        self.queues = {lane: asyncio.Queue(self.queue_size) for lane in LANES}
+        self._tasks = [asyncio.create_task(self._worker(lane))
+                       for lane, count in self.lane_workers.items() for _ in range(count)]
+        self.accepting = True
+
+    async def drain(self) -> None:
+        self.accepting = False
+        pending = sum(queue.qsize() for queue in self.queues.values())
+        if pending:
+            logger.info(f"Draining {pending} queued updates")
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues.values())),
+                                   self.drain_timeout)
+        except asyncio.TimeoutError:
+            left = sum(queue.qsize() for queue in self.queues.values())
+            logger.warning(f"Drain timed out, {left} updates dropped")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # Serves until SIGINT/SIGTERM (or cancellation), then drains
+    async def serve(self, host: str, port: int) -> None:
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        self.start()
+        logger.info(f"Webhook server on http://{host}:{port}{self.path} with {self.lane_workers['text']} text "
+                    f"and {self.lane_workers['photo']} photo workers")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        try:
+            await stop.wait()
+        finally:
+            await self.drain()
+            await runner.cleanup()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    loop.remove_signal_handler(sig)
+                except (NotImplementedError, RuntimeError):
+                    pass
@@ -3,12 +3,99 @@ import os
 from aiogram import Bot
 from dotenv import load_dotenv
 
+from src.bot.admission import AdmissionController
+from src.bot.stub import StubSession
+from src.database.engine import session_maker
+from src.database.write_behind import WriteBehindBuffer
+from src.fsm.storage import SQLiteStorage
+from src.model.cache import PredictionCache
 from src.model.model import FoodClassificationService
 
 load_dotenv()
-USDA_API_KEY = os.getenv("USDA_API_KEY")
+# USDA_* settings of the calorie bootstrap live in src.get_kcal, which runs without the bot
 
-MODEL_PATH = "src/model/vit_food_101.pth"
+# Micro-batching of photo classification: max images per forward pass and max wait to fill a batch
+INFERENCE_BATCH_SIZE = int(os.getenv("INFERENCE_BATCH_SIZE", 8))
+INFERENCE_MAX_WAIT_MS = float(os.getenv("INFERENCE_MAX_WAIT_MS", 10))
+# Number of inference worker processes (0 = in-process) and torch threads per worker (0 = split cores evenly)
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 0))
+INFERENCE_THREADS_PER_WORKER = int(os.getenv("INFERENCE_THREADS_PER_WORKER", 0))
+# Model variant: fp32, int8, torchscript, export or bf16. If a check folder is set,
+# the variant is refused unless its top-1/top-3 agreement with fp32 reaches the threshold
+MODEL_VARIANT = os.getenv("MODEL_VARIANT", "fp32")
+VARIANT_CHECK_DIR = os.getenv("VARIANT_CHECK_DIR") or None
+VARIANT_MIN_AGREEMENT = float(os.getenv("VARIANT_MIN_AGREEMENT", 0.98))
+
+# Optional cheap student model: it answers when its top-1 probability is >= CASCADE_THRESHOLD,
+# otherwise the image goes to the ViT. Tune the threshold with python -m src.model.calibrate
+STUDENT_MODEL_PATH = os.getenv("STUDENT_MODEL_PATH") or None
+STUDENT_ARCH = os.getenv("STUDENT_ARCH") or None
+CASCADE_THRESHOLD = float(os.getenv("CASCADE_THRESHOLD", 0.9))
+
+# Cache of predictions by Telegram file_unique_id, optionally also by perceptual hash, optionally persisted
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", 10000))
+PREDICTION_CACHE_TTL = float(os.getenv("PREDICTION_CACHE_TTL", 7 * 24 * 3600))
+PREDICTION_CACHE_PHASH = os.getenv("PREDICTION_CACHE_PHASH", "0") == "1"
+PREDICTION_CACHE_DB = os.getenv("PREDICTION_CACHE_DB") or None
+
+# Write-behind for user/meal/calorie inserts: batched every WRITE_BEHIND_ROWS rows or WRITE_BEHIND_MS ms.
+# Rows not yet flushed are lost if the process is killed, so it is off by default
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_ROWS = int(os.getenv("WRITE_BEHIND_ROWS", 200))
+WRITE_BEHIND_MS = float(os.getenv("WRITE_BEHIND_MS", 200))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", 5000))
+
+# Photo admission: per-user rate (photos/s) and burst, photos admitted overall before
+# answering "busy", photos in download/inference at once
+ADMISSION_RATE = float(os.getenv("ADMISSION_RATE", 0.5))
+ADMISSION_BURST = int(os.getenv("ADMISSION_BURST", 3))
+ADMISSION_MAX_DEPTH = int(os.getenv("ADMISSION_MAX_DEPTH", 64))
+ADMISSION_MAX_ACTIVE = int(os.getenv("ADMISSION_MAX_ACTIVE", 16))
+
+# polling or webhook. Pending updates survive a restart unless DROP_PENDING_UPDATES=1
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0") == "1"
+# Webhook: public URL registered with Telegram (unset = don't register, e.g. local replays),
+# listen address, secret header, handlers in flight, queued updates before answering 503
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or None
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+# Photos get their own workers, so text steps (grams, yes/no) never queue behind image work
+WEBHOOK_PHOTO_WORKERS = int(os.getenv("WEBHOOK_PHOTO_WORKERS", 4))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", 60))
+# Local testing without Telegram: Bot API calls are answered in-process, downloads return BOT_STUB_PHOTO
+BOT_STUB = os.getenv("BOT_STUB", "0") == "1"
+BOT_STUB_PHOTO = os.getenv("BOT_STUB_PHOTO") or None
+
+# Conversation state (FSM) file, empty = in memory (lost on restart). Conversations idle for
+# FSM_TTL seconds are dropped, FSM_CACHE_SIZE hot keys stay in memory (0 when several processes share the file)
+FSM_DB = os.getenv("FSM_DB", "fsm.db")
+FSM_TTL = float(os.getenv("FSM_TTL", 24 * 3600))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 10000))
+FSM_SWEEP_INTERVAL = float(os.getenv("FSM_SWEEP_INTERVAL", 300))
+
+# Stage timers and process gauges (METRICS_ENABLED=0 turns them off). /metrics (Prometheus text) is served only
+# on METRICS_HOST:METRICS_PORT when METRICS_PORT is set, never on the public webhook port;
+# METRICS_LOG_INTERVAL > 0 logs a summary
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", 0))
+
+MODEL_PATH = os.getenv("MODEL_PATH", "src/model/vit_food_101.pth")
 CLASSES_PATH = "src/model/classes.txt"
-classifier = FoodClassificationService(MODEL_PATH, CLASSES_PATH)
-bot = Bot(token=os.getenv("BOT_TOKEN"))
+classifier = FoodClassificationService(MODEL_PATH, CLASSES_PATH, INFERENCE_BATCH_SIZE, INFERENCE_MAX_WAIT_MS,
+                                       INFERENCE_WORKERS, INFERENCE_THREADS_PER_WORKER,
+                                       MODEL_VARIANT, VARIANT_CHECK_DIR, VARIANT_MIN_AGREEMENT,
+                                       STUDENT_MODEL_PATH, STUDENT_ARCH, CASCADE_THRESHOLD)
+prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL, PREDICTION_CACHE_PHASH,
+                                   db_path=PREDICTION_CACHE_DB)
+bot = Bot(token=os.getenv("BOT_TOKEN"), session=StubSession(BOT_STUB_PHOTO) if BOT_STUB else None)
+write_buffer = WriteBehindBuffer(session_maker, WRITE_BEHIND, WRITE_BEHIND_ROWS, WRITE_BEHIND_MS,
+                                 WRITE_BEHIND_MAX_PENDING)
+admission = AdmissionController(ADMISSION_RATE, ADMISSION_BURST, ADMISSION_MAX_DEPTH, ADMISSION_MAX_ACTIVE)
+fsm_storage = SQLiteStorage(FSM_DB, FSM_TTL, FSM_CACHE_SIZE, FSM_SWEEP_INTERVAL) if FSM_DB else None
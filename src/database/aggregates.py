@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import logging
+from datetime import date
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import delete, func, select, tuple_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.models import DailyTotal, Meal, User
+from src.database.query import daily_target
+
+logger = logging.getLogger(__name__)
+
+CHUNK = 200
+
+
+# Fills daily_target of users registered before it was stored
+async def backfill_targets(session: AsyncSession) -> int:
+    result = await session.execute(select(User).where(User.daily_target.is_(None)))
+    users = result.scalars().all()
+    for user in users:
+        try:
+            user.daily_target = daily_target(user.gender, user.age, user.height, user.weight,
+                                             user.activity, user.goal)
+        except (KeyError, TypeError):
+            logger.warning(f"Incomplete profile of user {user.tg_id}, no daily target")
+    await session.commit()
+    return len(users)
+
+
+# Recomputes daily_totals from meals (all users, or one) and writes only the days that drifted
+async def repair_daily_totals(session: AsyncSession, user_id: Optional[int] = None) -> int:
+    day = func.date(Meal.created)
+    expected_query = select(Meal.user_id, day, func.sum(Meal.kcal), func.count()).group_by(Meal.user_id, day)
+    current_query = select(DailyTotal.user_id, DailyTotal.day, DailyTotal.kcal, DailyTotal.meal_count)
+    if user_id is not None:
+        expected_query = expected_query.where(Meal.user_id == user_id)
+        current_query = current_query.where(DailyTotal.user_id == user_id)
+
+    expected: Dict[Tuple[int, date], Tuple[float, int]] = {
+        (uid, date.fromisoformat(d)): (kcal, count) for uid, d, kcal, count in await session.execute(expected_query)
+    }
+    current = {(uid, d): (kcal, count) for uid, d, kcal, count in await session.execute(current_query)}
+
+    def drifted(key) -> bool:
+        if key not in current:
+            return True
+        (kcal, count), (old_kcal, old_count) = expected[key], current[key]
+        return count != old_count or abs(kcal - old_kcal) > 1e-6
+
+    changed = [key for key in expected if drifted(key)]
+    stale = [key for key in current if key not in expected]
+
+    # Chunked to stay under SQLite's limit on bound parameters per statement
+    for i in range(0, len(changed), CHUNK):
+        query = insert(DailyTotal).values([
+            {'user_id': uid, 'day': d, 'kcal': expected[uid, d][0], 'meal_count': expected[uid, d][1]}
+            for uid, d in changed[i:i + CHUNK]
+        ])
+        query = query.on_conflict_do_update(
+            index_elements=[DailyTotal.user_id, DailyTotal.day],
+            set_={'kcal': query.excluded.kcal, 'meal_count': query.excluded.meal_count, 'updated': func.now()}
+        )
+        await session.execute(query)
+    for i in range(0, len(stale), CHUNK):
+        await session.execute(delete(DailyTotal).where(tuple_(DailyTotal.user_id, DailyTotal.day)
+                                                       .in_(stale[i:i + CHUNK])))
+    await session.commit()
+
+    if changed or stale:
+        logger.info(f"Daily totals repaired: {len(changed)} days rewritten, {len(stale)} removed")
+    return len(changed) + len(stale)
+
+
+# Run at startup: fills the tables after an upgrade, a no-op afterwards
+async def backfill(session: AsyncSession) -> None:
+    await backfill_targets(session)
+    has_totals = (await session.execute(select(DailyTotal.id).limit(1))).first() is not None
+    has_meals = (await session.execute(select(Meal.id).limit(1))).first() is not None
+    if has_meals and not has_totals:
+        await repair_daily_totals(session)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rebuild daily_totals and users' daily targets from raw data")
+    parser.add_argument('--user', type=int, help="Only this user id (meals.user_id)")
+    args = parser.parse_args()
+
+    async def run():
+        from src.database.engine import create_db, session_maker
+        await create_db()
+        async with session_maker() as session:
+            targets = await backfill_targets(session)
+            fixed = await repair_daily_totals(session, args.user)
+        logger.info(f"{targets} daily targets filled, {fixed} daily totals fixed")
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import re
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src import metrics
+from src.database.models import Calories
+
+logger = logging.getLogger(__name__)
+
+# pg_trgm's default is 0.3; a bit stricter so unrelated dishes are not offered at all
+MIN_SCORE = 0.45
+# Fuzzy matches below this are only suggestions: "chicken" scores ~0.6 against "Chicken wings",
+# so the user confirms with a yes/no keyboard before the meal is logged under the other name.
+CONFIRM_SCORE = 0.8
+
+_NON_WORD = re.compile(r"[^\w]+")
+
+
+class CalorieMatch(NamedTuple):
+    name: str
+    kcal_per_100: float
+    score: float
+
+
+# "  Spaghetti-Carbonara " -> "spaghetti carbonara"
+def normalize(name: str) -> str:
+    return " ".join(_NON_WORD.sub(" ", name.lower().replace("_", " ")).split())
+
+
+# Trigrams of every word padded like pg_trgm: "pizza" -> "  p", " pi", "piz", "izz", "zza", "za "
+def trigrams(normalized: str) -> Set[str]:
+    grams = set()
+    for word in normalized.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+# Process-wide read-through copy of the calories table. Loaded with one query on first use,
+# dropped by invalidate() whenever rows are written. A load that overlaps an invalidate() is used
+# but not marked loaded (the generation moved on), so the next lookup reads the new rows.
+# Names are matched exactly after normalization, otherwise by trigram similarity
+# (|A & B| / |A | B|) through an inverted index.
+class CalorieIndex:
+    def __init__(self, min_score: float = MIN_SCORE):
+        self.min_score = min_score
+        self._loaded = False
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        self._names: List[str] = []
+        self._kcal: List[float] = []
+        self._grams: List[Set[str]] = []
+        self._exact: Dict[str, int] = {}
+        self._postings: Dict[str, List[int]] = {}
+
+        self.exact_hits = metrics.counter('calorie_index_exact_hits')
+        self.fuzzy_hits = metrics.counter('calorie_index_fuzzy_hits')
+        self.misses = metrics.counter('calorie_index_misses')
+        self.loads = metrics.counter('calorie_index_loads')
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self._loaded = False
+
+    async def _ensure_loaded(self, session: AsyncSession) -> None:
+        if self._loaded:
+            return
+        async with self._lock:
+            if self._loaded:
+                return
+            generation = self._generation
+            result = await session.execute(select(Calories.name, Calories.kcal_per_100))
+            self._build(result.all())
+            self._loaded = generation == self._generation
+            self.loads.inc()
+
+    def _build(self, rows) -> None:
+        names, kcal, grams, exact, postings = [], [], [], {}, {}
+        for name, kcal_per_100 in rows:
+            if kcal_per_100 is None:
+                continue
+            i = len(names)
+            key = normalize(name)
+            names.append(name)
+            kcal.append(kcal_per_100)
+            grams.append(trigrams(key))
+            exact.setdefault(key, i)
+            for gram in grams[i]:
+                postings.setdefault(gram, []).append(i)
+
+        self._names, self._kcal, self._grams = names, kcal, grams
+        self._exact, self._postings = exact, postings
+        logger.info(f"Calorie index loaded with {len(names)} dishes")
+
+    def match(self, name: str, min_score: Optional[float] = None) -> Optional[CalorieMatch]:
+        key = normalize(name)
+        i = self._exact.get(key)
+        if i is not None:
+            self.exact_hits.inc()
+            return CalorieMatch(self._names[i], self._kcal[i], 1.0)
+
+        query = trigrams(key)
+        shared: Dict[int, int] = {}
+        for gram in query:
+            for i in self._postings.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+
+        best, best_score = None, 0.0
+        for i, common in shared.items():
+            score = common / (len(query) + len(self._grams[i]) - common)
+            if score > best_score:
+                best, best_score = i, score
+
+        if best is None or best_score < (self.min_score if min_score is None else min_score):
+            self.misses.inc()
+            return None
+        self.fuzzy_hits.inc()
+        return CalorieMatch(self._names[best], self._kcal[best], best_score)
+
+    async def lookup(self, session: AsyncSession, name: str,
+                     min_score: Optional[float] = None) -> Optional[CalorieMatch]:
+        await self._ensure_loaded(session)
+        return self.match(name, min_score)
+
+
+calorie_index = CalorieIndex()
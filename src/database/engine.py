@@ -1,9 +1,14 @@
 import logging
 from os import getenv
 
+from typing import Optional
+
 from dotenv import load_dotenv
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 
+from src import metrics
 from src.database.models.base import Base
 
 load_dotenv()
@@ -14,16 +19,90 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Applied to every new connection. WAL lets readers run next to the writer, NORMAL syncs
+# only at checkpoints (a crash may lose the last commits, never corrupts the file)
+PRAGMAS = {
+    'journal_mode': getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    # Negative is KiB: 64 MB of page cache per connection
+    'cache_size': int(getenv('SQLITE_CACHE_SIZE', -64000)),
+    'busy_timeout': int(getenv('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'temp_store': 'MEMORY',
+}
+# SQLite takes one writer at a time, so the write pool stays small; readers scale with it
+POOL_SIZE = int(getenv('DB_POOL_SIZE', 2))
+READ_POOL_SIZE = int(getenv('DB_READ_POOL_SIZE', 8))
+
+
+def _set_pragmas(pragmas: dict, read_only: bool):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            # journal_mode is a property of the file, a read-only connection cannot change it
+            if read_only and name == 'journal_mode':
+                continue
+            cursor.execute(f"PRAGMA {name}={value}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+    return on_connect
+
+
+# sqlite+aiosqlite:///path.db -> sqlite+aiosqlite:///file:path.db?mode=ro&uri=true
+def read_only_url(url: str) -> Optional[str]:
+    url = make_url(url)
+    if not url.database or url.database == ':memory:' or url.database.startswith('file:'):
+        return None
+    return url.set(database=f"file:{url.database}", query={**url.query, 'mode': 'ro', 'uri': 'true'})
+
+
+def make_engine(url, pragmas: Optional[dict] = None, pool_size: Optional[int] = None,
+                read_only: bool = False) -> AsyncEngine:
+    kwargs = {}
+    if pool_size:
+        kwargs.update(pool_size=pool_size, max_overflow=pool_size, pool_timeout=30)
+    new_engine = create_async_engine(url, **kwargs)
+    checkouts = metrics.counter('db_connection_checkouts')
+    event.listen(new_engine.sync_engine, 'checkout', lambda *args: checkouts.inc())
+    if pragmas or read_only:
+        event.listen(new_engine.sync_engine, 'connect', _set_pragmas(pragmas or {}, read_only))
+    return new_engine
+
+
 # Create .db file with tables
-engine = create_async_engine(getenv('DB_LITE'))
+engine = make_engine(getenv('DB_LITE'), PRAGMAS, POOL_SIZE)
 
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
+# Profile and history queries go through a separate read-only pool, so they never queue
+# behind the write connections (falls back to the main engine for in-memory databases)
+_read_url = read_only_url(getenv('DB_LITE'))
+read_engine = make_engine(_read_url, PRAGMAS, READ_POOL_SIZE, read_only=True) if _read_url else engine
+
+read_session_maker = async_sessionmaker(bind=read_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+# create_all never alters existing tables: new nullable columns are added with ALTER TABLE
+# and new indexes of old tables are created here
+def _create_all(conn) -> None:
+    Base.metadata.create_all(conn)
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                logger.info(f"Adding column {table.name}.{column.name}")
+                conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" '
+                                     f'{column.type.compile(conn.dialect)}')
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
 
 async def create_db():
     async with engine.begin() as conn:
         try:
-            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(_create_all)
             print("CREATE_DB SUCCESS")
         except Exception as e:
             logger.error(f"Error processing database: {e}")
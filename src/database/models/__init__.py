@@ -1,11 +1,15 @@
 from .base import Base
 from .calories import Calories
+from .daily_total import DailyTotal
 from .meal import Meal
+from .meta import Meta
 from .user import User
 
 __all__ = [
     "Base",
     "User",
     "Calories",
-    "Meal"
+    "Meal",
+    "DailyTotal",
+    "Meta"
 ]
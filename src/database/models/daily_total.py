@@ -0,0 +1,17 @@
+__all__ = ["DailyTotal"]
+
+from sqlalchemy import Column, Date, Float, Integer, UniqueConstraint
+
+from src.database.__mixin__ import IdMixin
+from src.database.models.base import Base
+
+
+# Running kcal sum per user and day, kept in step with meals by add_meal
+class DailyTotal(Base, IdMixin):
+    __tablename__ = 'daily_totals'
+    __table_args__ = (UniqueConstraint('user_id', 'day', name='uq_daily_totals_user_id_day'),)
+
+    user_id = Column(Integer, nullable=False)
+    day = Column(Date, nullable=False)
+    kcal = Column(Float, nullable=False, default=0.0)
+    meal_count = Column(Integer, nullable=False, default=0)
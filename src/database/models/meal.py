@@ -1,6 +1,6 @@
 __all__ = ["Meal"]
 
-from sqlalchemy import Column, String, Float, Integer, ForeignKey, DateTime, func
+from sqlalchemy import Column, String, Float, Integer, ForeignKey, DateTime, Index, func
 
 from src.database.__mixin__ import IdMixin
 from src.database.models.base import Base
@@ -8,6 +8,8 @@ from src.database.models.base import Base
 
 class Meal(Base, IdMixin):
     __tablename__ = 'meals'
+    # Every meal query is "this user, this time range": one index range scan, no table sort
+    __table_args__ = (Index('ix_meals_user_id_created', 'user_id', 'created'),)
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('user.id'))
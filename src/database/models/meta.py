@@ -0,0 +1,14 @@
+__all__ = ["Meta"]
+
+from sqlalchemy import Column, String
+
+from src.database.__mixin__ import IdMixin
+from src.database.models.base import Base
+
+
+# Small key/value settings of the database itself, e.g. the applied calorie snapshot version
+class Meta(Base, IdMixin):
+    __tablename__ = 'meta'
+
+    key = Column(String, unique=True, nullable=False)
+    value = Column(String)
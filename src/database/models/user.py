@@ -17,3 +17,5 @@ class User(Base, IdMixin):
     weight = Column(Float)
     activity = Column(Float)
     goal = Column(String(50))
+    # Mifflin-St Jeor kcal per day, computed at registration
+    daily_target = Column(Float)
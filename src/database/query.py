@@ -1,18 +1,44 @@
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
 from dotenv import find_dotenv, load_dotenv
-from sqlalchemy import select
+from sqlalchemy import String, func, select, type_coerce
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.database.models import User, Meal, Calories
+from src import metrics
+from src.database.calories import calorie_index
+from src.database.models import User, Meal, Calories, DailyTotal, Meta
 
 load_dotenv(find_dotenv())
 
+GOAL_FACTORS = {"Weight loss": 0.85, "Maintaining weight": 1, "Mass gain": 1.15}
+
+
+# func.now() in SQLite is UTC, so days of meals and daily totals are UTC days too
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def today() -> date:
+    return utcnow().date()
+
 
+# Formula of the Mifflin-St Jeor, kcal per day for the user's activity and goal
+def daily_target(gender: str, age: int, height: float, weight: float, activity: float, goal: str) -> float:
+    base = (10 * weight) + (6.25 * height) - (5 * age)
+    base += 5 if gender in ['male', 'm'] else -161
+    return base * activity * GOAL_FACTORS[goal]
+
+
+@metrics.timed('db_get_user_seconds')
 async def get_user(session: AsyncSession, user_id: int):
     query = select(User).where(User.tg_id == user_id)
     result = await session.execute(query)
     return result.scalar()
 
 
+@metrics.timed('db_add_user_seconds')
 async def add_user(session: AsyncSession, user_id: int, username: str, data: dict) -> None:
     session.add(User(
         tg_id=user_id,
@@ -22,37 +48,142 @@ async def add_user(session: AsyncSession, user_id: int, username: str, data: dic
         height=data.get('height'),
         weight=data.get('weight'),
         activity=data.get('activity'),
-        goal=data.get('goal')
+        goal=data.get('goal'),
+        daily_target=daily_target(data.get('gender'), data.get('age'), data.get('height'),
+                                  data.get('weight'), data.get('activity'), data.get('goal'))
     ))
     await session.commit()
 
 
+# The meal and its day's running total are written in one transaction
+@metrics.timed('db_add_meal_seconds')
 async def add_meal(session: AsyncSession, user_id: int, name: str, grams: float, total: float) -> None:
+    created = utcnow()
     session.add(Meal(
         user_id=user_id,
         name=name,
         grams=grams,
-        kcal=total
+        kcal=total,
+        created=created
     ))
+    query = insert(DailyTotal).values(user_id=user_id, day=created.date(), kcal=total, meal_count=1)
+    query = query.on_conflict_do_update(
+        index_elements=[DailyTotal.user_id, DailyTotal.day],
+        set_={'kcal': DailyTotal.kcal + query.excluded.kcal,
+              'meal_count': DailyTotal.meal_count + 1,
+              'updated': func.now()}
+    )
+    await session.execute(query)
     await session.commit()
 
 
+@metrics.timed('db_add_cal_seconds')
 async def add_cal(session: AsyncSession, name: str, kcal100: float) -> None:
     session.add(Calories(
         name=name,
         kcal_per_100=kcal100
     ))
     await session.commit()
+    calorie_index.invalidate()
+
+
+@metrics.timed('db_get_cal_seconds')
+async def get_cal(session: AsyncSession, name: str):
+    query = select(Calories).where(Calories.name == name)
+    result = await session.execute(query)
+    return result.scalars().first()
+
+
+@metrics.timed('db_get_cal_names_seconds')
+async def get_cal_names(session: AsyncSession) -> set:
+    result = await session.execute(select(Calories.name))
+    return set(result.scalars().all())
+
+
+@metrics.timed('db_get_cals_seconds')
+async def get_cals(session: AsyncSession) -> dict:
+    result = await session.execute(select(Calories.name, Calories.kcal_per_100))
+    return {name: kcal for name, kcal in result.all()}
+
+
+async def get_meta(session: AsyncSession, key: str) -> Optional[str]:
+    result = await session.execute(select(Meta.value).where(Meta.key == key))
+    return result.scalar()
+
+
+# Not committed: lands in the caller's transaction
+async def set_meta(session: AsyncSession, key: str, value: str) -> None:
+    query = insert(Meta).values(key=key, value=value)
+    query = query.on_conflict_do_update(index_elements=[Meta.key], set_={'value': query.excluded.value})
+    await session.execute(query)
+
+
+# Inserts or updates many {name: kcal_per_100} rows in one transaction
+@metrics.timed('db_upsert_cals_seconds')
+async def upsert_cals(session: AsyncSession, rows: dict) -> None:
+    if not rows:
+        return
+    query = insert(Calories).values([{'name': name, 'kcal_per_100': kcal} for name, kcal in rows.items()])
+    query = query.on_conflict_do_update(
+        index_elements=[Calories.name],
+        set_={'kcal_per_100': query.excluded.kcal_per_100}
+    )
+    await session.execute(query)
+    await session.commit()
+    calorie_index.invalidate()
 
 
-async def get_meals(session: AsyncSession, user_id: int):
-    query = select(Meal).where(Meal.user_id == user_id).order_by(Meal.created.desc())
+@metrics.timed('db_get_meals_seconds')
+async def get_meals(session: AsyncSession, user_id: int, limit: Optional[int] = None, before=None):
+    query = select(Meal).where(Meal.user_id == user_id)
+    if before is not None:
+        query = query.where(Meal.created < before)
+    query = query.order_by(Meal.created.desc()).limit(limit)
     result = await session.execute(query)
     return result.scalars().all()
 
 
-async def get_cal(session: AsyncSession, name: str):
-    query = select(Calories).where(Calories.name == name)
+# SQLite keeps datetimes as "YYYY-MM-DD HH:MM:SS[.ffffff]" text, so a day is the half-open
+# string range [day, next day). Compared as plain text the (user_id, created) index is used.
+def _created_from(day: date):
+    return type_coerce(Meal.created, String) >= day.isoformat()
+
+
+def _created_before(day: date):
+    return type_coerce(Meal.created, String) < day.isoformat()
+
+
+@metrics.timed('db_get_day_meals_seconds')
+async def get_day_meals(session: AsyncSession, user_id: int, day: Optional[date] = None):
+    day = day or today()
+    query = (select(Meal)
+             .where(Meal.user_id == user_id, _created_from(day), _created_before(day + timedelta(days=1)))
+             .order_by(Meal.created))
     result = await session.execute(query)
-    return result.scalars().first()
+    return result.scalars().all()
+
+
+@metrics.timed('db_get_day_total_seconds')
+async def get_day_total(session: AsyncSession, user_id: int, day: Optional[date] = None) -> Optional[DailyTotal]:
+    query = select(DailyTotal).where(DailyTotal.user_id == user_id, DailyTotal.day == (day or today()))
+    result = await session.execute(query)
+    return result.scalar()
+
+
+# Per-day kcal totals from daily_totals, newest first. Pages are keyed by day:
+# pass the oldest day of the previous page as `before` to get the next one.
+@metrics.timed('db_get_daily_totals_seconds')
+async def get_daily_totals(session: AsyncSession, user_id: int, limit: int = 14,
+                           before: Optional[date] = None) -> List[Tuple[date, float]]:
+    query = select(DailyTotal.day, DailyTotal.kcal).where(DailyTotal.user_id == user_id)
+    if before is not None:
+        query = query.where(DailyTotal.day < before)
+    query = query.order_by(DailyTotal.day.desc()).limit(limit)
+    result = await session.execute(query)
+    return [(day, kcal) for day, kcal in result.all()]
+
 
+@metrics.timed('db_has_meals_before_seconds')
+async def has_meals_before(session: AsyncSession, user_id: int, day: date) -> bool:
+    query = select(DailyTotal.id).where(DailyTotal.user_id == user_id, DailyTotal.day < day).limit(1)
+    return (await session.execute(query)).first() is not None
@@ -0,0 +1,33 @@
+from typing import Any, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from src import metrics
+
+sessions_opened = metrics.counter('db_sessions_opened')
+
+
+# Stands in for an AsyncSession and creates the real one on first attribute access,
+# so updates whose handler never queries the database cost no session and no connection.
+class LazySession:
+    def __init__(self, session_pool: async_sessionmaker):
+        self._session_pool = session_pool
+        self._session: Optional[AsyncSession] = None
+
+    @property
+    def opened(self) -> bool:
+        return self._session is not None
+
+    def _get(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._session_pool()
+            sessions_opened.inc()
+        return self._session
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._get(), name)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.close()
@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.query import get_cals, get_meta, set_meta, upsert_cals
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = os.path.join(os.path.dirname(__file__), "calories_snapshot.json")
+# Key in the meta table holding the snapshot version last applied to this database
+VERSION_KEY = 'calorie_snapshot_version'
+
+
+def load_snapshot(path: str = SNAPSHOT_PATH) -> Tuple[int, Dict[str, float]]:
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return data['version'], {name: float(kcal) for name, kcal in data['calories'].items()}
+
+
+# Brings the calories table up to the bundled snapshot in one transaction. A version newer than the one
+# recorded in the meta table replaces the rows whose value changed and records the new version; the same or an
+# older version only adds missing dishes, so values written since (USDA lookups, user input) are kept.
+async def apply_snapshot(session: AsyncSession, path: str = SNAPSHOT_PATH) -> int:
+    version, snapshot = load_snapshot(path)
+    applied = int(await get_meta(session, VERSION_KEY) or 0)
+    current = await get_cals(session)
+    if version > applied:
+        rows = {name: kcal for name, kcal in snapshot.items() if current.get(name) != kcal}
+        await set_meta(session, VERSION_KEY, str(version))
+    else:
+        rows = {name: kcal for name, kcal in snapshot.items() if name not in current}
+    await upsert_cals(session, rows)
+    await session.commit()
+    if version > applied:
+        logger.info(f"Calorie snapshot v{version} (was v{applied}): wrote {len(rows)} of {len(snapshot)} dishes")
+    elif rows:
+        logger.info(f"Calorie snapshot v{version}: added {len(rows)} of {len(snapshot)} dishes")
+    return len(rows)
+
+
+# Re-queries USDA for every class and writes the next snapshot version
+async def refresh_snapshot(path: str = SNAPSHOT_PATH, classes_path: Optional[str] = None) -> None:
+    from src.get_kcal import CLASSES_PATH, class_to_name, fetch_kcal, load_food101_classes
+
+    names = [class_to_name(c) for c in load_food101_classes(classes_path or CLASSES_PATH)]
+    found = await fetch_kcal(names)
+    if not found:
+        raise SystemExit("USDA returned no energy values, the snapshot was not changed")
+    missing = [name for name in names if name not in found]
+    if missing:
+        logger.warning(f"USDA has no energy value for {len(missing)} dishes, keeping old values: {missing}")
+
+    try:
+        version, old = load_snapshot(path)
+    except (OSError, KeyError, json.JSONDecodeError):
+        version, old = 0, {}
+    calories = {name: found.get(name, old.get(name)) for name in names if name in found or name in old}
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'version': version + 1, 'source': 'USDA FoodData Central search', 'calories': calories},
+                  f, indent=1)
+        f.write('\n')
+    os.replace(tmp, path)
+    logger.info(f"Wrote calorie snapshot v{version + 1} with {len(calories)} dishes to {path}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Calorie snapshot tools")
+    parser.add_argument('--refresh', action='store_true', help="Regenerate the snapshot from the USDA API")
+    parser.add_argument('--apply', action='store_true', help="Apply the snapshot to the database")
+    parser.add_argument('--path', default=SNAPSHOT_PATH)
+    parser.add_argument('--classes', help="Class list to look up (default src/model/classes.txt)")
+    args = parser.parse_args()
+
+    async def run():
+        if args.refresh:
+            await refresh_snapshot(args.path, args.classes)
+        if args.apply:
+            from src.database.engine import create_db, session_maker
+            await create_db()
+            async with session_maker() as session:
+                await apply_snapshot(session, args.path)
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
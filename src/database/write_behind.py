@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, insert as plain_insert
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from src import metrics
+from src.database import query
+from src.database.calories import calorie_index
+from src.database.models import Calories, DailyTotal, Meal, User
+
+logger = logging.getLogger(__name__)
+
+FLUSH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+# Optional write-behind for user, meal and calorie inserts. When enabled, rows are kept in
+# memory and written in one transaction every `max_rows` rows or `flush_ms` milliseconds.
+# Reads of a user with pending rows must call flush_user() first (the DB middleware does).
+# When disabled every call is written through with the caller's session, as before.
+class WriteBehindBuffer:
+    def __init__(self, session_pool: async_sessionmaker, enabled: bool = False, max_rows: int = 200,
+                 flush_ms: float = 200.0, max_pending: int = 5000):
+        self.session_pool = session_pool
+        self.enabled = enabled
+        self.max_rows = max(1, max_rows)
+        self.flush_ms = flush_ms
+        self.max_pending = max(self.max_rows, max_pending)
+
+        self._ops: List[Tuple[str, int, dict]] = []
+        self._users: Dict[int, int] = {}
+        self._lock: Optional[asyncio.Lock] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+        self.rows = metrics.counter('write_behind_rows')
+        self.failures = metrics.counter('write_behind_failures')
+        self.pending_gauge = metrics.gauge('write_behind_pending')
+        self.batch_size = metrics.histogram('write_behind_batch_size', FLUSH_BUCKETS)
+
+    def start(self) -> None:
+        if self._task is None and self.enabled:
+            self._lock = asyncio.Lock()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def pending(self, user_id: int) -> bool:
+        return user_id in self._users
+
+    async def add_user(self, session: AsyncSession, user_id: int, username: str, data: dict) -> None:
+        if not self.enabled:
+            return await query.add_user(session, user_id, username, data)
+        await self._put('user', user_id, dict(
+            tg_id=user_id,
+            user_name=username,
+            gender=data.get('gender'),
+            age=data.get('age'),
+            height=data.get('height'),
+            weight=data.get('weight'),
+            activity=data.get('activity'),
+            goal=data.get('goal'),
+            daily_target=query.daily_target(data.get('gender'), data.get('age'), data.get('height'),
+                                            data.get('weight'), data.get('activity'), data.get('goal')),
+        ))
+
+    async def add_meal(self, session: AsyncSession, user_id: int, name: str, grams: float, total: float) -> None:
+        if not self.enabled:
+            return await query.add_meal(session, user_id, name, grams, total)
+        created = query.utcnow()
+        await self._put('meal', user_id, dict(user_id=user_id, name=name, grams=grams, kcal=total,
+                                              created=created, updated=created))
+
+    # user_id is who entered the value, so their next lookup sees it
+    async def add_cal(self, session: AsyncSession, name: str, kcal100: float, user_id: int = 0) -> None:
+        if not self.enabled:
+            return await query.add_cal(session, name, kcal100)
+        await self._put('cal', user_id, dict(name=name, kcal_per_100=kcal100))
+
+    async def _put(self, kind: str, user_id: int, row: dict) -> None:
+        self.start()
+        # Back-pressure: callers wait for the database instead of growing the buffer
+        while len(self._ops) >= self.max_pending:
+            async with self._lock:
+                if len(self._ops) >= self.max_pending:
+                    await self._flush()
+        self._ops.append((kind, user_id, row))
+        self._users[user_id] = self._users.get(user_id, 0) + 1
+        self.pending_gauge.set(len(self._ops))
+        if len(self._ops) >= self.max_rows:
+            self._wakeup.set()
+
+    async def flush_user(self, user_id: int) -> None:
+        if self.pending(user_id):
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self._lock is None:
+            return
+        async with self._lock:
+            await self._flush()
+
+    # Caller holds the lock. Users stay pending until their rows are committed, so a concurrent
+    # flush_user() waits on the lock for this flush instead of reading before the commit.
+    async def _flush(self) -> None:
+        ops, self._ops = self._ops, []
+        self.pending_gauge.set(len(self._ops))
+        if not ops:
+            return
+        start = time.perf_counter()
+        try:
+            async with self.session_pool() as session:
+                await self._write(session, ops)
+        except Exception as e:
+            self.failures.inc()
+            logger.error(f"Write-behind batch of {len(ops)} rows failed ({e!r}), writing rows one by one")
+            await self._write_each(ops)
+        finally:
+            self._done(ops)
+        self.rows.inc(len(ops))
+        self.batch_size.observe(len(ops))
+        logger.debug(f"Flushed {len(ops)} rows in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def _done(self, ops: List[Tuple[str, int, dict]]) -> None:
+        for _, user_id, _ in ops:
+            left = self._users.get(user_id, 0) - 1
+            if left > 0:
+                self._users[user_id] = left
+            else:
+                self._users.pop(user_id, None)
+
+    async def _write(self, session: AsyncSession, ops: List[Tuple[str, int, dict]]) -> None:
+        users = [row for kind, _, row in ops if kind == 'user']
+        cals = [row for kind, _, row in ops if kind == 'cal']
+        meals = [row for kind, _, row in ops if kind == 'meal']
+
+        if users:
+            await session.execute(insert(User).values(users).on_conflict_do_nothing(index_elements=[User.tg_id]))
+        if cals:
+            await session.execute(insert(Calories).values(cals).on_conflict_do_nothing(index_elements=[Calories.name]))
+        if meals:
+            await session.execute(plain_insert(Meal), meals)
+            totals: Dict[Tuple[int, object], List[float]] = {}
+            for row in meals:
+                total = totals.setdefault((row['user_id'], row['created'].date()), [0.0, 0])
+                total[0] += row['kcal']
+                total[1] += 1
+            for (user_id, day), (kcal, count) in totals.items():
+                upsert = insert(DailyTotal).values(user_id=user_id, day=day, kcal=kcal, meal_count=count)
+                upsert = upsert.on_conflict_do_update(
+                    index_elements=[DailyTotal.user_id, DailyTotal.day],
+                    set_={'kcal': DailyTotal.kcal + upsert.excluded.kcal,
+                          'meal_count': DailyTotal.meal_count + upsert.excluded.meal_count,
+                          'updated': func.now()}
+                )
+                await session.execute(upsert)
+        await session.commit()
+        if cals:
+            calorie_index.invalidate()
+
+    # Fallback after a failed batch: one transaction per row, so one bad row loses only itself
+    async def _write_each(self, ops: List[Tuple[str, int, dict]]) -> None:
+        for op in ops:
+            try:
+                async with self.session_pool() as session:
+                    await self._write(session, [op])
+            except Exception as e:
+                self.failures.inc()
+                logger.error(f"Dropped {op[0]} row of user {op[1]}: {e!r}")
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Write-behind flush failed: {e!r}")
+
+    # Lets an in-flight flush finish, then writes whatever is left
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        await self.flush()
+        logger.info("Write-behind buffer flushed on shutdown")
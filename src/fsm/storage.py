@@ -0,0 +1,158 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import aiosqlite
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+# (state, data, expires at)
+Record = Tuple[Optional[str], Dict[str, Any], float]
+EMPTY: Record = (None, {}, 0.0)
+
+
+# FSM storage in a SQLite file: one row per chat/user with the state and compact JSON data.
+# Conversations idle for longer than `ttl` expire (checked on read, deleted by a background
+# sweeper). Up to `cache_size` keys are kept in an in-memory LRU with write-through, so hot
+# users cost no query and memory stays bounded however many users there are.
+# Several processes can share the file; set cache_size=0 then, the cache is per process.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str, ttl: float = 24 * 3600, cache_size: int = 10000, sweep_interval: float = 300,
+                 key_builder: Optional[KeyBuilder] = None):
+        self.path = path
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.sweep_interval = sweep_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+        self._db: Optional[aiosqlite.Connection] = None
+        self._open_lock: Optional[asyncio.Lock] = None
+        self._sweeper: Optional[asyncio.Task] = None
+        self._cache: "OrderedDict[str, Record]" = OrderedDict()
+
+        self.hits = metrics.counter('fsm_cache_hits')
+        self.misses = metrics.counter('fsm_cache_misses')
+        self.expired = metrics.counter('fsm_expired')
+
+    async def _conn(self) -> aiosqlite.Connection:
+        if self._db is not None:
+            return self._db
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+        async with self._open_lock:
+            if self._db is None:
+                db = await aiosqlite.connect(self.path)
+                await db.execute("PRAGMA journal_mode=WAL")
+                await db.execute("PRAGMA synchronous=NORMAL")
+                await db.execute("CREATE TABLE IF NOT EXISTS fsm "
+                                 "(key TEXT PRIMARY KEY, state TEXT, data TEXT, expires REAL) WITHOUT ROWID")
+                await db.execute("CREATE INDEX IF NOT EXISTS ix_fsm_expires ON fsm (expires)")
+                await db.commit()
+                self._db = db
+                if self.ttl and self.sweep_interval:
+                    self._sweeper = asyncio.create_task(self._sweep_loop())
+        return self._db
+
+    def _expires(self) -> float:
+        return time.time() + self.ttl if self.ttl else 0.0
+
+    @staticmethod
+    def _alive(record: Record) -> bool:
+        return not record[2] or record[2] > time.time()
+
+    def _remember(self, key: str, record: Record) -> None:
+        if self.cache_size <= 0:
+            return
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key: str) -> Record:
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            self.hits.inc()
+        else:
+            self.misses.inc()
+            db = await self._conn()
+            async with db.execute("SELECT state, data, expires FROM fsm WHERE key = ?", (key,)) as cursor:
+                row = await cursor.fetchone()
+            record = (row[0], json.loads(row[1]) if row[1] else {}, row[2] or 0.0) if row else EMPTY
+            self._remember(key, record)
+        if not self._alive(record):
+            self.expired.inc()
+            await self._store(key, EMPTY)
+            return EMPTY
+        return record
+
+    async def _store(self, key: str, record: Record) -> None:
+        state, data, expires = record
+        db = await self._conn()
+        if state is None and not data:
+            await db.execute("DELETE FROM fsm WHERE key = ?", (key,))
+            record = EMPTY
+        else:
+            await db.execute(
+                "INSERT INTO fsm (key, state, data, expires) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                "expires = excluded.expires",
+                (key, state, json.dumps(data, separators=(',', ':'), ensure_ascii=False) if data else None, expires)
+            )
+        await db.commit()
+        self._remember(key, record)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        name = self.key_builder.build(key)
+        _, data, _ = await self._load(name)
+        await self._store(name, (state.state if isinstance(state, State) else state, data, self._expires()))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self.key_builder.build(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        name = self.key_builder.build(key)
+        state, _, _ = await self._load(name)
+        await self._store(name, (state, data.copy(), self._expires()))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._load(self.key_builder.build(key)))[1].copy()
+
+    async def sweep(self) -> int:
+        db = await self._conn()
+        now = time.time()
+        cursor = await db.execute("DELETE FROM fsm WHERE expires > 0 AND expires <= ?", (now,))
+        await db.commit()
+        for name in [name for name, record in self._cache.items() if not self._alive(record)]:
+            del self._cache[name]
+        if cursor.rowcount:
+            self.expired.inc(cursor.rowcount)
+            logger.info(f"Expired {cursor.rowcount} idle FSM conversations")
+        return cursor.rowcount
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"FSM sweep failed: {e!r}")
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        if self._db is not None:
+            db, self._db = self._db, None
+            await db.close()
+        self._cache.clear()
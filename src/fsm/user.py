@@ -19,3 +19,4 @@ class PhotoStates(StatesGroup):
     waiting_grams = State()
     confirm_name = State()
     ask_calories = State()
+    confirm_match = State()
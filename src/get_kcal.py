@@ -1,12 +1,17 @@
+import asyncio
+import hashlib
 import json
 import logging
+import os
+import random
 import time
+from typing import Dict, List, Optional
 
-import requests
+import aiohttp
+from dotenv import load_dotenv
+from sqlalchemy.ext.asyncio import async_sessionmaker
 
-from src.config import USDA_API_KEY, CLASSES_PATH
-from src.database.engine import session_maker
-from src.database.query import get_cal, add_cal
+from src.database.query import get_cal_names, upsert_cals
 
 logging.basicConfig(
     level=logging.INFO,
@@ -14,7 +19,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-SEARCH_URL = "https://api.nal.usda.gov/fdc/v1/foods/search"
+# Read here rather than in src.config, so the snapshot tool and tests need neither BOT_TOKEN nor DB_LITE.
+# Search endpoint (point it at a local stub for tests), parallel requests, requests per second
+# and the folder that keeps raw responses between restarts
+load_dotenv()
+USDA_API_KEY = os.getenv("USDA_API_KEY")
+USDA_SEARCH_URL = os.getenv("USDA_SEARCH_URL", "https://api.nal.usda.gov/fdc/v1/foods/search")
+USDA_CONCURRENCY = int(os.getenv("USDA_CONCURRENCY", 8))
+USDA_RATE = float(os.getenv("USDA_RATE", 10))
+USDA_CACHE_DIR = os.getenv("USDA_CACHE_DIR", ".cache/usda")
+CLASSES_PATH = "src/model/classes.txt"
+
+RETRIES = 4
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 
 # Reads 101 class
 def load_food101_classes(path):
@@ -22,65 +40,153 @@ def load_food101_classes(path):
         return [line.strip() for line in f.readlines()]
 
 
-# Getting all 101 classes of food in kcal per 100g
-def get_kcal_for_food(name: str):
-    params = {
-        "api_key": USDA_API_KEY,
-        "query": name,
-        "pageSize": 1
-    }
+# Same naming as the bot uses for predictions: "apple_pie" -> "Apple pie"
+def class_to_name(original: str) -> str:
+    return " ".join(original.split("_")).capitalize()
 
-    for attempt in range(3):
-        try:
-            r = requests.get(SEARCH_URL, params=params, timeout=5)
 
-            if r.status_code != 200:
-                logger.error(f"USDA returned {r.status_code} for {name}")
-                time.sleep(0.5)
-                continue
+# Allows `rate` requests per second on average with bursts up to `capacity`
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
 
-            try:
-                data = r.json()
-            except json.JSONDecodeError:
-                logger.error(f"USDA returned non-JSON for {name}")
-                time.sleep(0.5)
-                continue
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
-            if "foods" not in data or not data["foods"]:
-                return None
 
-            food = data["foods"][0]
-            for n in food.get("foodNutrients", []):
-                if n.get("nutrientName", "").lower() == "energy" and n.get("unitName") == "KCAL":
-                    return n.get("value")
+# Raw USDA responses on disk, keyed by query, so a restart never asks USDA the same thing twice
+class ResponseCache:
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
 
+    def _path(self, query: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(query.encode()).hexdigest() + '.json')
+
+    def get(self, query: str) -> Optional[dict]:
+        try:
+            with open(self._path(query), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
             return None
 
-        except Exception as e:
-            logger.error(f"Error USDA {name}: {e}")
-            time.sleep(0.5)
+    def put(self, query: str, data: dict) -> None:
+        path = self._path(query)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
 
-    return None
 
+# Energy in kcal per 100g of the best search match
+def parse_kcal(data: dict) -> Optional[float]:
+    if "foods" not in data or not data["foods"]:
+        return None
 
-async def get_kcal():
-    classes = load_food101_classes(CLASSES_PATH)
+    food = data["foods"][0]
+    for n in food.get("foodNutrients", []):
+        if n.get("nutrientName", "").lower() == "energy" and n.get("unitName") == "KCAL":
+            return n.get("value")
+    return None
 
-    async with session_maker() as session:
 
-        for original in classes:
-            name = " ".join(original.split("_")).capitalize()
+async def fetch_food(http: aiohttp.ClientSession, name: str, bucket: TokenBucket,
+                     cache: ResponseCache, url: str = USDA_SEARCH_URL,
+                     api_key: Optional[str] = USDA_API_KEY) -> Optional[dict]:
+    cached = cache.get(name)
+    if cached is not None:
+        return cached
 
-            if await get_cal(session, name):
-                continue
+    params = {
+        "api_key": api_key or "",
+        "query": name,
+        "pageSize": 1
+    }
 
-            logger.info(f"Searching for: {name}...")
+    for attempt in range(RETRIES):
+        if attempt:
+            # Exponential backoff with full jitter
+            await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+        await bucket.acquire()
+        try:
+            async with http.get(url, params=params) as r:
+                if r.status in RETRY_STATUSES:
+                    logger.warning(f"USDA returned {r.status} for {name}, retrying")
+                    continue
+                if r.status != 200:
+                    logger.error(f"USDA returned {r.status} for {name}")
+                    return None
+                data = await r.json(content_type=None)
+        except json.JSONDecodeError:
+            logger.error(f"USDA returned non-JSON for {name}")
+            continue
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Error USDA {name}: {e!r}")
+            continue
+
+        cache.put(name, data)
+        return data
+
+    logger.error(f"USDA gave up on {name} after {RETRIES} attempts")
+    return None
 
-            kcal = get_kcal_for_food(name)
 
+# Fetches all names concurrently (bounded), returns the ones USDA knows the energy of
+async def fetch_kcal(names: List[str], url: str = USDA_SEARCH_URL, concurrency: int = USDA_CONCURRENCY,
+                     rate: float = USDA_RATE, cache_dir: str = USDA_CACHE_DIR,
+                     api_key: Optional[str] = USDA_API_KEY) -> Dict[str, float]:
+    bucket = TokenBucket(rate)
+    cache = ResponseCache(cache_dir)
+    semaphore = asyncio.Semaphore(concurrency)
+    timeout = aiohttp.ClientTimeout(total=10)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as http:
+        async def one(name: str):
+            async with semaphore:
+                data = await fetch_food(http, name, bucket, cache, url, api_key)
+            kcal = parse_kcal(data) if data else None
             if kcal:
                 logger.info(f"{name}: {kcal} kcal/100g")
-                await add_cal(session, name, float(kcal))
             else:
                 logger.error(f"not found {name}")
-            time.sleep(0.5)
+            return name, kcal
+
+        results = await asyncio.gather(*(one(name) for name in names))
+    return {name: float(kcal) for name, kcal in results if kcal}
+
+
+# Looks up the classes the calories table lacks and stores them with one bulk upsert
+async def get_kcal(session_pool: Optional[async_sessionmaker] = None, classes_path: str = CLASSES_PATH,
+                   url: str = USDA_SEARCH_URL, api_key: Optional[str] = USDA_API_KEY,
+                   cache_dir: str = USDA_CACHE_DIR) -> None:
+    if session_pool is None:
+        from src.database.engine import session_maker as session_pool
+    classes = load_food101_classes(classes_path)
+
+    async with session_pool() as session:
+        known = await get_cal_names(session)
+        missing = [name for name in map(class_to_name, classes) if name not in known]
+        if not missing:
+            return
+        if not api_key:
+            logger.warning(f"{len(missing)} dishes have no calories and USDA_API_KEY is not set")
+            return
+
+        logger.info(f"Searching USDA for {len(missing)} dishes...")
+        start = time.perf_counter()
+        found = await fetch_kcal(missing, url, cache_dir=cache_dir, api_key=api_key)
+        await upsert_cals(session, found)
+        logger.info(f"Stored {len(found)}/{len(missing)} dishes in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,324 @@
+import asyncio
+import functools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Dict, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Process-wide registry of metrics, looked up by name
+registry: Dict[str, object] = {}
+_lock = threading.Lock()
+
+# Stage timers (timer/timed) and process gauges are skipped while disabled;
+# counters, gauges and histograms kept by other modules are not affected
+enabled = True
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def set_enabled(value: bool) -> None:
+    global enabled
+    enabled = value
+
+
+class Counter:
+    def __init__(self, name: str):
+        self.name = name
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self) -> dict:
+        return {'value': self.value}
+
+
+class Gauge:
+    def __init__(self, name: str):
+        self.name = name
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def snapshot(self) -> dict:
+        return {'value': self.value}
+
+
+# Cumulative histogram with fixed upper bounds (last bucket is +Inf)
+class Histogram:
+    def __init__(self, name: str, buckets: Sequence[float]):
+        self.name = name
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        bounds = [str(b) for b in self.buckets] + ['+Inf']
+        return {
+            'buckets': dict(zip(bounds, counts)),
+            'sum': total,
+            'count': count,
+        }
+
+    # Observations made elsewhere (see merge), bucketed the same way
+    def add(self, counts: Sequence[int], total: float) -> None:
+        with self._lock:
+            for i, n in enumerate(counts):
+                self.counts[i] += n
+            self.sum += total
+            self.count += sum(counts)
+
+    # Upper bound of the bucket holding the q-th quantile (inf if it falls into the last bucket)
+    def quantile(self, q: float) -> float:
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return 0.0
+        rank, seen = q * count, 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+def _get_or_create(name: str, factory):
+    metric = registry.get(name)
+    if metric is None:
+        with _lock:
+            metric = registry.get(name)
+            if metric is None:
+                metric = factory()
+                registry[name] = metric
+    return metric
+
+
+def counter(name: str) -> Counter:
+    return _get_or_create(name, lambda: Counter(name))
+
+
+def gauge(name: str) -> Gauge:
+    return _get_or_create(name, lambda: Gauge(name))
+
+
+def histogram(name: str, buckets: Sequence[float]) -> Histogram:
+    return _get_or_create(name, lambda: Histogram(name, buckets))
+
+
+# What take_deltas() has already reported, per metric name
+_reported: Dict[str, tuple] = {}
+
+
+# Counter and histogram increments since the previous call. Inference worker processes send
+# these back with every result and the parent adds them to its own registry with merge(),
+# so /metrics in the parent covers work done in the workers. Gauges stay per process.
+def take_deltas() -> list:
+    deltas = []
+    for name, metric in list(registry.items()):
+        if isinstance(metric, Counter):
+            value = metric.value
+            if value != _reported.get(name, 0.0):
+                deltas.append(('counter', name, value - _reported.get(name, 0.0)))
+                _reported[name] = value
+        elif isinstance(metric, Histogram):
+            with metric._lock:
+                counts, total, count = list(metric.counts), metric.sum, metric.count
+            last_counts, last_total, last_count = _reported.get(name, ([0] * len(counts), 0.0, 0))
+            if count != last_count:
+                deltas.append(('histogram', name, metric.buckets,
+                               [n - last for n, last in zip(counts, last_counts)], total - last_total))
+                _reported[name] = (counts, total, count)
+    return deltas
+
+
+def merge(deltas: list) -> None:
+    for kind, name, *rest in deltas:
+        if kind == 'counter':
+            counter(name).inc(rest[0])
+        else:
+            buckets, counts, total = rest
+            histogram(name, buckets).add(counts, total)
+
+
+def snapshot() -> dict:
+    return {name: metric.snapshot() for name, metric in list(registry.items())}
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+_NOOP = nullcontext()
+
+
+# with metrics.timer('photo_download_seconds'): ... observes the block's duration; a no-op when disabled
+def timer(name: str, buckets: Sequence[float] = STAGE_BUCKETS):
+    if not enabled:
+        return _NOOP
+    return _Timer(histogram(name, buckets))
+
+
+# Decorator version of timer() for sync and async functions
+def timed(name: str, buckets: Sequence[float] = STAGE_BUCKETS):
+    def decorator(fn):
+        hist = histogram(name, buckets)
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                if not enabled:
+                    return await fn(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    hist.observe(time.perf_counter() - start)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not enabled:
+                    return fn(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    hist.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+# RSS, uptime, threads and torch thread pools, refreshed before each export
+def collect_process() -> None:
+    if not enabled:
+        return
+    gauge('process_rss_mb').set(rss_mb())
+    gauge('process_uptime_seconds').set(uptime())
+    gauge('process_threads').set(threading.active_count())
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        gauge('torch_threads').set(torch.get_num_threads())
+        gauge('torch_interop_threads').set(torch.get_num_interop_threads())
+
+
+def _prometheus_name(name: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_:]', '_', name)
+
+
+# Prometheus text exposition format (version 0.0.4)
+def render_prometheus() -> str:
+    collect_process()
+    lines = []
+    for name, metric in sorted(list(registry.items())):
+        name = _prometheus_name(name)
+        if isinstance(metric, Histogram):
+            data = metric.snapshot()
+            lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, n in data['buckets'].items():
+                cumulative += n
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum {data['sum']}")
+            lines.append(f"{name}_count {data['count']}")
+        else:
+            kind = 'counter' if isinstance(metric, Counter) else 'gauge'
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {metric.value}")
+    return "\n".join(lines) + "\n"
+
+
+# One line with every non-zero counter/gauge and count/p50/p95 of every non-empty histogram
+def summary() -> str:
+    collect_process()
+    parts = []
+    for name, metric in sorted(list(registry.items())):
+        if isinstance(metric, Histogram):
+            if metric.count:
+                parts.append(f"{name} n={metric.count} p50={metric.quantile(0.5):g} p95={metric.quantile(0.95):g}")
+        elif metric.value:
+            parts.append(f"{name}={metric.value:g}")
+    return ", ".join(parts)
+
+
+async def log_periodically(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(f"Metrics: {summary()}")
+
+
+# aiohttp handler for GET /metrics
+async def handle(request):
+    from aiohttp import web
+    return web.Response(body=render_prometheus().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+# The only /metrics endpoint, on its own (by default loopback) address; returns the runner to clean up
+async def serve(host: str, port: int):
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+    return runner
+
+
+# Resident set size of this process in MB (peak RSS where /proc is unavailable)
+def rss_mb() -> float:
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        return 0.0
+
+
+_imported_at = time.time()
+
+
+# Seconds since the process started (since this module was imported where /proc is unavailable)
+def uptime() -> float:
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as f:
+            system_uptime = float(f.read().split()[0])
+        return system_uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.time() - _imported_at
@@ -1,13 +1,80 @@
-from typing import Any, Awaitable, Callable, Dict
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
 
 from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
 from aiogram.types import TelegramObject
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
+from src import metrics
+from src.database.session import LazySession
+from src.database.write_behind import WriteBehindBuffer
 
+logger = logging.getLogger(__name__)
+
+
+# Gives handlers `session` (read-write) and `read_session` (read-only pool when configured) as
+# lazy proxies: a session is opened on first use and a connection on its first query.
+# Handlers flagged with flags={'no_db': True} get neither. Registered as an inner middleware
+# of message and callback_query, so the handler (and its flags) are already resolved.
+# Rows the user wrote through the write-behind buffer are flushed first, so they read their own writes.
 class DataBaseSession(BaseMiddleware):
-    def __init__(self, session_pool: async_sessionmaker):
+    def __init__(self, session_pool: async_sessionmaker, read_session_pool: Optional[async_sessionmaker] = None,
+                 write_buffer: Optional[WriteBehindBuffer] = None):
         self.session_pool = session_pool
+        self.read_session_pool = read_session_pool or session_pool
+        self.write_buffer = write_buffer
+        self.updates = metrics.counter('db_middleware_updates')
+        self.skipped = metrics.counter('db_middleware_skipped')
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        self.updates.inc()
+        if get_flag(data, 'no_db'):
+            self.skipped.inc()
+            return await handler(event, data)
+
+        user = data.get('event_from_user')
+        if self.write_buffer is not None and user is not None:
+            await self.write_buffer.flush_user(user.id)
+        session = LazySession(self.session_pool)
+        read_session = LazySession(self.read_session_pool)
+        data['session'] = session
+        data['read_session'] = read_session
+        try:
+            return await handler(event, data)
+        finally:
+            await session.close()
+            await read_session.close()
+
+
+# Logs once how long after process start the first update was handled
+class FirstUpdateLogger(BaseMiddleware):
+    def __init__(self):
+        self.logged = False
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            if not self.logged:
+                self.logged = True
+                logger.info(f"First update handled {metrics.uptime():.1f}s after start, RSS {metrics.rss_mb():.0f} MB")
+
+
+# End-to-end handler latency of one router (handler_<name>_seconds), errors included
+class HandlerTimer(BaseMiddleware):
+    def __init__(self, name: str):
+        self.name = f'handler_{name}_seconds'
 
     async def __call__(
             self,
@@ -15,6 +82,5 @@ class DataBaseSession(BaseMiddleware):
             event: TelegramObject,
             data: Dict[str, Any],
     ) -> Any:
-        async with self.session_pool() as session:
-            data['session'] = session
+        with metrics.timer(self.name):
             return await handler(event, data)
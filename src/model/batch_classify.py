@@ -0,0 +1,263 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import torch
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+from src.model.preprocess import CROP, decode_image
+from src.model.variants import IMAGE_EXTENSIONS
+
+logger = logging.getLogger(__name__)
+
+CSV_FIELDS = ['path', 'label', 'prediction', 'confidence', 'top3', 'error']
+
+
+# (path, label or '') pairs without building a list: a directory is walked in sorted order,
+# with the parent folder as label if labels_from_dirs; a manifest is either JSONL
+# ({"path": ..., "label": ...}) or one "path[,label]" per line, relative paths resolve against it
+def iter_inputs(images_dir: Optional[str] = None, manifest: Optional[str] = None,
+                labels_from_dirs: bool = False) -> Iterator[Tuple[str, str]]:
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('{'):
+                    item = json.loads(line)
+                    path, label = item['path'], item.get('label') or ''
+                else:
+                    path, _, label = line.partition(',')
+                    path, label = path.strip(), label.strip()
+                yield os.path.join(base, path), label
+        return
+
+    for root, dirs, files in os.walk(images_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(root, name), os.path.basename(root) if labels_from_dirs else ''
+
+
+# Streams decoded images; each DataLoader worker takes every n-th input, so nothing is listed up front.
+# Unreadable files come through with the error instead of stopping the run.
+class ImageStream(IterableDataset):
+    def __init__(self, transform: Callable, images_dir: Optional[str] = None, manifest: Optional[str] = None,
+                 labels_from_dirs: bool = False, skip: Optional[Set[str]] = None):
+        self.transform = transform
+        self.source = (images_dir, manifest, labels_from_dirs)
+        self.skip = skip or set()
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker, workers = (info.id, info.num_workers) if info else (0, 1)
+        for i, (path, label) in enumerate(iter_inputs(*self.source)):
+            if i % workers != worker or path in self.skip:
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    x = self.transform(decode_image(f))
+                yield x, path, label, ''
+            except Exception as e:
+                yield torch.zeros(3, CROP, CROP), path, label, repr(e)
+
+
+class Writer:
+    def __init__(self, path: str):
+        self.path = path
+        self.csv = path.endswith('.csv')
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a', encoding='utf-8', newline='')
+        if self.csv:
+            self.writer = csv.DictWriter(self.file, CSV_FIELDS)
+            if new:
+                self.writer.writeheader()
+
+    def write(self, row: dict) -> None:
+        if self.csv:
+            self.writer.writerow({**row, 'top3': '|'.join(f"{c}:{p:.4f}" for c, p in row['top3'])})
+        else:
+            self.file.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+    # After every batch, so an interrupted run keeps every finished row
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+# Rows already in the output (a torn last line from a kill is cut off first)
+def read_done(path: str) -> Iterator[dict]:
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end != len(data):
+            f.truncate(end)
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+# Confusion matrix over the model's classes; labels that are not a class are only counted
+class Evaluation:
+    def __init__(self, classes: List[str]):
+        self.classes = classes
+        self.index = {name: i for i, name in enumerate(classes)}
+        self.confusion = torch.zeros(len(classes), len(classes), dtype=torch.long)
+        self.unknown = 0
+
+    def add(self, label: str, prediction: str) -> None:
+        if not label:
+            return
+        if label not in self.index or prediction not in self.index:
+            self.unknown += 1
+            return
+        self.confusion[self.index[label], self.index[prediction]] += 1
+
+    @property
+    def total(self) -> int:
+        return int(self.confusion.sum())
+
+    def per_class(self) -> Dict[str, dict]:
+        tp = self.confusion.diag().double()
+        predicted = self.confusion.sum(dim=0).double()
+        actual = self.confusion.sum(dim=1).double()
+        precision = torch.where(predicted > 0, tp / predicted.clamp(min=1), torch.zeros_like(tp))
+        recall = torch.where(actual > 0, tp / actual.clamp(min=1), torch.zeros_like(tp))
+        return {name: {'precision': float(precision[i]), 'recall': float(recall[i]), 'support': int(actual[i])}
+                for i, name in enumerate(self.classes) if actual[i] or predicted[i]}
+
+    def report(self, confusion_path: Optional[str] = None, top_confusions: int = 10) -> None:
+        if not self.total:
+            logger.info(f"No labelled images to evaluate ({self.unknown} with labels outside the classes)")
+            return
+        accuracy = float(self.confusion.diag().sum()) / self.total
+        logger.info(f"Accuracy {accuracy:.4f} on {self.total} labelled images"
+                    + (f", {self.unknown} skipped with labels outside the classes" if self.unknown else ""))
+        stats = self.per_class()
+        print(f"{'class':<28}{'precision':>10}{'recall':>10}{'support':>9}")
+        for name, s in sorted(stats.items(), key=lambda item: item[1]['recall']):
+            print(f"{name:<28}{s['precision']:>10.3f}{s['recall']:>10.3f}{s['support']:>9}")
+
+        off = self.confusion.clone()
+        off.fill_diagonal_(0)
+        values, flat = off.flatten().topk(min(top_confusions, off.numel()))
+        pairs = [(self.classes[i // len(self.classes)], self.classes[i % len(self.classes)], int(v))
+                 for v, i in zip(values.tolist(), flat.tolist()) if v]
+        if pairs:
+            print("\nMost confused (label -> prediction):")
+            for label, prediction, n in pairs:
+                print(f"  {label} -> {prediction}: {n}")
+
+        if confusion_path:
+            with open(confusion_path, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['label'] + self.classes)
+                for name, row in zip(self.classes, self.confusion.tolist()):
+                    writer.writerow([name] + row)
+            logger.info(f"Confusion matrix written to {confusion_path}")
+
+
+def classify(service, dataset: ImageStream, output: str, batch_size: int, workers: int,
+             evaluation: Evaluation) -> None:
+    done = set()
+    for row in read_done(output):
+        done.add(row['path'])
+        if not row.get('error'):
+            evaluation.add(row.get('label') or '', row['prediction'])
+    if done:
+        logger.info(f"Resuming: {len(done)} images already in {output}")
+
+    dataset.skip = done
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=workers)
+    writer = Writer(output)
+    count, start = 0, time.perf_counter()
+    try:
+        for x, paths, labels, errors in loader:
+            probs = service._forward(x)
+            top = torch.topk(probs, k=3)
+            for i, path in enumerate(paths):
+                if errors[i]:
+                    writer.write({'path': path, 'label': labels[i], 'prediction': '', 'confidence': 0.0,
+                                  'top3': [], 'error': errors[i]})
+                    continue
+                top3 = [(service.classes[c], round(float(p), 4))
+                        for c, p in zip(top.indices[i].tolist(), top.values[i].tolist())]
+                writer.write({'path': path, 'label': labels[i], 'prediction': top3[0][0],
+                              'confidence': top3[0][1], 'top3': top3, 'error': ''})
+                evaluation.add(labels[i], top3[0][0])
+            writer.flush()
+            count += len(paths)
+            if count % (batch_size * 10) < batch_size:
+                logger.info(f"{count} images ({count / (time.perf_counter() - start):.1f} img/s)")
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    logger.info(f"Classified {count} images in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.1f} img/s)")
+
+
+def main() -> None:
+    # Not src.config: that builds the bot and needs BOT_TOKEN and DB_LITE. Same env names and defaults.
+    from dotenv import load_dotenv
+    from src.model.model import FoodClassificationService
+    from src.training.data import CLASSES_PATH
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Classify a folder or manifest of images into JSONL/CSV")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--images', help="Folder of images (searched recursively)")
+    source.add_argument('--manifest', help="JSONL with path/label or 'path[,label]' per line")
+    parser.add_argument('--labels-from-dirs', action='store_true', help="Parent folder name is the label")
+    parser.add_argument('--out', required=True, help="Output .jsonl or .csv; existing rows are skipped (resume)")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=4, help="Decode processes")
+    parser.add_argument('--threads', type=int, default=0, help="torch threads for the forward pass (0 = default)")
+    parser.add_argument('--model', default=os.getenv("MODEL_PATH", "src/model/vit_food_101.pth"))
+    parser.add_argument('--classes', default=CLASSES_PATH)
+    parser.add_argument('--variant', default=os.getenv("MODEL_VARIANT", "fp32"))
+    parser.add_argument('--variant-check-dir', default=os.getenv("VARIANT_CHECK_DIR") or None,
+                        help="Refuse the variant unless it agrees with fp32 on these images")
+    parser.add_argument('--variant-min-agreement', type=float,
+                        default=float(os.getenv("VARIANT_MIN_AGREEMENT", 0.98)))
+    parser.add_argument('--student', default=os.getenv("STUDENT_MODEL_PATH") or None,
+                        help="Cascade like the bot when set")
+    parser.add_argument('--student-arch', default=os.getenv("STUDENT_ARCH") or None)
+    parser.add_argument('--cascade-threshold', type=float, default=float(os.getenv("CASCADE_THRESHOLD", 0.9)))
+    parser.add_argument('--confusion', help="Write the confusion matrix to this CSV")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    service = FoodClassificationService(args.model, args.classes, variant=args.variant,
+                                        variant_check_dir=args.variant_check_dir,
+                                        variant_min_agreement=args.variant_min_agreement,
+                                        student_path=args.student, student_arch=args.student_arch,
+                                        cascade_threshold=args.cascade_threshold)
+    service.load()
+
+    dataset = ImageStream(service.transform, args.images, args.manifest, args.labels_from_dirs)
+    evaluation = Evaluation(service.classes)
+    classify(service, dataset, args.out, args.batch_size, args.workers, evaluation)
+    evaluation.report(args.confusion)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Optional, Tuple, Union
+
+import torch
+
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+QUEUE_DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+Runner = Union[Callable[[torch.Tensor], torch.Tensor], Callable[[torch.Tensor], Awaitable[torch.Tensor]]]
+
+
+# Collects single images into batches: up to max_batch_size items or max_wait_ms,
+# whichever comes first, then runs one forward pass off the event loop.
+# A sync runner is called in the executor, an async runner (e.g. a process pool) is awaited;
+# max_concurrency batches may be in flight at once.
+class BatchingEngine:
+    def __init__(self, runner: Runner, max_batch_size: int = 8, max_wait_ms: float = 10.0,
+                 executor: Optional[Executor] = None, max_concurrency: int = 1):
+        self.runner = runner
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.max_concurrency = max(1, max_concurrency)
+        self._is_async = asyncio.iscoroutinefunction(runner)
+        self._executor = executor or ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                        thread_name_prefix='inference')
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._inflight = set()
+
+        self.queue_depth = metrics.gauge('inference_queue_depth')
+        self.queue_depth_hist = metrics.histogram('inference_queue_depth_at_submit', QUEUE_DEPTH_BUCKETS)
+        self.batch_size_hist = metrics.histogram('inference_batch_size', BATCH_SIZE_BUCKETS)
+
+    def start(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, x: torch.Tensor) -> torch.Tensor:
+        self.start()
+        fut = asyncio.get_running_loop().create_future()
+        self.queue_depth_hist.observe(self._queue.qsize())
+        self._queue.put_nowait((x, fut))
+        self.queue_depth.set(self._queue.qsize())
+        return await fut
+
+    async def _collect(self) -> List[Tuple[torch.Tensor, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                # Window is over, but take whatever is already waiting
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        self.queue_depth.set(self._queue.qsize())
+        # Callers that gave up (e.g. handler cancelled) don't need a forward pass
+        return [(x, fut) for x, fut in batch if not fut.done()]
+
+    async def _run(self) -> None:
+        while True:
+            # Don't collect the next batch until there is capacity to run it,
+            # so requests arriving meanwhile can join it
+            await self._slots.acquire()
+            try:
+                batch = await self._collect()
+            except BaseException:
+                self._slots.release()
+                raise
+            if not batch:
+                self._slots.release()
+                continue
+
+            task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _run_batch(self, batch: List[Tuple[torch.Tensor, asyncio.Future]]) -> None:
+        try:
+            self.batch_size_hist.observe(len(batch))
+            try:
+                xs = torch.stack([x for x, _ in batch])
+                if self._is_async:
+                    probs = await self.runner(xs)
+                else:
+                    probs = await asyncio.get_running_loop().run_in_executor(self._executor, self.runner, xs)
+            except Exception as e:
+                logger.error(f"Batch inference error: {e}")
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                return
+
+            for i, (_, fut) in enumerate(batch):
+                if not fut.done():
+                    fut.set_result(probs[i])
+        finally:
+            self._slots.release()
+            # Only left pending if the batch task itself was cancelled
+            for _, fut in batch:
+                if not fut.done():
+                    fut.cancel()
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'queue_depth_at_submit': self.queue_depth_hist.snapshot(),
+            'batch_size': self.batch_size_hist.snapshot(),
+        }
+
+    async def close(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        for task in list(self._inflight):
+            task.cancel()
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, fut = self._queue.get_nowait()
+                if not fut.done():
+                    fut.cancel()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,198 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from PIL import Image
+
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+BANDS = 4
+BAND_BITS = HASH_BITS // BANDS
+
+
+# 64-bit difference hash: survives recompression and resizing of the same picture
+def dhash(img: Image.Image) -> int:
+    small = img.convert('L').resize((9, 8), Image.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def _bands(h: int) -> List[Tuple[int, int]]:
+    mask = (1 << BAND_BITS) - 1
+    return [(i, (h >> (i * BAND_BITS)) & mask) for i in range(BANDS)]
+
+
+# LRU + TTL cache of top-3 predictions. Exact key is Telegram's file_unique_id;
+# optionally near-duplicates are found by dHash within max_distance bits.
+# Hashes are split into 4 bands, so any hash within 3 bits shares at least one band exactly.
+# The SQLite copy is written by a background thread in batches, never on the event loop.
+class PredictionCache:
+    def __init__(self, max_entries: int = 10000, ttl: float = 7 * 24 * 3600, phash: bool = False,
+                 max_distance: int = 3, db_path: Optional[str] = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.phash = phash
+        self.max_distance = min(max_distance, BANDS - 1)
+        self._entries: "OrderedDict[str, Tuple[float, list, Optional[int]]]" = OrderedDict()
+        self._band_index: Dict[Tuple[int, int], Set[str]] = {}
+
+        self.hits = metrics.counter('prediction_cache_hits')
+        self.near_hits = metrics.counter('prediction_cache_near_hits')
+        self.misses = metrics.counter('prediction_cache_misses')
+        self.evictions = metrics.counter('prediction_cache_evictions')
+        self.size = metrics.gauge('prediction_cache_size')
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._writes: "queue.Queue[Optional[Tuple[str, tuple]]]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        if db_path:
+            self._open_db(db_path)
+            self._writer = threading.Thread(target=self._write_loop, name='prediction-cache-writer', daemon=True)
+            self._writer.start()
+
+    def _open_db(self, db_path: str) -> None:
+        # Written to from the writer thread after the restore below
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        # Losing the last few writes on a crash is fine for a cache
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS prediction_cache "
+            "(key TEXT PRIMARY KEY, hash TEXT, result TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        self._db.execute("DELETE FROM prediction_cache WHERE expires < ?", (time.time(),))
+        rows = self._db.execute(
+            "SELECT key, hash, result, expires FROM prediction_cache ORDER BY expires DESC LIMIT ?",
+            (self.max_entries,)
+        ).fetchall()
+        for key, h, result, expires in reversed(rows):
+            self._store(key, json.loads(result), int(h, 16) if h else None, expires)
+        self._db.commit()
+        logger.info(f"Prediction cache restored {len(rows)} entries from {db_path}")
+
+    def _store(self, key: str, result: list, h: Optional[int], expires: float) -> None:
+        if key in self._entries:
+            self._unindex(key)
+        self._entries[key] = (expires, result, h)
+        self._entries.move_to_end(key)
+        if h is not None:
+            for band in _bands(h):
+                self._band_index.setdefault(band, set()).add(key)
+
+    def _unindex(self, key: str) -> None:
+        _, _, h = self._entries[key]
+        if h is None:
+            return
+        for band in _bands(h):
+            keys = self._band_index.get(band)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._band_index[band]
+
+    def _remove(self, key: str) -> None:
+        self._unindex(key)
+        del self._entries[key]
+        if self._db is not None:
+            self._writes.put(("DELETE FROM prediction_cache WHERE key = ?", (key,)))
+
+    # Everything queued since the last commit goes in one transaction; None stops the thread
+    def _write_loop(self) -> None:
+        stop = False
+        while not stop:
+            batch = [self._writes.get()]
+            while True:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            try:
+                for sql, params in (op for op in batch if op is not None):
+                    self._db.execute(sql, params)
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Prediction cache write failed: {e}")
+
+    def _lookup(self, key: str) -> Optional[list]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    # With phash on, a miss here is not final: get_similar() decides between near hit and miss
+    def get(self, key: str) -> Optional[list]:
+        result = self._lookup(key)
+        if result is not None:
+            self.hits.inc()
+        elif not self.phash:
+            self.misses.inc()
+        return result
+
+    # Closest unexpired entry within max_distance bits (expired ones are dropped on the way)
+    def get_similar(self, h: int) -> Optional[list]:
+        candidates = set()
+        for band in _bands(h):
+            candidates |= self._band_index.get(band, set())
+
+        by_distance = sorted((bin(self._entries[key][2] ^ h).count('1'), key) for key in candidates)
+        for distance, key in by_distance:
+            if distance > self.max_distance:
+                break
+            result = self._lookup(key)
+            if result is not None:
+                self.near_hits.inc()
+                return result
+        self.misses.inc()
+        return None
+
+    def put(self, key: str, result: list, h: Optional[int] = None) -> None:
+        expires = time.time() + self.ttl
+        self._store(key, result, h, expires)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions.inc()
+        self.size.set(len(self._entries))
+
+        if self._db is not None:
+            self._writes.put((
+                "INSERT OR REPLACE INTO prediction_cache (key, hash, result, expires) VALUES (?, ?, ?, ?)",
+                (key, format(h, 'x') if h is not None else None, json.dumps(result), expires)
+            ))
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits.value,
+            'near_hits': self.near_hits.value,
+            'misses': self.misses.value,
+            'evictions': self.evictions.value,
+        }
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,109 @@
+import argparse
+import logging
+import os
+
+import torch
+from PIL import Image
+
+from src.model.variants import find_images
+
+logger = logging.getLogger(__name__)
+
+
+# For every candidate threshold t the student answers images with confidence >= t and the ViT the rest.
+# Returns the lowest t (fewest escalations) whose cascade accuracy reaches target_accuracy.
+def pick_threshold(confidence: torch.Tensor, student_correct: torch.Tensor, teacher_correct: torch.Tensor,
+                   target_accuracy: float) -> dict:
+    order = torch.argsort(confidence, descending=True)
+    conf = confidence[order]
+    student_ok = student_correct[order].float()
+    teacher_ok = teacher_correct[order].float()
+    n = conf.shape[0]
+
+    # accuracy[k]: the k most confident images stay with the student, the rest go to the ViT
+    zero = torch.zeros(1)
+    kept_student = torch.cat([zero, torch.cumsum(student_ok, 0)])
+    escalated_teacher = teacher_ok.sum() - torch.cat([zero, torch.cumsum(teacher_ok, 0)])
+    accuracy = (kept_student + escalated_teacher) / n
+
+    reached = bool((accuracy >= target_accuracy).any())
+    best = accuracy >= target_accuracy if reached else accuracy == accuracy.max()
+    k = int(best.nonzero()[-1])
+    # k == 0 means everything escalates: any threshold above the highest confidence
+    threshold = float(conf[k - 1]) if k else float(conf[0]) + 1e-6
+
+    return {
+        'threshold': threshold,
+        'accuracy': float(accuracy[k]),
+        'escalation_rate': (n - k) / n,
+        'student_accuracy': float(student_ok.mean()),
+        'teacher_accuracy': float(teacher_ok.mean()),
+        'target_reached': reached,
+    }
+
+
+def main() -> None:
+    # Not src.config: that builds the bot and needs BOT_TOKEN and DB_LITE. Same env names and defaults.
+    from dotenv import load_dotenv
+    from src.model.model import FoodClassificationService
+    from src.training.data import CLASSES_PATH
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Pick CASCADE_THRESHOLD for a target accuracy")
+    parser.add_argument('--val-dir', required=True, help="Folder with one sub-folder of images per class")
+    parser.add_argument('--target-accuracy', type=float, required=True, help="e.g. 0.85")
+    parser.add_argument('--model', default=os.getenv("MODEL_PATH", "src/model/vit_food_101.pth"))
+    parser.add_argument('--classes', default=CLASSES_PATH)
+    parser.add_argument('--variant', default=os.getenv("MODEL_VARIANT", "fp32"), help="ViT variant the bot serves")
+    parser.add_argument('--variant-check-dir', default=os.getenv("VARIANT_CHECK_DIR") or None)
+    parser.add_argument('--variant-min-agreement', type=float,
+                        default=float(os.getenv("VARIANT_MIN_AGREEMENT", 0.98)))
+    parser.add_argument('--student', default=os.getenv("STUDENT_MODEL_PATH") or None)
+    parser.add_argument('--arch', default=os.getenv("STUDENT_ARCH") or None)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--limit', type=int, default=0)
+    args = parser.parse_args()
+
+    service = FoodClassificationService(args.model, args.classes, variant=args.variant,
+                                        variant_check_dir=args.variant_check_dir,
+                                        variant_min_agreement=args.variant_min_agreement,
+                                        student_path=args.student, student_arch=args.arch)
+    service.load()
+    if service.student is None:
+        raise SystemExit("A student model is required (--student or STUDENT_MODEL_PATH)")
+
+    index = {name: i for i, name in enumerate(service.classes)}
+    paths = [p for p in find_images(args.val_dir, args.limit) if p.parent.name in index]
+    if not paths:
+        raise SystemExit(f"No images in {args.val_dir} under folders named after the classes")
+
+    confidence, student_correct, teacher_correct = [], [], []
+    with torch.no_grad():
+        for i in range(0, len(paths), args.batch_size):
+            chunk = paths[i:i + args.batch_size]
+            x = torch.stack([service.transform(Image.open(p)) for p in chunk])
+            labels = torch.tensor([index[p.parent.name] for p in chunk])
+
+            student = torch.softmax(service.student(x), dim=1)
+            teacher = service.model(x)
+            confidence.append(student.max(dim=1).values)
+            student_correct.append(student.argmax(dim=1) == labels)
+            teacher_correct.append(teacher.argmax(dim=1) == labels)
+            logger.info(f"{min(i + args.batch_size, len(paths))}/{len(paths)} images")
+
+    result = pick_threshold(torch.cat(confidence), torch.cat(student_correct), torch.cat(teacher_correct),
+                            args.target_accuracy)
+    if not result['target_reached']:
+        logger.warning(f"Target accuracy {args.target_accuracy} is not reachable, using the best threshold")
+    logger.info(f"Student accuracy {result['student_accuracy']:.3f}, ViT accuracy {result['teacher_accuracy']:.3f}")
+    logger.info(f"CASCADE_THRESHOLD={result['threshold']:.4f}: cascade accuracy {result['accuracy']:.3f}, "
+                f"escalation rate {result['escalation_rate']:.1%}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
@@ -1,24 +1,129 @@
+import asyncio
 import logging
 import os
-from typing import List
+import time
+from functools import partial
+from typing import List, Optional
 
 import torch
 import torch.nn as nn
 from PIL import Image
-from torchvision import models, transforms
+from torchvision import models
+
+from src import metrics
+from src.model.batching import BatchingEngine
+from src.model.preprocess import to_tensor
+from src.model.student import build_student, load_student
+from src.model.variants import VariantRejected, build_variant, check_variant, variant_path
+from src.model.workers import InferencePool
 
 logger = logging.getLogger(__name__)
 
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+# ViT-B/16 with the two-layer head from ViT_improved (src.training.train trains exactly this)
+def build_vit(num_classes: int, weights=None) -> nn.Module:
+    model = models.vit_b_16(weights=weights)
+    in_features = model.heads.head.in_features
+    model.heads.head = nn.Sequential(
+        nn.Linear(in_features, 512),
+        nn.ReLU(),
+        nn.Dropout(0.4),
+        nn.Linear(512, num_classes)
+    )
+    return model
+
 
 # Model like in ViT_improved
 class FoodClassificationService:
-    def __init__(self, model_path: str, classes_path: str):
+    def __init__(self, model_path: str, classes_path: str, max_batch_size: int = 1, max_wait_ms: float = 0.0,
+                 workers: int = 0, threads_per_worker: int = 0, variant: str = 'fp32',
+                 variant_check_dir: Optional[str] = None, variant_min_agreement: float = 0.98,
+                 student_path: Optional[str] = None, student_arch: Optional[str] = None,
+                 cascade_threshold: float = 0.9):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.model_path = model_path
+        self.variant = variant
+        self.variant_check = (variant_check_dir, variant_min_agreement)
+        self.student_path = student_path
+        self.student_arch = student_arch
+        self.cascade_threshold = cascade_threshold
         self.classes = self._load_classes(classes_path)
-        self.model = self._load_model(model_path)
         self.transform = self._get_transform()
 
-        logger.info(f"Model loaded on device: {self.device}")
+        # The model itself is built by load()/ensure_loaded(), so importing config stays cheap
+        self.model = None
+        self.student = None
+        self._loading: Optional[asyncio.Future] = None
+
+        self.student_latency = metrics.histogram('cascade_student_seconds', LATENCY_BUCKETS)
+        self.teacher_latency = metrics.histogram('cascade_teacher_seconds', LATENCY_BUCKETS)
+        self.cascade_images = metrics.counter('cascade_images')
+        self.cascade_escalations = metrics.counter('cascade_escalations')
+        # Predictions dropped because top-1 is under 50%
+        self.low_confidence = metrics.counter('low_confidence_rejections')
+
+        # workers > 0: the model lives only in worker processes, this one just batches and preprocesses
+        self.pool = None
+        if workers > 0:
+            options = {
+                'variant': variant,
+                'variant_check_dir': variant_check_dir,
+                'variant_min_agreement': variant_min_agreement,
+                'student_path': student_path,
+                'student_arch': student_arch,
+                'cascade_threshold': cascade_threshold,
+            }
+            self.pool = InferencePool(model_path, classes_path, len(self.classes),
+                                      workers, threads_per_worker, max_batch_size, options)
+            self.engine = BatchingEngine(self.pool.run, max_batch_size, max_wait_ms, max_concurrency=workers)
+            logger.info(f"Inference delegated to {workers} worker processes")
+        else:
+            self.engine = BatchingEngine(self._forward, max_batch_size, max_wait_ms)
+
+    # Builds the in-process model; blocking, so async code goes through ensure_loaded()
+    def load(self) -> None:
+        if self.model is not None or self.pool is not None:
+            return
+        start = time.perf_counter()
+        model = self._load_model(self.model_path)
+        if self.variant != 'fp32':
+            model = self._apply_variant(model, self.model_path, *self.variant_check)
+        if self.student_path:
+            try:
+                self.student = load_student(self.student_path, len(self.classes), self.student_arch, self.device)
+            except Exception as e:
+                logger.error(f"Failed to load student model, cascade disabled: {e}")
+        self.model = model
+        logger.info(f"Model ({self.variant}) loaded on device: {self.device} "
+                    f"in {time.perf_counter() - start:.1f}s")
+
+    # Starts loading in the background on first call; every caller awaits the same load
+    async def ensure_loaded(self) -> None:
+        if self.pool is not None:
+            self.pool.start()
+            return
+        if self.model is not None:
+            return
+        if self._loading is None:
+            self._loading = asyncio.get_running_loop().run_in_executor(None, self.load)
+            self._loading.add_done_callback(self._loading_done)
+        await asyncio.shield(self._loading)
+
+    # A failed load is forgotten, so the next photo tries again instead of re-raising the same error
+    def _loading_done(self, fut: asyncio.Future) -> None:
+        if fut.cancelled() or fut.exception() is not None:
+            self._loading = None
+
+    def start_loading(self) -> None:
+        self._loader_task = asyncio.get_running_loop().create_task(self.ensure_loaded())
+        self._loader_task.add_done_callback(self._log_load_failure)
+
+    @staticmethod
+    def _log_load_failure(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Background model load failed, retrying on the next photo: {task.exception()!r}")
 
     def _load_classes(self, classes_path: str) -> List[str]:
         with open(classes_path, 'r', encoding='utf-8') as f:
@@ -26,24 +131,37 @@ class FoodClassificationService:
         logger.info(f"Loaded {len(classes)} classes")
         return classes
 
+    # Memory-mapped and weights-only: pages come from the page cache on demand
+    # and are shared by every process that maps the same checkpoint
+    def _load_checkpoint(self, model_path: str):
+        try:
+            return torch.load(model_path, map_location='cpu', mmap=True, weights_only=True)
+        except RuntimeError:
+            # Legacy (non-zip) checkpoints can't be mmap'd
+            return torch.load(model_path, map_location='cpu', weights_only=True)
+
     def _load_model(self, model_path: str) -> nn.Module:
-        model = models.vit_b_16(weights=None)
-        num_classes = len(self.classes)
-        in_features = model.heads.head.in_features
-
-        model.heads.head = nn.Sequential(
-            nn.Linear(in_features, 512),
-            nn.ReLU(),
-            nn.Dropout(0.4),
-            nn.Linear(512, num_classes)
-        )
-
-        if os.path.exists(model_path):
-            checkpoint = torch.load(model_path, map_location=self.device)
+        checkpoint = self._load_checkpoint(model_path) if os.path.exists(model_path) else None
+
+        # A distilled student (src.training.distill) records its architecture and is a drop-in replacement
+        if isinstance(checkpoint, dict) and 'arch' in checkpoint:
+            with torch.device('meta'):
+                model = build_student(checkpoint['arch'], len(self.classes))
+            model.load_state_dict(checkpoint['model_state_dict'], assign=True)
+            logger.info(f"Serving {checkpoint['arch']} student from {model_path}")
+            model.to(self.device)
+            model.eval()
+            return model
+
+        # With a checkpoint there is no point in random init: build on meta and assign the loaded tensors
+        with torch.device('meta' if checkpoint is not None else 'cpu'):
+            model = build_vit(len(self.classes))
+
+        if checkpoint is not None:
             if isinstance(checkpoint, dict) and 'model_state_dict' in checkpoint:
-                model.load_state_dict(checkpoint['model_state_dict'])
+                model.load_state_dict(checkpoint['model_state_dict'], assign=True)
             else:
-                model.load_state_dict(checkpoint)
+                model.load_state_dict(checkpoint, assign=True)
         else:
             logger.warning(f"Model file {model_path} not found. Using untrained model.")
 
@@ -51,33 +169,96 @@ class FoodClassificationService:
         model.eval()
         return model
 
+    # Swaps the fp32 model for the configured variant, unless it drifts from fp32 on the check images
+    def _apply_variant(self, model: nn.Module, model_path: str, check_dir: Optional[str],
+                       min_agreement: float) -> nn.Module:
+        if self.device.type != 'cpu':
+            logger.warning(f"Model variant {self.variant} is CPU-only, keeping fp32 on {self.device}")
+            self.variant = 'fp32'
+            return model
+
+        try:
+            candidate = build_variant(model, self.variant, variant_path(model_path, self.variant), model_path)
+            if check_dir:
+                result = check_variant(model, candidate, check_dir, self.transform, min_agreement)
+                logger.info(f"Variant {self.variant} agrees with fp32: "
+                            f"top-1 {result['top1']:.3f}, top-3 {result['top3']:.3f} on {result['images']} images")
+            return candidate
+        except VariantRejected as e:
+            logger.error(f"Model variant {self.variant} refused, using fp32: {e}")
+        except Exception as e:
+            logger.error(f"Failed to build model variant {self.variant}, using fp32: {e}")
+        self.variant = 'fp32'
+        return model
+
     def _get_transform(self):
         mean = [0.485, 0.456, 0.406]
         std = [0.229, 0.224, 0.225]
 
-        return transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize(mean, std),
-        ])
+        # Resize(256) + CenterCrop(224) + ToTensor + Normalize without intermediate PIL copies
+        return partial(to_tensor, resize=256, crop=224, mean=mean, std=std)
+
+    def _preprocess(self, img: Image.Image) -> torch.Tensor:
+        return self.transform(img)
 
+    # Runs in the engine's worker thread, never on the event loop.
+    # With a student model, only images it is unsure about (top-1 < cascade_threshold) reach the ViT.
+    def _forward(self, x: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad(), metrics.timer('model_forward_seconds'):
+            x = x.to(self.device)
+            if self.student is None:
+                return torch.nn.functional.softmax(self.model(x), dim=1).cpu()
+
+            start = time.perf_counter()
+            probs = torch.nn.functional.softmax(self.student(x), dim=1)
+            self.student_latency.observe(time.perf_counter() - start)
+
+            hard = probs.max(dim=1).values < self.cascade_threshold
+            escalated = int(hard.sum())
+            self.cascade_images.inc(x.shape[0])
+            self.cascade_escalations.inc(escalated)
+            if escalated:
+                start = time.perf_counter()
+                probs[hard] = torch.nn.functional.softmax(self.model(x[hard]), dim=1)
+                self.teacher_latency.observe(time.perf_counter() - start)
+            return probs.cpu()
+
+    def cascade_stats(self) -> dict:
+        images = self.cascade_images.value
+        return {
+            'images': images,
+            'escalation_rate': self.cascade_escalations.value / images if images else 0.0,
+            'student_seconds': self.student_latency.snapshot(),
+            'teacher_seconds': self.teacher_latency.snapshot(),
+        }
+
+    def _top3(self, probs: torch.Tensor):
+        topk = torch.topk(probs, k=3)
+        results = []
+        for i, idx in enumerate(topk.indices.tolist()):
+            res = {'class': self.classes[idx], 'confidence': float(topk.values[i].item() * 100), 'rank': i + 1}
+            results.append(res)
+        if results[0]['confidence'] < 50:
+            self.low_confidence.inc()
+            return None
+        return results
+
+    # Stages: preprocess (in the executor), inference (batching wait + forward pass, also in worker processes)
+    @metrics.timed('predict_pil_seconds')
     async def predict_pil(self, img: Image.Image):
         try:
-            img = img.convert('RGB')
-            x = self.transform(img).unsqueeze(0)
-
-            with torch.no_grad():
-                out = self.model(x)
-                probs = torch.nn.functional.softmax(out, dim=1)[0]
-                topk = torch.topk(probs, k=3)
-                results = []
-                for i, idx in enumerate(topk.indices.tolist()):
-                    res = {'class': self.classes[idx], 'confidence': float(topk.values[i].item() * 100), 'rank': i + 1}
-                    results.append(res)
-                if results[0]['confidence'] < 50:
-                    return None
-                return results
+            loop = asyncio.get_running_loop()
+            with metrics.timer('photo_preprocess_seconds'):
+                x = await loop.run_in_executor(None, self._preprocess, img)
+            await self.ensure_loaded()
+            with metrics.timer('inference_seconds'):
+                probs = await self.engine.submit(x)
+            return self._top3(probs)
         except Exception as e:
             logger.error(f"Predict error: {e}")
             return None
+
+    async def close(self) -> None:
+        await self.engine.close()
+        if self.pool is not None:
+            await self.pool.close()
@@ -0,0 +1,73 @@
+import math
+from io import BytesIO
+from typing import BinaryIO, List, Sequence
+
+import numpy as np
+import torch
+from PIL import Image
+from aiogram import Bot
+from aiogram.types import PhotoSize
+
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+RESIZE = 256
+CROP = 224
+
+
+# Smallest Telegram rendition whose short side still covers the resize target, else the largest one
+def select_photo(photos: List[PhotoSize], min_side: int = RESIZE) -> PhotoSize:
+    by_area = sorted(photos, key=lambda p: p.width * p.height)
+    for photo in by_area:
+        if min(photo.width, photo.height) >= min_side:
+            return photo
+    return by_area[-1]
+
+
+# Downloads into memory, nothing touches the disk
+async def download_photo(bot: Bot, photo: PhotoSize) -> BytesIO:
+    buffer = BytesIO()
+    await bot.download(photo, destination=buffer)
+    buffer.seek(0)
+    return buffer
+
+
+# For JPEGs, draft mode lets libjpeg decode at 1/2, 1/4 or 1/8 scale (DCT scaling),
+# picking the smallest scale that still keeps the short side >= short_side
+def decode_image(data: BinaryIO, short_side: int = RESIZE) -> Image.Image:
+    img = Image.open(data)
+    if img.format == 'JPEG':
+        w, h = img.size
+        scale = short_side / min(w, h)
+        if scale < 1:
+            img.draft('RGB', (math.ceil(w * scale), math.ceil(h * scale)))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.load()
+    return img
+
+
+# Same result as Resize(resize) + CenterCrop(crop) + ToTensor + Normalize, with one PIL resize
+# and the crop/normalize done on a NumPy view instead of intermediate PIL images
+def to_tensor(img: Image.Image, resize: int = RESIZE, crop: int = CROP,
+              mean: Sequence[float] = MEAN, std: Sequence[float] = STD) -> torch.Tensor:
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    w, h = img.size
+    if w <= h:
+        size = (resize, int(resize * h / w))
+    else:
+        size = (int(resize * w / h), resize)
+    if size != (w, h):
+        img = img.resize(size, Image.BILINEAR)
+
+    pixels = np.asarray(img)
+    top = int(round((size[1] - crop) / 2.0))
+    left = int(round((size[0] - crop) / 2.0))
+    window = pixels[top:top + crop, left:left + crop].transpose(2, 0, 1)
+
+    # (x / 255 - mean) / std == (x - 255 * mean) / (255 * std), written into one float buffer
+    x = np.empty((3, crop, crop), dtype=np.float32)
+    np.subtract(window, np.array(mean, dtype=np.float32).reshape(3, 1, 1) * 255, out=x)
+    x /= np.array(std, dtype=np.float32).reshape(3, 1, 1) * 255
+    return torch.from_numpy(x)
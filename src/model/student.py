@@ -0,0 +1,111 @@
+import logging
+from typing import Optional
+
+import torch
+import torch.nn as nn
+from torchvision import models
+
+logger = logging.getLogger(__name__)
+
+
+# Simple CNN like in 1model
+class FoodCNN(nn.Module):
+    def __init__(self, num_classes):
+        super().__init__()
+        self.features = nn.Sequential(
+            nn.Conv2d(3, 32, 3, padding=1),
+            nn.BatchNorm2d(32),
+            nn.ReLU(),
+            nn.MaxPool2d(2),
+
+            nn.Conv2d(32, 64, 3, padding=1),
+            nn.BatchNorm2d(64),
+            nn.ReLU(),
+            nn.MaxPool2d(2),
+
+            nn.Conv2d(64, 128, 3, padding=1),
+            nn.BatchNorm2d(128),
+            nn.ReLU(),
+            nn.MaxPool2d(2),
+
+            nn.Conv2d(128, 256, 3, padding=1),
+            nn.BatchNorm2d(256),
+            nn.ReLU(),
+            nn.AdaptiveAvgPool2d((7, 7)),
+        )
+
+        self.classifier = nn.Sequential(
+            nn.Flatten(),
+            nn.Linear(256 * 7 * 7, 512),
+            nn.ReLU(),
+            nn.BatchNorm1d(512),
+            nn.Dropout(0.5),
+            nn.Linear(512, num_classes)
+        )
+
+    def forward(self, x):
+        x = self.features(x)
+        x = self.classifier(x)
+        return x
+
+
+def _head(in_features: int, num_classes: int) -> nn.Module:
+    return nn.Sequential(
+        nn.Linear(in_features, 512),
+        nn.ReLU(),
+        nn.Dropout(0.4),
+        nn.Linear(512, num_classes)
+    )
+
+
+# EfficientNet-B0 like in Efficientnet
+def _efficientnet_b0(num_classes: int) -> nn.Module:
+    model = models.efficientnet_b0(weights=None)
+    model.classifier[1] = _head(model.classifier[1].in_features, num_classes)
+    return model
+
+
+def _mobilenet_v3_small(num_classes: int) -> nn.Module:
+    model = models.mobilenet_v3_small(weights=None)
+    model.classifier[3] = _head(model.classifier[3].in_features, num_classes)
+    return model
+
+
+def _mobilenet_v3_large(num_classes: int) -> nn.Module:
+    model = models.mobilenet_v3_large(weights=None)
+    model.classifier[3] = _head(model.classifier[3].in_features, num_classes)
+    return model
+
+
+STUDENT_ARCHS = {
+    'efficientnet_b0': _efficientnet_b0,
+    'mobilenet_v3_small': _mobilenet_v3_small,
+    'mobilenet_v3_large': _mobilenet_v3_large,
+    'food_cnn': FoodCNN,
+}
+
+
+def build_student(arch: str, num_classes: int) -> nn.Module:
+    if arch not in STUDENT_ARCHS:
+        raise ValueError(f"Unknown student architecture {arch!r}, expected one of {list(STUDENT_ARCHS)}")
+    return STUDENT_ARCHS[arch](num_classes)
+
+
+# Accepts a plain state_dict (as saved by the notebooks) or a dict with 'model_state_dict';
+# an 'arch' key in the checkpoint (as written by the distillation script) wins over `arch`
+def load_student(model_path: str, num_classes: int, arch: Optional[str] = None,
+                 device: torch.device = torch.device('cpu')) -> nn.Module:
+    checkpoint = torch.load(model_path, map_location='cpu', weights_only=True)
+    state = checkpoint
+    if isinstance(checkpoint, dict) and 'model_state_dict' in checkpoint:
+        arch = checkpoint.get('arch', arch)
+        state = checkpoint['model_state_dict']
+    if arch is None:
+        raise ValueError(f"Student checkpoint {model_path} has no 'arch', set STUDENT_ARCH")
+
+    model = build_student(arch, num_classes)
+    model.load_state_dict(state)
+    model.to(device)
+    model.eval()
+    logger.info(f"Loaded {arch} student from {model_path}")
+    return model
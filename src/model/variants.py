@@ -0,0 +1,229 @@
+import argparse
+import copy
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional
+
+import torch
+import torch.nn as nn
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+VARIANTS = ('fp32', 'int8', 'torchscript', 'export', 'bf16')
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp'}
+
+
+class VariantRejected(Exception):
+    pass
+
+
+# bf16 matmuls are only fast with native support (AVX512-BF16 or AMX), otherwise they are emulated
+def bf16_supported() -> bool:
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+# Runs a bf16 copy of the model on fp32 inputs and returns fp32 logits
+class _Bf16Model(nn.Module):
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model.to(torch.bfloat16)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.model(x.to(torch.bfloat16)).float()
+
+
+def variant_path(model_path: str, variant: str) -> str:
+    extension = 'pt2' if variant == 'export' else 'pt'
+    return f"{os.path.splitext(model_path)[0]}.{variant}.{extension}"
+
+
+# What the cached variant was built from: a retrained checkpoint (or another torch) means a rebuild
+def _stamp(source: Optional[str]) -> dict:
+    stat = os.stat(source) if source and os.path.exists(source) else None
+    return {
+        'checkpoint': os.path.abspath(source) if source else None,
+        'size': stat.st_size if stat else None,
+        'mtime_ns': stat.st_mtime_ns if stat else None,
+        'torch': torch.__version__,
+    }
+
+
+def _cache_valid(cache_path: str, source: Optional[str]) -> bool:
+    try:
+        with open(cache_path + '.json', 'r') as f:
+            return os.path.exists(cache_path) and json.load(f) == _stamp(source)
+    except (OSError, ValueError):
+        return False
+
+
+# Written under a temporary name and moved into place, the stamp last
+def _save_cache(save: Callable[[str], None], cache_path: str, source: Optional[str]) -> None:
+    tmp = f"{cache_path}.{os.getpid()}.tmp"
+    save(tmp)
+    os.replace(tmp, cache_path)
+    with open(tmp, 'w') as f:
+        json.dump(_stamp(source), f)
+    os.replace(tmp, cache_path + '.json')
+
+
+# Inference workers start together: one of them builds the cache, the others wait and load it
+@contextmanager
+def _build_lock(cache_path: Optional[str]):
+    if not cache_path or fcntl is None:
+        yield
+        return
+    with open(cache_path + '.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# Builds `variant` from an eval-mode fp32 model. Traced variants are cached next to the checkpoint
+# (`source`) and loaded from there on the next start, as long as the checkpoint is unchanged;
+# the fp32 model is left untouched.
+def build_variant(model: nn.Module, variant: str, cache_path: Optional[str] = None,
+                  source: Optional[str] = None) -> nn.Module:
+    if variant not in VARIANTS:
+        raise ValueError(f"Unknown model variant {variant!r}, expected one of {VARIANTS}")
+
+    example = torch.randn(2, 3, 224, 224)
+
+    if variant == 'fp32':
+        return model
+
+    if variant == 'int8':
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    if variant == 'bf16':
+        if not bf16_supported():
+            raise VariantRejected("bf16 requested but the CPU has no native bf16 support")
+        return _Bf16Model(copy.deepcopy(model)).eval()
+
+    with _build_lock(cache_path):
+        if variant == 'torchscript':
+            if cache_path and _cache_valid(cache_path, source):
+                return torch.jit.load(cache_path, map_location='cpu')
+            with torch.no_grad():
+                traced = torch.jit.freeze(torch.jit.trace(model, example))
+            if cache_path:
+                _save_cache(partial(torch.jit.save, traced), cache_path, source)
+            return traced
+
+        # variant == 'export'
+        if cache_path and _cache_valid(cache_path, source):
+            return torch.export.load(cache_path).module()
+        batch = torch.export.Dim('batch', min=1, max=256)
+        with torch.no_grad():
+            program = torch.export.export(model, (example,), dynamic_shapes=({0: batch},))
+        if cache_path:
+            _save_cache(partial(torch.export.save, program), cache_path, source)
+        return program.module()
+
+
+def find_images(images_dir: str, limit: int = 0) -> List[Path]:
+    paths = sorted(p for p in Path(images_dir).rglob('*') if p.suffix.lower() in IMAGE_EXTENSIONS)
+    return paths[:limit] if limit else paths
+
+
+def _batches(paths: List[Path], transform: Callable, batch_size: int) -> Iterable[torch.Tensor]:
+    for i in range(0, len(paths), batch_size):
+        yield torch.stack([transform(Image.open(p).convert('RGB')) for p in paths[i:i + batch_size]])
+
+
+# Top-1 agreement: same argmax as fp32. Top-3 agreement: mean overlap of the two top-3 sets.
+def agreement(reference: nn.Module, candidate: nn.Module, batches: Iterable[torch.Tensor]) -> dict:
+    top1 = top3 = total = 0.0
+    with torch.no_grad():
+        for x in batches:
+            ref = reference(x).topk(3, dim=1).indices
+            cand = candidate(x).float().topk(3, dim=1).indices
+            top1 += (ref[:, 0] == cand[:, 0]).sum().item()
+            top3 += sum(len(set(r) & set(c)) / 3 for r, c in zip(ref.tolist(), cand.tolist()))
+            total += x.shape[0]
+    if not total:
+        raise VariantRejected("No images to check the variant against")
+    return {'top1': top1 / total, 'top3': top3 / total, 'images': int(total)}
+
+
+def check_variant(reference: nn.Module, candidate: nn.Module, images_dir: str, transform: Callable,
+                  min_agreement: float, limit: int = 200, batch_size: int = 16) -> dict:
+    paths = find_images(images_dir, limit)
+    result = agreement(reference, candidate, _batches(paths, transform, batch_size))
+    if result['top1'] < min_agreement or result['top3'] < min_agreement:
+        raise VariantRejected(
+            f"top-1 agreement {result['top1']:.3f}, top-3 agreement {result['top3']:.3f} "
+            f"on {result['images']} images, required {min_agreement}")
+    return result
+
+
+def _latency_ms(model: nn.Module, batch_size: int, runs: int = 10) -> float:
+    x = torch.randn(batch_size, 3, 224, 224)
+    with torch.no_grad():
+        model(x)
+        start = time.perf_counter()
+        for _ in range(runs):
+            model(x)
+    return (time.perf_counter() - start) / runs * 1000
+
+
+# Produces variant files next to the checkpoint and reports agreement and latency against fp32
+def main() -> None:
+    # Not src.config: that builds the bot and needs BOT_TOKEN and DB_LITE. Same env names and defaults.
+    from dotenv import load_dotenv
+    from src.model.model import FoodClassificationService
+    from src.training.data import CLASSES_PATH
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Build and check model variants")
+    parser.add_argument('--variant', choices=VARIANTS[1:], action='append', required=True)
+    parser.add_argument('--model', default=os.getenv("MODEL_PATH", "src/model/vit_food_101.pth"))
+    parser.add_argument('--classes', default=CLASSES_PATH)
+    parser.add_argument('--images', required=True, help="Held-out images to compare against fp32")
+    parser.add_argument('--min-agreement', type=float, default=0.98)
+    parser.add_argument('--limit', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=8)
+    args = parser.parse_args()
+
+    service = FoodClassificationService(args.model, args.classes)
+    service.load()
+    reference = service.model
+    logger.info(f"fp32: {_latency_ms(reference, args.batch_size):.1f} ms/batch of {args.batch_size}")
+
+    for variant in args.variant:
+        try:
+            model = build_variant(reference, variant, variant_path(args.model, variant), args.model)
+            result = check_variant(reference, model, args.images, service.transform,
+                                   args.min_agreement, args.limit)
+        except VariantRejected as e:
+            logger.error(f"{variant} rejected: {e}")
+            continue
+        latency = _latency_ms(model, args.batch_size)
+        logger.info(f"{variant}: top-1 {result['top1']:.3f}, top-3 {result['top3']:.3f}, "
+                    f"{latency:.1f} ms/batch of {args.batch_size}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
@@ -0,0 +1,219 @@
+import asyncio
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import torch.multiprocessing as mp
+
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+IMAGE_SHAPE = (3, 224, 224)
+
+
+# Entry point of a worker process: loads the checkpoint once and serves batches
+# that the parent has copied into its preallocated shared-memory slot.
+# Every result carries the metric increments of that batch (cascade counters, forward timings).
+def _worker_main(index: int, model_path: str, classes_path: str, num_threads: int, options: dict,
+                 inputs: torch.Tensor, outputs: torch.Tensor, tasks: mp.Queue, results: mp.Queue,
+                 metrics_enabled: bool = True) -> None:
+    from src.model.model import FoodClassificationService
+
+    metrics.set_enabled(metrics_enabled)
+    torch.set_num_threads(num_threads)
+    service = FoodClassificationService(model_path, classes_path, **options)
+    service.load()
+    metrics.take_deltas()
+    results.put(('ready', index, None, []))
+
+    while True:
+        job = tasks.get()
+        if job is None:
+            break
+        job_id, n = job
+        try:
+            outputs[:n].copy_(service._forward(inputs[:n]))
+            results.put((job_id, index, None, metrics.take_deltas()))
+        except Exception as e:
+            results.put((job_id, index, repr(e), metrics.take_deltas()))
+
+
+# Pool of K inference processes, each with its own torch thread budget.
+# Pixel data never goes through pickle: only (job_id, n) is sent over the queues.
+# Worker i owns slot i and its own task queue, so when a worker dies the pool knows which batch
+# was lost; the batch fails, the worker is replaced and the slot is reused only after that.
+class InferencePool:
+    # Deaths before 'ready' in a row after which the pool gives up (e.g. the checkpoint doesn't load)
+    MAX_RESTARTS = 3
+
+    def __init__(self, model_path: str, classes_path: str, num_classes: int,
+                 workers: int, threads_per_worker: int = 0, max_batch_size: int = 8,
+                 options: Optional[dict] = None):
+        self.model_path = model_path
+        self.classes_path = classes_path
+        self.num_classes = num_classes
+        self.workers = max(1, workers)
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // self.workers)
+        self.max_batch_size = max(1, max_batch_size)
+        # Keyword arguments for the FoodClassificationService built in each worker
+        self.options = options or {}
+
+        self._processes: List[mp.Process] = []
+        self._tasks: List[mp.Queue] = []
+        self._inputs: List[torch.Tensor] = []
+        self._outputs: List[torch.Tensor] = []
+        self._free: Optional[asyncio.Queue] = None
+        # job_id -> (future, slot, n); the slot stays taken until its worker answers or dies
+        self._pending: Dict[int, Tuple[asyncio.Future, int, int]] = {}
+        self._restarts: List[int] = []
+        self._ids = itertools.count()
+        self._reader: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._broken: Optional[Exception] = None
+        self._closed = False
+
+    def start(self) -> None:
+        if self._processes:
+            return
+        self._ctx = mp.get_context('spawn')
+        self._loop = asyncio.get_running_loop()
+        self._results = self._ctx.Queue()
+
+        # One slot per worker is enough: the batching engine never has more batches in flight
+        self._inputs = [torch.empty((self.max_batch_size, *IMAGE_SHAPE)).share_memory_()
+                        for _ in range(self.workers)]
+        self._outputs = [torch.empty((self.max_batch_size, self.num_classes)).share_memory_()
+                         for _ in range(self.workers)]
+        self._free = asyncio.Queue()
+        self._processes = [None] * self.workers
+        self._tasks = [None] * self.workers
+        self._restarts = [0] * self.workers
+        for slot in range(self.workers):
+            self._spawn(slot)
+            self._free.put_nowait(slot)
+
+        self._reader = threading.Thread(target=self._read_results, name='inference-results', daemon=True)
+        self._reader.start()
+        logger.info(f"Started {self.workers} inference workers, {self.threads_per_worker} threads each")
+
+    # A fresh task queue too: a job left in the dead worker's queue must not run twice
+    def _spawn(self, slot: int) -> None:
+        self._tasks[slot] = self._ctx.Queue()
+        p = self._ctx.Process(
+            target=_worker_main,
+            args=(slot, self.model_path, self.classes_path, self.threads_per_worker, self.options,
+                  self._inputs[slot], self._outputs[slot], self._tasks[slot], self._results, metrics.enabled),
+            daemon=True,
+        )
+        p.start()
+        self._processes[slot] = p
+
+    # Runs in a background thread and hands results and worker deaths back to the event loop
+    def _read_results(self) -> None:
+        checked = time.monotonic()
+        while not self._closed:
+            try:
+                job_id, slot, error, deltas = self._results.get(timeout=1)
+            except queue.Empty:
+                job_id = None
+            except (EOFError, OSError):
+                return
+
+            try:
+                if job_id == 'ready':
+                    self._loop.call_soon_threadsafe(self._ready, slot)
+                elif job_id is not None:
+                    metrics.merge(deltas)
+                    self._loop.call_soon_threadsafe(self._resolve, job_id, slot, error)
+                if job_id is None or time.monotonic() - checked >= 1:
+                    checked = time.monotonic()
+                    for slot, p in enumerate(list(self._processes)):
+                        if p is not None and not p.is_alive():
+                            self._loop.call_soon_threadsafe(self._worker_died, slot, p)
+            except RuntimeError:
+                # The event loop is gone
+                return
+
+    def _ready(self, slot: int) -> None:
+        self._restarts[slot] = 0
+        logger.info(f"Inference worker {slot} ready")
+
+    # The result is copied out before the slot is released, so the next batch can't overwrite it.
+    # A cancelled caller doesn't free the slot either: that only happens here, once the worker is done.
+    def _resolve(self, job_id: int, slot: int, error: Optional[str]) -> None:
+        fut, _, n = self._pending.pop(job_id, (None, None, 0))
+        if fut is None:
+            return
+        if not fut.done():
+            if error:
+                fut.set_exception(RuntimeError(error))
+            else:
+                fut.set_result(self._outputs[slot][:n].clone())
+        self._free.put_nowait(slot)
+
+    def _worker_died(self, slot: int, process: mp.Process) -> None:
+        if self._closed or self._processes[slot] is not process:
+            return
+        error = RuntimeError(f"Inference worker {slot} died (exit code {process.exitcode})")
+        for job_id, (fut, job_slot, _) in list(self._pending.items()):
+            if job_slot == slot:
+                del self._pending[job_id]
+                if not fut.done():
+                    fut.set_exception(error)
+                self._free.put_nowait(slot)
+        self._restarts[slot] += 1
+        if self._restarts[slot] > self.MAX_RESTARTS:
+            self._processes[slot] = None
+            self._broken = RuntimeError(f"{error}; gave up after {self.MAX_RESTARTS} restarts")
+            logger.error(f"{self._broken}, inference pool disabled")
+            self._fail_all(self._broken)
+            return
+        logger.error(f"{error}, restarting it")
+        self._spawn(slot)
+
+    def _fail_all(self, error: Exception) -> None:
+        if self._pending:
+            logger.error(f"{error}, failing {len(self._pending)} pending batches")
+        for fut, _, _ in self._pending.values():
+            if not fut.done():
+                fut.set_exception(error)
+        self._pending.clear()
+
+    async def run(self, xs: torch.Tensor) -> torch.Tensor:
+        self.start()
+        if self._broken is not None:
+            raise self._broken
+        n = xs.shape[0]
+        if n > self.max_batch_size:
+            raise ValueError(f"Batch of {n} exceeds pool slot size {self.max_batch_size}")
+
+        slot = await self._free.get()
+        if self._broken is not None:
+            self._free.put_nowait(slot)
+            raise self._broken
+        self._inputs[slot][:n].copy_(xs)
+        job_id = next(self._ids)
+        fut = self._loop.create_future()
+        self._pending[job_id] = (fut, slot, n)
+        self._tasks[slot].put((job_id, n))
+        return await fut
+
+    async def close(self) -> None:
+        if not self._processes:
+            return
+        self._closed = True
+        processes = [p for p in self._processes if p is not None]
+        for tasks in self._tasks:
+            tasks.put(None)
+        for p in processes:
+            await asyncio.get_running_loop().run_in_executor(None, p.join, 5)
+            if p.is_alive():
+                p.terminate()
+        self._processes = []
+        self._fail_all(RuntimeError("Inference pool closed"))
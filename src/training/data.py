@@ -0,0 +1,65 @@
+import os
+from typing import Callable, List, Optional, Tuple
+
+import torch
+from torch.utils.data import Dataset
+from torchvision import transforms
+
+from src.model.preprocess import CROP, MEAN, STD, decode_image, to_tensor
+
+CLASSES_PATH = "src/model/classes.txt"
+
+
+def load_classes(path: str = CLASSES_PATH) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# Reads meta/<split>.txt of the Food-101 layout ("apple_pie/1005649" per line) into (image path, label)
+# pairs. Labels follow src/model/classes.txt, the order the bot's checkpoint was trained with.
+def read_split(root: str, split: str, classes: List[str], limit: int = 0) -> List[Tuple[str, int]]:
+    index = {name: i for i, name in enumerate(classes)}
+    samples = []
+    with open(os.path.join(root, 'meta', f'{split}.txt'), 'r') as f:
+        for line in f:
+            name = line.strip()
+            if not name:
+                continue
+            label = name.split('/')[0]
+            samples.append((os.path.join(root, 'images', name + '.jpg'), index[label]))
+    return samples[:limit] if limit else samples
+
+
+# Same preprocessing as serving: draft-mode decode + Resize(256) + CenterCrop(224) + Normalize
+class EvalTransform:
+    def __call__(self, path: str) -> torch.Tensor:
+        with open(path, 'rb') as f:
+            return to_tensor(decode_image(f))
+
+
+class TrainTransform:
+    def __init__(self):
+        self.augment = transforms.Compose([
+            transforms.RandomResizedCrop(CROP, scale=(0.7, 1.0)),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize(MEAN, STD),
+        ])
+
+    def __call__(self, path: str) -> torch.Tensor:
+        with open(path, 'rb') as f:
+            return self.augment(decode_image(f))
+
+
+# Returns (image, label, position in the split), the position keys per-image caches such as teacher logits
+class ImageListDataset(Dataset):
+    def __init__(self, samples: List[Tuple[str, int]], transform: Optional[Callable[[str], torch.Tensor]] = None):
+        self.samples = samples
+        self.transform = transform or EvalTransform()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        path, label = self.samples[idx]
+        return self.transform(path), label, idx
@@ -0,0 +1,176 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import List, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from src.model.student import STUDENT_ARCHS, build_student
+from src.training.data import EvalTransform, ImageListDataset, TrainTransform, load_classes, read_split
+
+logger = logging.getLogger(__name__)
+
+
+def _samples_digest(samples: List[Tuple[str, int]], checkpoint: str) -> str:
+    digest = hashlib.sha1()
+    stat = os.stat(checkpoint) if os.path.exists(checkpoint) else None
+    digest.update(f"{checkpoint}:{stat.st_size if stat else 0}:{stat.st_mtime if stat else 0}".encode())
+    for path, label in samples:
+        digest.update(f"{path}:{label}\n".encode())
+    return digest.hexdigest()
+
+
+# Teacher logits for every image of the split, computed once on the eval transform and kept
+# as a float16 memmap (N x classes). Reused as long as the split and the checkpoint are unchanged.
+def cache_teacher_logits(teacher: nn.Module, samples: List[Tuple[str, int]], num_classes: int,
+                         cache_dir: str, checkpoint: str, batch_size: int, workers: int) -> np.memmap:
+    os.makedirs(cache_dir, exist_ok=True)
+    data_path = os.path.join(cache_dir, 'teacher_logits.f16')
+    meta_path = os.path.join(cache_dir, 'teacher_logits.json')
+    digest = _samples_digest(samples, checkpoint)
+
+    if os.path.exists(meta_path) and os.path.exists(data_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta.get('digest') == digest:
+            logger.info(f"Using cached teacher logits from {data_path}")
+            return np.memmap(data_path, dtype=np.float16, mode='r', shape=(len(samples), num_classes))
+
+    logits = np.memmap(data_path, dtype=np.float16, mode='w+', shape=(len(samples), num_classes))
+    loader = DataLoader(ImageListDataset(samples, EvalTransform()), batch_size=batch_size,
+                        num_workers=workers, shuffle=False)
+    start = time.perf_counter()
+    with torch.no_grad():
+        for x, _, idx in loader:
+            logits[idx.numpy()] = teacher(x).numpy().astype(np.float16)
+            done = int(idx[-1]) + 1
+            logger.info(f"Teacher logits {done}/{len(samples)} "
+                        f"({done / (time.perf_counter() - start):.1f} img/s)")
+    logits.flush()
+    with open(meta_path, 'w') as f:
+        json.dump({'digest': digest, 'count': len(samples), 'num_classes': num_classes}, f)
+    return np.memmap(data_path, dtype=np.float16, mode='r', shape=(len(samples), num_classes))
+
+
+# Hinton et al.: KL between softened distributions (scaled by T^2) plus cross-entropy on the labels
+def distillation_loss(student_logits: torch.Tensor, teacher_logits: torch.Tensor, labels: torch.Tensor,
+                      temperature: float, alpha: float) -> torch.Tensor:
+    soft = F.kl_div(F.log_softmax(student_logits / temperature, dim=1),
+                    F.log_softmax(teacher_logits / temperature, dim=1),
+                    log_target=True, reduction='batchmean') * temperature ** 2
+    hard = F.cross_entropy(student_logits, labels, label_smoothing=0.1)
+    return alpha * soft + (1 - alpha) * hard
+
+
+def evaluate(model: nn.Module, samples: List[Tuple[str, int]], batch_size: int, workers: int) -> float:
+    model.eval()
+    correct = total = 0
+    loader = DataLoader(ImageListDataset(samples, EvalTransform()), batch_size=batch_size, num_workers=workers)
+    with torch.no_grad():
+        for x, y, _ in loader:
+            correct += (model(x).argmax(dim=1) == y).sum().item()
+            total += y.shape[0]
+    return correct / total if total else 0.0
+
+
+def latency_ms(model: nn.Module, runs: int = 20) -> float:
+    model.eval()
+    x = torch.randn(1, 3, 224, 224)
+    with torch.no_grad():
+        model(x)
+        start = time.perf_counter()
+        for _ in range(runs):
+            model(x)
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def save_checkpoint(path: str, model: nn.Module, arch: str, classes: List[str], epoch: int, accuracy: float) -> None:
+    tmp = path + '.tmp'
+    torch.save({
+        'arch': arch,
+        'model_state_dict': model.state_dict(),
+        'classes': classes,
+        'epoch': epoch,
+        'accuracy': accuracy,
+    }, tmp)
+    os.replace(tmp, path)
+
+
+def main() -> None:
+    from src.model.model import FoodClassificationService
+
+    parser = argparse.ArgumentParser(description="Distill the ViT checkpoint into a small student")
+    parser.add_argument('--data-root', required=True, help="Food-101 folder with images/ and meta/")
+    parser.add_argument('--teacher', default="src/model/vit_food_101.pth")
+    parser.add_argument('--classes', default="src/model/classes.txt")
+    parser.add_argument('--arch', choices=list(STUDENT_ARCHS), default='mobilenet_v3_large')
+    parser.add_argument('--out', default="src/model/student.pth")
+    parser.add_argument('--cache-dir', default=".cache/distill")
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--temperature', type=float, default=4.0)
+    parser.add_argument('--alpha', type=float, default=0.9, help="Weight of the distillation term")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--limit', type=int, default=0, help="Use only the first N train/test images")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    classes = load_classes(args.classes)
+    train = read_split(args.data_root, 'train', classes, args.limit)
+    test = read_split(args.data_root, 'test', classes, args.limit)
+
+    teacher_service = FoodClassificationService(args.teacher, args.classes)
+    teacher_service.load()
+    teacher = teacher_service.model
+    logits = cache_teacher_logits(teacher, train, len(classes), args.cache_dir, args.teacher,
+                                  args.batch_size, args.workers)
+
+    # Teacher logits come from the centre crop, so augmentation stays mild
+    student = build_student(args.arch, len(classes))
+    optimizer = torch.optim.AdamW(student.parameters(), lr=args.lr, weight_decay=0.05)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=max(1, args.epochs))
+    loader = DataLoader(ImageListDataset(train, TrainTransform()), batch_size=args.batch_size,
+                        shuffle=True, num_workers=args.workers, drop_last=len(train) > args.batch_size)
+
+    best = -1.0
+    for epoch in range(args.epochs):
+        student.train()
+        running, seen, start = 0.0, 0, time.perf_counter()
+        for x, y, idx in loader:
+            teacher_logits = torch.from_numpy(logits[idx.numpy()].astype(np.float32))
+            loss = distillation_loss(student(x), teacher_logits, y, args.temperature, args.alpha)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            running += loss.item() * y.shape[0]
+            seen += y.shape[0]
+        scheduler.step()
+
+        accuracy = evaluate(student, test, args.batch_size, args.workers)
+        logger.info(f"Epoch {epoch + 1}: loss {running / max(seen, 1):.4f}, test accuracy {accuracy:.2%}, "
+                    f"{seen / (time.perf_counter() - start):.1f} img/s")
+        if accuracy > best:
+            best = accuracy
+            save_checkpoint(args.out, student, args.arch, classes, epoch, accuracy)
+            logger.info(f"Saved student to {args.out}")
+
+    teacher_ms, student_ms = latency_ms(teacher), latency_ms(student)
+    logger.info(f"Latency per image on CPU: ViT {teacher_ms:.1f} ms, {args.arch} {student_ms:.1f} ms "
+                f"({teacher_ms / student_ms:.1f}x faster), best student accuracy {best:.2%}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
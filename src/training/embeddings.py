@@ -0,0 +1,285 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Dataset
+
+from src.training.data import CLASSES_PATH, EvalTransform, ImageListDataset, load_classes, read_split
+from src.training.shards import ShardDataset
+
+logger = logging.getLogger(__name__)
+
+FEATURES_FILE = 'features.f16'
+INDEX_FILE = 'index.json'
+
+
+# The ViT split in two: `front` is frozen and cached once, `tail` is what gets trained.
+# train_blocks=0: the cache holds the final CLS embedding (after encoder.ln), only heads.head is trained.
+# train_blocks=k: the cache holds the tokens entering the last k encoder blocks, which are trained
+# together with encoder.ln and the head (the notebook's fine-tuning setup with k=4).
+class SplitViT:
+    def __init__(self, vit: nn.Module, train_blocks: int = 0):
+        self.vit = vit
+        self.layers = len(vit.encoder.layers)
+        if not 0 <= train_blocks <= self.layers:
+            raise ValueError(f"train_blocks must be between 0 and {self.layers}")
+        self.train_blocks = train_blocks
+        self.cut = self.layers - train_blocks
+
+    def feature_shape(self) -> Tuple[int, ...]:
+        dim = self.vit.hidden_dim
+        return (dim,) if self.train_blocks == 0 else (self.vit.seq_length, dim)
+
+    # Same steps as torchvision's VisionTransformer.forward, stopped at the cut
+    @torch.no_grad()
+    def front(self, x: torch.Tensor) -> torch.Tensor:
+        vit = self.vit
+        x = vit._process_input(x)
+        x = torch.cat([vit.class_token.expand(x.shape[0], -1, -1), x], dim=1)
+        x = vit.encoder.dropout(x + vit.encoder.pos_embedding)
+        for layer in vit.encoder.layers[:self.cut]:
+            x = layer(x)
+        if self.train_blocks == 0:
+            x = vit.encoder.ln(x)[:, 0]
+        return x
+
+    def tail(self) -> nn.Module:
+        return Tail(self.vit, self.cut, self.train_blocks)
+
+
+class Tail(nn.Module):
+    def __init__(self, vit: nn.Module, cut: int, train_blocks: int):
+        super().__init__()
+        self.train_blocks = train_blocks
+        if train_blocks:
+            self.layers = nn.Sequential(*list(vit.encoder.layers)[cut:])
+            self.ln = vit.encoder.ln
+        self.head = vit.heads.head
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.train_blocks:
+            x = self.ln(self.layers(x))[:, 0]
+        return self.head(x)
+
+
+def _digest(sources: List[str], checkpoint: str, train_blocks: int) -> str:
+    digest = hashlib.sha1()
+    stat = os.stat(checkpoint) if os.path.exists(checkpoint) else None
+    digest.update(f"{checkpoint}:{stat.st_size if stat else 0}:{stat.st_mtime if stat else 0}:".encode())
+    digest.update(f"{train_blocks}\n".encode())
+    for source in sources:
+        digest.update(f"{source}\n".encode())
+    return digest.hexdigest()
+
+
+def _read_index(directory: str) -> Optional[dict]:
+    path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _write_index(directory: str, index: dict) -> None:
+    tmp = os.path.join(directory, INDEX_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, os.path.join(directory, INDEX_FILE))
+
+
+# Runs the frozen front over `dataset` (eval crop, no augmentation) into a float16 memmap.
+# Keyed by the images, the checkpoint and the cut; labels are not part of it, so a new class
+# list or relabelled data reuses the features. Progress is recorded, an interrupted run resumes.
+def build_cache(split_vit: SplitViT, dataset: Dataset, sources: List[str], directory: str, checkpoint: str,
+                batch_size: int = 64, workers: int = 4, device: torch.device = torch.device('cpu')) -> np.memmap:
+    os.makedirs(directory, exist_ok=True)
+    digest = _digest(sources, checkpoint, split_vit.train_blocks)
+    shape = (max(1, len(dataset)),) + split_vit.feature_shape()
+    path = os.path.join(directory, FEATURES_FILE)
+    index = _read_index(directory)
+
+    if index is not None and index['digest'] == digest and index['done'] == index['count']:
+        logger.info(f"Using cached features from {path}")
+        return np.memmap(path, dtype=np.float16, mode='r', shape=shape)
+    if index is not None and index['digest'] == digest:
+        features = np.memmap(path, dtype=np.float16, mode='r+', shape=shape)
+        logger.info(f"Resuming {path} at {index['done']}/{index['count']}")
+    else:
+        index = {'count': len(dataset), 'shape': list(shape[1:]), 'digest': digest, 'done': 0,
+                 'train_blocks': split_vit.train_blocks}
+        features = np.memmap(path, dtype=np.float16, mode='w+', shape=shape)
+        size_mb = features.nbytes / 2 ** 20
+        logger.info(f"Caching {len(dataset)} x {list(shape[1:])} float16 features ({size_mb:.0f} MB) in {path}")
+
+    done = index['done']
+    remaining = torch.utils.data.Subset(dataset, range(done, len(dataset)))
+    loader = DataLoader(remaining, batch_size=batch_size, num_workers=workers)
+    split_vit.vit.eval()
+    start = time.perf_counter()
+    for batch in loader:
+        x = batch[0]
+        features[done:done + x.shape[0]] = split_vit.front(x.to(device)).cpu().numpy().astype(np.float16)
+        done += x.shape[0]
+        features.flush()
+        _write_index(directory, {**index, 'done': done})
+        rate = (done - index['done']) / (time.perf_counter() - start)
+        logger.info(f"Features {done}/{len(dataset)} ({rate:.1f} img/s)")
+    return np.memmap(path, dtype=np.float16, mode='r', shape=shape)
+
+
+# Shuffled batches straight from the memmap: sorted indices per batch keep the reads mostly sequential
+def feature_batches(features: np.memmap, labels: np.ndarray, batch_size: int, shuffle: bool = True):
+    n = len(labels)
+    order = torch.randperm(n).numpy() if shuffle else np.arange(n)
+    for i in range(0, n, batch_size):
+        idx = np.sort(order[i:i + batch_size])
+        yield torch.from_numpy(features[idx].astype(np.float32)), torch.from_numpy(labels[idx].astype(np.int64))
+
+
+def evaluate(tail: nn.Module, features: np.memmap, labels: np.ndarray, batch_size: int,
+             device: torch.device = torch.device('cpu')) -> float:
+    tail.eval()
+    correct = 0
+    with torch.no_grad():
+        for x, y in feature_batches(features, labels, batch_size, shuffle=False):
+            correct += (tail(x.to(device)).argmax(dim=1).cpu() == y).sum().item()
+    return correct / len(labels) if len(labels) else 0.0
+
+
+# Size of the output layer in a ViT checkpoint (None if it can't be told)
+def checkpoint_classes(path: str) -> Optional[int]:
+    if not os.path.exists(path):
+        return None
+    state = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    state = state.get('model_state_dict', state) if isinstance(state, dict) else state
+    weight = state.get('heads.head.3.weight') if isinstance(state, dict) else None
+    return None if weight is None else weight.shape[0]
+
+
+# Full ViT state dict with the retrained tail merged in: loads with _load_model like the original checkpoint
+def save_checkpoint(path: str, vit: nn.Module, classes: List[str], epoch: int, accuracy: float,
+                    train_blocks: int) -> None:
+    tmp = path + '.tmp'
+    torch.save({
+        'model_state_dict': vit.state_dict(),
+        'classes': classes,
+        'epoch': epoch,
+        'accuracy': accuracy,
+        'train_blocks': train_blocks,
+    }, tmp)
+    os.replace(tmp, path)
+
+
+# (dataset, what identifies its images for the cache key, labels)
+def _split(args, name: str, classes: List[str]) -> Tuple[Dataset, List[str], np.ndarray]:
+    if args.shards:
+        dataset = ShardDataset(os.path.join(args.shards, name), train=False, limit=args.limit)
+        return dataset, [f"{dataset.digest}:{len(dataset)}"], dataset.labels()
+    samples = read_split(args.data_root, name, classes, args.limit)
+    return (ImageListDataset(samples, EvalTransform()), [path for path, _ in samples],
+            np.asarray([label for _, label in samples], dtype=np.int16))
+
+
+def main() -> None:
+    from src.model.model import FoodClassificationService
+
+    parser = argparse.ArgumentParser(description="Retrain the ViT head (and optionally the last blocks) "
+                                                 "from cached frozen-backbone features")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--data-root', help="Food-101 folder with images/ and meta/")
+    source.add_argument('--shards', help="Output of python -m src.training.shards (no JPEG decoding)")
+    parser.add_argument('--checkpoint', default="src/model/vit_food_101.pth")
+    parser.add_argument('--classes', default=CLASSES_PATH)
+    parser.add_argument('--out', default="src/model/vit_food_101.retrained.pth")
+    parser.add_argument('--cache-dir', default=".cache/embeddings")
+    parser.add_argument('--train-blocks', type=int, default=0,
+                        help="Last encoder blocks to train; 0 caches CLS embeddings and trains only the head")
+    parser.add_argument('--reset-head', action='store_true', help="Start the head from scratch")
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--extract-batch-size', type=int, default=64)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--limit', type=int, default=0, help="Use only the first N train/test images")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    classes = load_classes(args.classes)
+    service = FoodClassificationService(args.checkpoint, args.classes)
+    # A changed class list: load the checkpoint with its own head size, then swap the last layer
+    trained_classes = checkpoint_classes(args.checkpoint)
+    if trained_classes and trained_classes != len(classes):
+        service.classes = [str(i) for i in range(trained_classes)]
+    service.load()
+    vit, device = service.model, service.device
+    if not hasattr(vit, 'encoder'):
+        raise SystemExit(f"{args.checkpoint} is not a ViT checkpoint")
+    last = vit.heads.head[-1]
+    if last.out_features != len(classes):
+        vit.heads.head[-1] = nn.Linear(last.in_features, len(classes)).to(device)
+        logger.info(f"New output layer: {last.out_features} -> {len(classes)} classes")
+    split_vit = SplitViT(vit, args.train_blocks)
+
+    cache = os.path.join(args.cache_dir, f"blocks{args.train_blocks}")
+    splits = {}
+    for name in ('train', 'test'):
+        dataset, sources, labels = _split(args, name, classes)
+        features = build_cache(split_vit, dataset, sources, os.path.join(cache, name), args.checkpoint,
+                               args.extract_batch_size, args.workers, device)
+        splits[name] = (features, labels)
+
+    tail = split_vit.tail()
+    if args.reset_head:
+        for module in tail.head:
+            if isinstance(module, nn.Linear):
+                module.reset_parameters()
+    for p in vit.parameters():
+        p.requires_grad = False
+    for p in tail.parameters():
+        p.requires_grad = True
+    optimizer = torch.optim.AdamW(tail.parameters(), lr=args.lr, weight_decay=0.05)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=max(1, args.epochs))
+
+    train_features, train_labels = splits['train']
+    best = evaluate(tail, *splits['test'], args.batch_size, device)
+    logger.info(f"Test accuracy before retraining {best:.2%}")
+    saved = False
+    for epoch in range(args.epochs):
+        tail.train()
+        running, seen, start = 0.0, 0, time.perf_counter()
+        for x, y in feature_batches(train_features, train_labels, args.batch_size):
+            x, y = x.to(device), y.to(device)
+            loss = F.cross_entropy(tail(x), y, label_smoothing=0.1)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            running += loss.item() * y.shape[0]
+            seen += y.shape[0]
+        scheduler.step()
+
+        accuracy = evaluate(tail, *splits['test'], args.batch_size, device)
+        logger.info(f"Epoch {epoch + 1}: loss {running / max(seen, 1):.4f}, test accuracy {accuracy:.2%}, "
+                    f"{seen / (time.perf_counter() - start):.0f} samples/s")
+        if accuracy > best:
+            best, saved = accuracy, True
+            save_checkpoint(args.out, vit, classes, epoch, accuracy, args.train_blocks)
+            logger.info(f"Saved retrained model to {args.out}")
+    if not saved:
+        logger.info(f"No epoch beat the starting {best:.2%}, nothing saved")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
@@ -0,0 +1,208 @@
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from multiprocessing import Pool
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torch.utils.data import Dataset
+
+from src.model.preprocess import CROP, MEAN, RESIZE, STD, decode_image
+from src.training.data import CLASSES_PATH, load_classes, read_split
+
+logger = logging.getLogger(__name__)
+
+IMAGES_FILE = 'images.u8'
+LABELS_FILE = 'labels.i16'
+INDEX_FILE = 'index.json'
+
+
+# Short side resized to `size` (like serving's Resize(256)), then the centre size x size square.
+# Serving's CenterCrop(224) of this square is exactly what it would see from the original photo.
+def to_square(path: str, size: int = RESIZE) -> np.ndarray:
+    with open(path, 'rb') as f:
+        img = decode_image(f, short_side=size)
+    # Same rounding as to_tensor, so the centre crop lands on the same pixels
+    w, h = img.size
+    resized = (size, int(size * h / w)) if w <= h else (int(size * w / h), size)
+    if resized != (w, h):
+        img = img.resize(resized, Image.BILINEAR)
+    left, top = int(round((resized[0] - size) / 2.0)), int(round((resized[1] - size) / 2.0))
+    return np.asarray(img.crop((left, top, left + size, top + size)), dtype=np.uint8)
+
+
+def _decode(job: Tuple[str, int]) -> np.ndarray:
+    return to_square(*job)
+
+
+def _read_index(directory: str) -> Optional[dict]:
+    path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _write_index(directory: str, index: dict) -> None:
+    tmp = os.path.join(directory, INDEX_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, os.path.join(directory, INDEX_FILE))
+
+
+def _digest(samples: List[Tuple[str, int]], size: int) -> str:
+    digest = hashlib.sha1(str(size).encode())
+    for path, label in samples:
+        digest.update(f"{path}:{label}\n".encode())
+    return digest.hexdigest()
+
+
+# One split as <out>/<split>/images.u8 (N x size x size x 3 uint8), labels.i16 and index.json.
+# Decoding runs in `workers` processes; the index records progress, so an interrupted build resumes.
+def build_split(samples: List[Tuple[str, int]], directory: str, classes: List[str], size: int = RESIZE,
+                workers: int = 4, chunk: int = 256) -> dict:
+    os.makedirs(directory, exist_ok=True)
+    digest = _digest(samples, size)
+    index = _read_index(directory)
+    if index is None or index['digest'] != digest:
+        index = {'count': len(samples), 'size': size, 'layout': 'NHWC', 'classes': classes,
+                 'digest': digest, 'done': 0}
+        mode = 'w+'
+    elif index['done'] == index['count']:
+        logger.info(f"{directory} is up to date ({index['count']} images)")
+        return index
+    else:
+        mode = 'r+'
+        logger.info(f"Resuming {directory} at {index['done']}/{index['count']}")
+
+    shape = (max(1, len(samples)), size, size, 3)
+    images = np.memmap(os.path.join(directory, IMAGES_FILE), dtype=np.uint8, mode=mode, shape=shape)
+    labels = np.memmap(os.path.join(directory, LABELS_FILE), dtype=np.int16, mode=mode, shape=(shape[0],))
+    labels[:len(samples)] = [label for _, label in samples]
+
+    start, done = time.perf_counter(), index['done']
+    with Pool(max(1, workers)) as pool:
+        while done < len(samples):
+            jobs = [(path, size) for path, _ in samples[done:done + chunk]]
+            for i, pixels in enumerate(pool.imap(_decode, jobs, chunksize=8)):
+                images[done + i] = pixels
+            done += len(jobs)
+            images.flush()
+            labels.flush()
+            _write_index(directory, {**index, 'done': done})
+            rate = (done - index['done']) / (time.perf_counter() - start)
+            logger.info(f"{directory}: {done}/{len(samples)} ({rate:.1f} img/s)")
+
+    index['done'] = done
+    return index
+
+
+# Reads a built split without decoding anything. The memmap is opened copy-on-write in each
+# DataLoader worker, so every worker reads the same page-cache pages and nothing is copied until
+# augmentation writes a new tensor. Train: random resized crop + flip on the uint8 tensor;
+# eval: centre crop, identical to serving. Returns (image, label, index) like ImageListDataset.
+class ShardDataset(Dataset):
+    def __init__(self, directory: str, train: bool = False, crop: int = CROP,
+                 scale: Tuple[float, float] = (0.7, 1.0), limit: int = 0):
+        index = _read_index(directory)
+        if index is None or index['done'] != index['count']:
+            raise FileNotFoundError(f"No complete shard in {directory}, "
+                                    f"build it with python -m src.training.shards")
+        self.directory = directory
+        self.size = index['size']
+        self.count = min(limit, index['count']) if limit else index['count']
+        self.classes = index['classes']
+        self.digest = index['digest']
+        self.train = train
+        self.crop = crop
+        self.scale = scale
+        self.mean = torch.tensor(MEAN).view(3, 1, 1) * 255
+        self.std = torch.tensor(STD).view(3, 1, 1) * 255
+        self._images = None
+        self._labels = None
+
+    def _open(self) -> None:
+        shape = (max(1, self.count), self.size, self.size, 3)
+        self._images = np.memmap(os.path.join(self.directory, IMAGES_FILE), dtype=np.uint8, mode='c',
+                                 shape=shape)
+        self._labels = np.memmap(os.path.join(self.directory, LABELS_FILE), dtype=np.int16, mode='c',
+                                 shape=(shape[0],))
+
+    # Labels alone, without touching the images
+    def labels(self) -> np.ndarray:
+        if self._labels is None:
+            self._open()
+        return np.asarray(self._labels[:self.count])
+
+    # The memmap is not pickled to workers, each one maps the file itself
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = state['_labels'] = None
+        return state
+
+    def __len__(self):
+        return self.count
+
+    def _random_box(self) -> Tuple[int, int, int, int]:
+        area = self.size * self.size
+        for _ in range(10):
+            target = area * float(torch.empty(1).uniform_(*self.scale))
+            ratio = math.exp(float(torch.empty(1).uniform_(math.log(3 / 4), math.log(4 / 3))))
+            w, h = round(math.sqrt(target * ratio)), round(math.sqrt(target / ratio))
+            if 0 < w <= self.size and 0 < h <= self.size:
+                top = int(torch.randint(0, self.size - h + 1, (1,)))
+                left = int(torch.randint(0, self.size - w + 1, (1,)))
+                return top, left, h, w
+        offset = (self.size - self.crop) // 2
+        return offset, offset, self.crop, self.crop
+
+    def __getitem__(self, idx):
+        if self._images is None:
+            self._open()
+        img = torch.from_numpy(self._images[idx]).permute(2, 0, 1)
+        if self.train:
+            top, left, h, w = self._random_box()
+            x = img[:, top:top + h, left:left + w].float()
+            if (h, w) != (self.crop, self.crop):
+                x = F.interpolate(x.unsqueeze(0), size=(self.crop, self.crop), mode='bilinear',
+                                  align_corners=False, antialias=True).squeeze(0)
+            if torch.rand(1).item() < 0.5:
+                x = x.flip(2)
+        else:
+            offset = (self.size - self.crop) // 2
+            x = img[:, offset:offset + self.crop, offset:offset + self.crop].float()
+        return (x - self.mean) / self.std, int(self._labels[idx]), idx
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Decode a Food-101 folder once into memory-mapped uint8 shards")
+    parser.add_argument('--data-root', required=True, help="Food-101 folder with images/ and meta/")
+    parser.add_argument('--out', default=".cache/shards")
+    parser.add_argument('--classes', default=CLASSES_PATH)
+    parser.add_argument('--splits', nargs='+', default=['train', 'test'])
+    parser.add_argument('--size', type=int, default=RESIZE, help="Side of the stored square")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--limit', type=int, default=0, help="Only the first N images of each split")
+    args = parser.parse_args()
+
+    classes = load_classes(args.classes)
+    for split in args.splits:
+        samples = read_split(args.data_root, split, classes, args.limit)
+        index = build_split(samples, os.path.join(args.out, split), classes, args.size, args.workers)
+        size_mb = index['count'] * args.size * args.size * 3 / 2 ** 20
+        logger.info(f"{split}: {index['count']} images, {size_mb:.0f} MB in {os.path.join(args.out, split)}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
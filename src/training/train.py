@@ -0,0 +1,384 @@
+import argparse
+import logging
+import os
+import random
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+from src.model.model import build_vit
+from src.training.data import CLASSES_PATH, EvalTransform, ImageListDataset, TrainTransform, load_classes, read_split
+from src.training.embeddings import SplitViT
+from src.training.shards import ShardDataset
+
+logger = logging.getLogger(__name__)
+
+LAST_CHECKPOINT = 'last.pth'
+# Settings a resumed run must share with the one that wrote the checkpoint
+RESUME_KEYS = ('batch_size', 'seed', 'limit', 'train_blocks', 'epochs', 'data_root', 'shards')
+
+
+# Python, NumPy and torch from one seed. deterministic also rules out nondeterministic kernels (slower)
+def seed_everything(seed: int, deterministic: bool = False) -> None:
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    torch.manual_seed(seed)
+    if deterministic:
+        os.environ.setdefault('CUBLAS_WORKSPACE_CONFIG', ':4096:8')
+        torch.use_deterministic_algorithms(True, warn_only=True)
+        torch.backends.cudnn.benchmark = False
+
+
+# torch seeds each DataLoader worker from the loader's generator; NumPy and random follow it
+def _seed_worker(worker_id: int) -> None:
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+# A permutation per epoch from (seed, epoch), so a run resumed mid-epoch skips the batches it
+# already trained on without loading them, and sees the rest in the same order
+class EpochSampler(Sampler):
+    def __init__(self, size: int, seed: int):
+        self.size = size
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch: int, start: int = 0) -> None:
+        self.epoch, self.start = epoch, start
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(self.size, generator=generator)[self.start:].tolist())
+
+    def __len__(self):
+        return max(0, self.size - self.start)
+
+
+# Mixup / CutMix on the batch's device, decided per image: with probability `prob` an image is
+# either blended with (mixup) or gets a box pasted from (cutmix) its partner in a shuffled batch.
+# Boxes are masks built from index comparisons, so there is no NumPy and no host round trip.
+# Returns the mixed batch and soft targets for cross_entropy.
+class MixUpCutMix:
+    def __init__(self, num_classes: int, prob: float = 0.5, mixup_alpha: float = 0.8, cutmix_alpha: float = 1.0,
+                 cutmix_share: float = 0.5):
+        self.num_classes = num_classes
+        self.prob = prob
+        self.mixup_alpha = mixup_alpha
+        self.cutmix_alpha = cutmix_alpha
+        self.cutmix_share = cutmix_share
+
+    def _lam(self, alpha: float, n: int, device: torch.device) -> torch.Tensor:
+        if alpha <= 0:
+            return torch.ones(n, device=device)
+        alpha = torch.tensor(alpha, device=device)
+        return torch.distributions.Beta(alpha, alpha).sample((n,))
+
+    def __call__(self, x: torch.Tensor, y: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        target = F.one_hot(y, self.num_classes).float()
+        if self.prob <= 0:
+            return x, target
+        n, _, h, w = x.shape
+        device = x.device
+        perm = torch.randperm(n, device=device)
+        mixed = torch.rand(n, device=device) < self.prob
+        cut = mixed & (torch.rand(n, device=device) < self.cutmix_share)
+        blend = mixed & ~cut
+
+        # CutMix: box of (1 - lam) of the area around a random centre, clipped at the borders
+        side = torch.sqrt(1 - self._lam(self.cutmix_alpha, n, device))
+        half_h, half_w = (h * side).long() // 2, (w * side).long() // 2
+        cy, cx = torch.randint(h, (n,), device=device), torch.randint(w, (n,), device=device)
+        rows, cols = torch.arange(h, device=device), torch.arange(w, device=device)
+        in_rows = (rows >= (cy - half_h).clamp(0, h)[:, None]) & (rows < (cy + half_h).clamp(0, h)[:, None])
+        in_cols = (cols >= (cx - half_w).clamp(0, w)[:, None]) & (cols < (cx + half_w).clamp(0, w)[:, None])
+        box = (in_rows[:, :, None] & in_cols[:, None, :]) & cut[:, None, None]
+        x = torch.where(box[:, None], x[perm], x)
+
+        # Mixup, and lam as the share of the image's own label (the exact box area for CutMix)
+        lam = torch.where(blend, self._lam(self.mixup_alpha, n, device), torch.ones(n, device=device))
+        x = torch.lerp(x[perm], x, lam.to(x.dtype)[:, None, None, None])
+        lam = torch.where(cut, 1 - box.flatten(1).float().mean(1), lam)
+        return x, lam[:, None] * target + (1 - lam[:, None]) * target[perm]
+
+
+# bf16 autocast on CPU and on GPUs that have it, fp16 (with a GradScaler) on older GPUs
+def autocast_dtype(device: torch.device, precision: str) -> Optional[torch.dtype]:
+    if precision == 'fp32':
+        return None
+    if precision == 'auto':
+        if device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+            return torch.float16
+        return torch.bfloat16
+    if precision == 'fp16' and device.type != 'cuda':
+        raise SystemExit("fp16 autocast needs CUDA, use bf16 or fp32 on CPU")
+    return torch.bfloat16 if precision == 'bf16' else torch.float16
+
+
+# The ViT from serving, frozen except the head and, with train_blocks > 0, the last blocks and encoder.ln
+def build_model(num_classes: int, init: Optional[str], imagenet: bool, train_blocks: int) -> nn.Module:
+    weights = None
+    if imagenet:
+        from torchvision.models import ViT_B_16_Weights
+        weights = ViT_B_16_Weights.IMAGENET1K_V1
+    model = build_vit(num_classes, weights)
+    if init:
+        state = torch.load(init, map_location='cpu', weights_only=True)
+        model.load_state_dict(state.get('model_state_dict', state))
+        logger.info(f"Initialized from {init}")
+    elif not imagenet:
+        logger.warning("Training from random weights, pass --init or --imagenet to fine-tune")
+
+    for p in model.parameters():
+        p.requires_grad = False
+    layers = model.encoder.layers
+    trained = list(layers)[len(layers) - train_blocks:] + [model.encoder.ln] if train_blocks else []
+    for module in trained + [model.heads]:
+        for p in module.parameters():
+            p.requires_grad = True
+    return model
+
+
+def _datasets(args, classes: List[str]) -> Tuple[Dataset, Dataset]:
+    if args.shards:
+        return (ShardDataset(os.path.join(args.shards, 'train'), train=True, limit=args.limit),
+                ShardDataset(os.path.join(args.shards, 'test'), train=False, limit=args.limit))
+    return (ImageListDataset(read_split(args.data_root, 'train', classes, args.limit), TrainTransform()),
+            ImageListDataset(read_split(args.data_root, 'test', classes, args.limit), EvalTransform()))
+
+
+def evaluate(model: nn.Module, loader: DataLoader, device: torch.device, dtype: Optional[torch.dtype]) -> float:
+    model.eval()
+    correct = total = 0
+    with torch.no_grad(), torch.autocast(device.type, dtype=dtype, enabled=dtype is not None):
+        for x, y, _ in loader:
+            correct += (model(x.to(device)).argmax(dim=1).cpu() == y).sum().item()
+            total += y.shape[0]
+    return correct / total if total else 0.0
+
+
+# NumPy's state holds an array, kept as a tensor so the checkpoint still loads with weights_only
+def rng_state() -> dict:
+    kind, keys, pos, has_gauss, gauss = np.random.get_state()
+    return {
+        'python': random.getstate(),
+        'numpy': (kind, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, gauss),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state: dict) -> None:
+    random.setstate(state['python'])
+    kind, keys, pos, has_gauss, gauss = state['numpy']
+    np.random.set_state((kind, keys.numpy().astype(np.uint32), pos, has_gauss, gauss))
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+# Everything needed to continue, written atomically. model_state_dict sits at the top level,
+# so _load_model reads this file like any other checkpoint.
+def save_checkpoint(path: str, model: nn.Module, classes: List[str], epoch: int, step: int, accuracy: float,
+                    optimizer=None, scheduler=None, scaler=None, config: Optional[dict] = None) -> None:
+    tmp = path + '.tmp'
+    checkpoint = {
+        'model_state_dict': model.state_dict(),
+        'classes': classes,
+        'epoch': epoch,
+        'accuracy': accuracy,
+    }
+    if optimizer is not None:
+        checkpoint.update({
+            'step': step,
+            'optimizer_state_dict': optimizer.state_dict(),
+            'scheduler_state_dict': scheduler.state_dict(),
+            'scaler_state_dict': scaler.state_dict() if scaler is not None else None,
+            'rng_state': rng_state(),
+            'config': config,
+        })
+    torch.save(checkpoint, tmp)
+    os.replace(tmp, path)
+
+
+# Per-step timing between log lines: waiting for the loader vs everything after the batch arrived
+class Throughput:
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.start = time.perf_counter()
+        self.wait = 0.0
+        self.steps = 0
+        self.images = 0
+
+    def step(self, wait: float, images: int) -> None:
+        self.wait += wait
+        self.steps += 1
+        self.images += images
+
+    def report(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        compute = elapsed - self.wait
+        return (f"{self.images / elapsed:.1f} img/s, data wait {self.wait / self.steps * 1000:.0f} ms/step, "
+                f"compute {compute / self.steps * 1000:.0f} ms/step ({self.wait / elapsed:.0%} waiting)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fine-tune the serving ViT on Food-101 (resumable)")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--data-root', help="Food-101 folder with images/ and meta/")
+    source.add_argument('--shards', help="Output of python -m src.training.shards (no JPEG decoding)")
+    parser.add_argument('--classes', default=CLASSES_PATH)
+    parser.add_argument('--init', help="Checkpoint to start from, e.g. src/model/vit_food_101.pth")
+    parser.add_argument('--imagenet', action='store_true', help="Start from torchvision's ImageNet weights")
+    parser.add_argument('--out', default="src/model/vit_food_101.trained.pth", help="Best weights by test accuracy")
+    parser.add_argument('--checkpoint-dir', default=".cache/train", help=f"Where {LAST_CHECKPOINT} is kept")
+    parser.add_argument('--resume', action='store_true', help=f"Continue from {LAST_CHECKPOINT}")
+    parser.add_argument('--train-blocks', type=int, default=4, help="Last encoder blocks to train")
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--warmup-epochs', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--lr', type=float, default=3e-4, help="Head learning rate")
+    parser.add_argument('--backbone-lr-scale', type=float, default=0.1, help="Encoder lr = lr x this")
+    parser.add_argument('--weight-decay', type=float, default=1e-4)
+    parser.add_argument('--label-smoothing', type=float, default=0.1)
+    parser.add_argument('--mix-prob', type=float, default=0.5, help="Share of images that get mixup or cutmix")
+    parser.add_argument('--mixup-alpha', type=float, default=0.8)
+    parser.add_argument('--cutmix-alpha', type=float, default=1.0)
+    parser.add_argument('--clip-grad', type=float, default=1.0)
+    parser.add_argument('--precision', choices=['auto', 'bf16', 'fp16', 'fp32'], default='auto')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=0, help="torch threads (0 = default)")
+    parser.add_argument('--limit', type=int, default=0, help="Use only the first N train/test images")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--deterministic', action='store_true', help="Deterministic kernels only (slower)")
+    parser.add_argument('--log-every', type=int, default=20, help="Steps between throughput lines")
+    parser.add_argument('--save-every', type=int, default=500, help="Steps between resume checkpoints")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    seed_everything(args.seed, args.deterministic)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    dtype = autocast_dtype(device, args.precision)
+    classes = load_classes(args.classes)
+    train_set, test_set = _datasets(args, classes)
+    config = {key: getattr(args, key) for key in RESUME_KEYS}
+
+    model = build_model(len(classes), args.init, args.imagenet, args.train_blocks).to(device)
+    # The frozen blocks run like inference (no autograd, fused attention); only the tail is trained
+    split = SplitViT(model, args.train_blocks)
+    tail = split.tail()
+    head = list(model.heads.parameters())
+    head_ids = {id(p) for p in head}
+    encoder = [p for p in model.parameters() if p.requires_grad and id(p) not in head_ids]
+    optimizer = torch.optim.AdamW([
+        {'params': head, 'lr': args.lr},
+        {'params': encoder, 'lr': args.lr * args.backbone_lr_scale},
+    ], weight_decay=args.weight_decay)
+    warmup = min(args.warmup_epochs, max(0, args.epochs - 1))
+    scheduler = torch.optim.lr_scheduler.SequentialLR(optimizer, [
+        torch.optim.lr_scheduler.LinearLR(optimizer, start_factor=0.1, total_iters=max(1, warmup)),
+        torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=max(1, args.epochs - warmup)),
+    ], milestones=[warmup])
+    scaler = torch.amp.GradScaler(device.type) if dtype == torch.float16 else None
+    mix = MixUpCutMix(len(classes), args.mix_prob, args.mixup_alpha, args.cutmix_alpha)
+
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
+    last_path = os.path.join(args.checkpoint_dir, LAST_CHECKPOINT)
+    start_epoch, start_step, best = 0, 0, -1.0
+    if args.resume and os.path.exists(last_path):
+        checkpoint = torch.load(last_path, map_location='cpu', weights_only=True)
+        changed = {k: (checkpoint['config'].get(k), v) for k, v in config.items() if checkpoint['config'].get(k) != v}
+        if changed:
+            raise SystemExit(f"{last_path} was written with other settings (saved, now): {changed}")
+        model.load_state_dict(checkpoint['model_state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        if scaler is not None and checkpoint['scaler_state_dict']:
+            scaler.load_state_dict(checkpoint['scaler_state_dict'])
+        set_rng_state(checkpoint['rng_state'])
+        start_epoch, start_step, best = checkpoint['epoch'], checkpoint['step'], checkpoint['accuracy']
+        logger.info(f"Resuming from {last_path}: epoch {start_epoch + 1}, step {start_step}")
+    elif args.resume:
+        logger.info(f"No {last_path} yet, starting from scratch")
+
+    sampler = EpochSampler(len(train_set), args.seed)
+    loader_options = {'num_workers': args.workers, 'pin_memory': device.type == 'cuda',
+                      'persistent_workers': args.workers > 0, 'worker_init_fn': _seed_worker}
+    generator = torch.Generator()
+    train_loader = DataLoader(train_set, batch_size=args.batch_size, sampler=sampler,
+                              drop_last=len(train_set) > args.batch_size, generator=generator, **loader_options)
+    test_loader = DataLoader(test_set, batch_size=args.batch_size, **loader_options)
+    trainable = [p for p in tail.parameters() if p.requires_grad]
+    logger.info(f"{len(train_set)} train / {len(test_set)} test images, "
+                f"{sum(p.numel() for p in trainable) / 1e6:.1f}M trainable parameters, "
+                f"{dtype or torch.float32} on {device}")
+
+    for epoch in range(start_epoch, args.epochs):
+        # Worker seeds per epoch too; only a mid-epoch resume with workers > 0 replays different augmentations
+        generator.manual_seed(args.seed + epoch)
+        sampler.set_epoch(epoch, start_step * args.batch_size)
+        step, start_step = start_step, 0
+        steps = step + len(train_loader)
+        model.eval()
+        tail.train()
+        throughput = Throughput()
+        running, seen = torch.zeros((), device=device), 0
+        epoch_start = waited = time.perf_counter()
+        for x, y, _ in train_loader:
+            arrived = time.perf_counter()
+            x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+            x, targets = mix(x, y)
+            with torch.autocast(device.type, dtype=dtype, enabled=dtype is not None):
+                logits = tail(split.front(x))
+            loss = F.cross_entropy(logits.float(), targets, label_smoothing=args.label_smoothing)
+
+            optimizer.zero_grad(set_to_none=True)
+            if scaler is not None:
+                scaler.scale(loss).backward()
+                scaler.unscale_(optimizer)
+                nn.utils.clip_grad_norm_(trainable, args.clip_grad)
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                loss.backward()
+                nn.utils.clip_grad_norm_(trainable, args.clip_grad)
+                optimizer.step()
+            running += loss.detach() * y.shape[0]
+            seen += y.shape[0]
+            step += 1
+            throughput.step(arrived - waited, y.shape[0])
+
+            if step % args.log_every == 0 or step == steps:
+                # .item() waits for the GPU, so the compute time below is real
+                logger.info(f"Epoch {epoch + 1} step {step}/{steps}: loss {loss.item():.4f}, {throughput.report()}")
+                throughput.reset()
+            if args.save_every and step % args.save_every == 0 and step < steps:
+                save_checkpoint(last_path, model, classes, epoch, step, best, optimizer, scheduler, scaler, config)
+            waited = time.perf_counter()
+        scheduler.step()
+
+        accuracy = evaluate(model, test_loader, device, dtype)
+        logger.info(f"Epoch {epoch + 1}: loss {running.item() / max(seen, 1):.4f}, test accuracy {accuracy:.2%}, "
+                    f"{seen / (time.perf_counter() - epoch_start):.1f} img/s")
+        if accuracy > best:
+            best = accuracy
+            save_checkpoint(args.out, model, classes, epoch, step, accuracy)
+            logger.info(f"Saved best model to {args.out}")
+        save_checkpoint(last_path, model, classes, epoch + 1, 0, best, optimizer, scheduler, scaler, config)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
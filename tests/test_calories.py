@@ -0,0 +1,50 @@
+import asyncio
+
+from src.database.calories import CalorieIndex
+
+
+class _Result:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return self.rows
+
+
+# Stands in for an AsyncSession; `during` runs while the SELECT is in flight
+class _Session:
+    def __init__(self, rows, during=None):
+        self.rows = rows
+        self.during = during
+
+    async def execute(self, _):
+        if self.during is not None:
+            self.during()
+        return _Result(list(self.rows))
+
+
+def test_invalidate_during_load_is_not_lost():
+    async def scenario():
+        index = CalorieIndex()
+        rows = [("Pizza", 266.0)]
+
+        # Another writer adds a dish and invalidates while the first load is reading
+        def write():
+            rows.append(("Sushi", 150.0))
+            index.invalidate()
+
+        stale = _Session([("Pizza", 266.0)], during=write)
+        assert (await index.lookup(stale, "pizza")).name == "Pizza"
+        match = await index.lookup(_Session(rows), "sushi")
+        assert match is not None and match.name == "Sushi"
+
+    asyncio.run(scenario())
+
+
+def test_load_is_reused_without_invalidate():
+    async def scenario():
+        index = CalorieIndex()
+        await index.lookup(_Session([("Pizza", 266.0)]), "pizza")
+        assert (await index.lookup(_Session([]), "pizza")).name == "Pizza"
+
+    asyncio.run(scenario())
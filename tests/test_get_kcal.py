@@ -0,0 +1,83 @@
+import asyncio
+
+from aiohttp import web
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from src import get_kcal as bootstrap
+from src.database.models import Calories
+from src.database.models.base import Base
+from src.database.query import get_cals
+
+KCAL = {"Pizza": 266.0, "Sushi": 150.0, "Ramen": 436.0}
+# Statuses the stub answers before the real response, per query
+FAILURES = {"Pizza": [429], "Sushi": [500, 503]}
+
+
+def _food(kcal: float) -> dict:
+    return {"foods": [{"foodNutrients": [{"nutrientName": "Energy", "unitName": "KCAL", "value": kcal}]}]}
+
+
+async def _stub_usda(requests: dict):
+    failures = {name: list(statuses) for name, statuses in FAILURES.items()}
+
+    async def search(request: web.Request) -> web.Response:
+        name = request.query["query"]
+        requests[name] = requests.get(name, 0) + 1
+        if failures.get(name):
+            return web.Response(status=failures[name].pop(0))
+        return web.json_response(_food(KCAL[name]))
+
+    app = web.Application()
+    app.router.add_get("/search", search)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/search"
+
+
+# Retries 429/5xx, stores everything with one bulk upsert, and a second run is answered
+# from the on-disk cache without asking the server again
+def test_bootstrap_against_stub(tmp_path, monkeypatch):
+    monkeypatch.setattr(bootstrap.random, "uniform", lambda a, b: 0)
+    upserts = []
+    upsert_cals = bootstrap.upsert_cals
+
+    async def counting_upsert(session, rows):
+        upserts.append(dict(rows))
+        await upsert_cals(session, rows)
+
+    monkeypatch.setattr(bootstrap, "upsert_cals", counting_upsert)
+    classes = tmp_path / "classes.txt"
+    classes.write_text("pizza\nsushi\nramen\n")
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        pool = async_sessionmaker(engine, expire_on_commit=False)
+        requests = {}
+        runner, url = await _stub_usda(requests)
+        cache_dir = str(tmp_path / "usda")
+        try:
+            await bootstrap.get_kcal(pool, str(classes), url, "key", cache_dir)
+            assert requests == {"Pizza": 2, "Sushi": 3, "Ramen": 1}
+            assert upserts == [KCAL]
+            async with pool() as session:
+                assert await get_cals(session) == KCAL
+
+            async with pool() as session:
+                await session.execute(delete(Calories))
+                await session.commit()
+            await bootstrap.get_kcal(pool, str(classes), url, "key", cache_dir)
+            assert requests == {"Pizza": 2, "Sushi": 3, "Ramen": 1}
+            assert upserts == [KCAL, KCAL]
+            async with pool() as session:
+                assert await get_cals(session) == KCAL
+        finally:
+            await runner.cleanup()
+            await engine.dispose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,48 @@
+import asyncio
+import json
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from src.database.models.base import Base
+from src.database.query import get_cals, get_meta, upsert_cals
+from src.database.snapshot import VERSION_KEY, apply_snapshot
+
+
+def _write(path, version, calories):
+    path.write_text(json.dumps({'version': version, 'source': 'test', 'calories': calories}))
+
+
+def test_newer_snapshot_updates_changed_rows(tmp_path):
+    snapshot = tmp_path / "snapshot.json"
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        pool = async_sessionmaker(engine, expire_on_commit=False)
+        try:
+            async with pool() as session:
+                _write(snapshot, 1, {"Pizza": 266.0, "Sushi": 150.0})
+                assert await apply_snapshot(session, str(snapshot)) == 2
+                assert await get_meta(session, VERSION_KEY) == "1"
+
+                # Same version again: a value written since is kept, only new dishes are added
+                await upsert_cals(session, {"Pizza": 280.0})
+                _write(snapshot, 1, {"Pizza": 266.0, "Sushi": 150.0, "Ramen": 436.0})
+                assert await apply_snapshot(session, str(snapshot)) == 1
+                assert await get_cals(session) == {"Pizza": 280.0, "Sushi": 150.0, "Ramen": 436.0}
+
+                # A regenerated snapshot fixes stale rows and leaves equal ones alone
+                _write(snapshot, 2, {"Pizza": 266.0, "Sushi": 143.0, "Ramen": 436.0})
+                assert await apply_snapshot(session, str(snapshot)) == 2
+                assert await get_cals(session) == {"Pizza": 266.0, "Sushi": 143.0, "Ramen": 436.0}
+                assert await get_meta(session, VERSION_KEY) == "2"
+
+                # An older bundled snapshot never rolls the table back
+                _write(snapshot, 1, {"Pizza": 1.0})
+                assert await apply_snapshot(session, str(snapshot)) == 0
+                assert await get_meta(session, VERSION_KEY) == "2"
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())
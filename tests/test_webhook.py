@@ -0,0 +1,69 @@
+import asyncio
+import os
+
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.types import Message
+from aiohttp.test_utils import TestServer
+
+from src.bot.replay import load_updates, replay
+from src.bot.stub import StubSession
+from src.bot.webhook import WebhookServer
+
+UPDATES = os.path.join(os.path.dirname(__file__), "data", "updates.jsonl")
+
+
+# Recorded updates are posted to the webhook app with a BOT_STUB bot. Handlers wait on `gate`,
+# so the test controls when queued work finishes.
+def test_webhook_acks_rejects_and_drains():
+    async def scenario():
+        text, photo = load_updates(UPDATES)
+        gate, started, done = asyncio.Event(), asyncio.Event(), []
+        router = Router()
+
+        @router.message(F.photo)
+        async def on_photo(msg: Message, bot: Bot):
+            started.set()
+            await gate.wait()
+            await bot.download(msg.photo[-1])
+            await msg.answer("photo")
+            done.append(msg.message_id)
+
+        @router.message(F.text)
+        async def on_text(msg: Message):
+            await gate.wait()
+            await msg.answer("text")
+            done.append(msg.message_id)
+
+        dp = Dispatcher()
+        dp.include_router(router)
+        session = StubSession()
+        bot = Bot(token="123:abc", session=session)
+        server = WebhookServer(dp, bot, workers=1, photo_workers=1, queue_size=1, drain_timeout=10)
+        http = TestServer(server.app)
+        await http.start_server()
+        url = str(http.make_url(server.path))
+        server.start()
+        try:
+            # Acknowledged while the handler is still waiting
+            assert await replay(url, [text], concurrency=1) == {200: 1}
+            # One photo in the worker and one in the queue fill the photo lane: the next gets 503
+            assert await replay(url, [photo], concurrency=1) == {200: 1}
+            await asyncio.wait_for(started.wait(), 5)
+            assert await replay(url, [photo], concurrency=1) == {200: 1}
+            assert await replay(url, [photo], concurrency=1) == {503: 1}
+            assert done == []
+
+            draining = asyncio.create_task(server.drain())
+            await asyncio.sleep(0)
+            assert await replay(url, [text], concurrency=1) == {503: 1}
+            gate.set()
+            await asyncio.wait_for(draining, 10)
+            assert sorted(done) == [1, 2, 2]
+            assert session.calls.get("SendMessage") == 3
+            assert session.calls.get("GetFile") == 2
+        finally:
+            gate.set()
+            await http.close()
+            await bot.session.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,50 @@
+import asyncio
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from src.database.models.base import Base
+from src.database.query import get_day_meals
+from src.database.write_behind import WriteBehindBuffer
+
+
+# A flush_user() that lands while a flush is writing must wait for its commit,
+# otherwise the read right after it misses the meal that was just added
+def test_flush_user_waits_for_flush_in_flight(tmp_path):
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        pool = async_sessionmaker(engine, expire_on_commit=False)
+        buffer = WriteBehindBuffer(pool, enabled=True, flush_ms=60_000)
+
+        # Hold the batch inside _write until the reader has asked for a flush
+        writing, release = asyncio.Event(), asyncio.Event()
+        write = buffer._write
+
+        async def slow_write(session, ops):
+            writing.set()
+            await release.wait()
+            await write(session, ops)
+
+        buffer._write = slow_write
+        try:
+            await buffer.add_meal(None, 1, "Pizza", 150.0, 399.0)
+            flushing = asyncio.create_task(buffer.flush())
+            await writing.wait()
+
+            reader = asyncio.create_task(buffer.flush_user(1))
+            await asyncio.sleep(0.05)
+            assert not reader.done()
+
+            release.set()
+            await asyncio.gather(flushing, reader)
+            async with pool() as session:
+                meals = await get_day_meals(session, 1)
+            assert [meal.name for meal in meals] == ["Pizza"]
+            assert not buffer.pending(1)
+        finally:
+            release.set()
+            await buffer.close()
+            await engine.dispose()
+
+    asyncio.run(scenario())